@@ -1,6 +1,5 @@
 import os
 from typing import List, Dict, Any, Optional
-from openai import AsyncOpenAI
 import json
 import re
 import asyncio
@@ -12,14 +11,18 @@ from services import feedback_memory
 
 from sdk.tool import BaseTool
 from memory.mcp_memory import MCPMemoryManager
-from agent.prompt_template import generate_prompt
+from agent.prompt_template import assemble_prompt, generate_prompt
 from models.schemas import ChatMessage,QueryResponse
 from memory import pgvector_memory as pgvec
 
 from services.feedback_memory import store_message as store_feedback_message
-from services.feedback_memory import get_user_messages
+from services.feedback_memory import get_user_messages, search_feedback
 
 from services.feedback_tool import FeedbackTool
+from services import deadline, metrics, tracing
+from services.context_packer import ContextItem, context_packer
+from services.llm_gateway import llm
+from sdk.stdio_transport import serve_stdio
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO,
                     format="%(asctime)s [%(levelname)s] %(message)s")
@@ -43,8 +46,6 @@ class MCPAgent:
         self.memory = memory
         self.prompt_template = prompt_template
         
-        self.client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        
         # for tool in tools:
         #     if tool.name=="openai":
         #         self.openai_tool=tool
@@ -187,13 +188,14 @@ class MCPAgent:
             #     {"role": "system", "content": "You output strictly valid JSON and nothing else."},
             #     {"role": "user", "content": f"{prompt}\n\nUser input:\n{user_input}"}
             # ]
-            resp=await self.client.chat.completions.create(
+            resp=await llm.chat(
+                "field_extraction",
                 model="gpt-3.5-turbo",
                 temperature=0,
-                messages=[
-                    {"role":"system","content":"You output strictly valid JSON and nothing else."},
-                    {"role":"user","content":prompt},
-                ],
+                messages=assemble_prompt(
+                    "You output strictly valid JSON and nothing else.\n\n"+prompt,
+                    user_input=user_input,
+                ),
             )
             content=resp.choices[0].message.content or ""
             content=self._strip_code_fences(content)
@@ -239,13 +241,7 @@ class MCPAgent:
         This helps the agent consider prior corrections and feedback.
         """
         try:
-            messages=await get_user_messages(user_id)
-            relevant=[]
-            for m in messages:
-                if 'assistant' in m['role'] or 'feedback' in m['role']:
-                    if any (word in user_input.lower() for word in m['content'].lower().split()):
-                        relevant.append(m)
-            return relevant[:top_k]
+            return await search_feedback(user_id, user_input, top_k=top_k)
         except Exception:
             logger.exception("Failed to fetch relevant feedback") 
             return []                   
@@ -253,6 +249,12 @@ class MCPAgent:
     
     async def run(self, user_id: str, messages: List[ChatMessage], use_memory: bool = True):
         extracted=None
+        #rate limiting - before any memory writes, embeddings or LLM calls
+        if self.ratelimiter_tool:
+            allowed= await self.ratelimiter_tool.run({"user_id":user_id})
+            if not allowed.get("allowed",True):
+                return {"error":"Rate limit exceeded.", "rate_limited":True, "retry_after":allowed.get("retry_after")}
+        
         #save latest message in memory
         chat_messages = []
         for msg in messages:
@@ -273,24 +275,27 @@ class MCPAgent:
             if not role or not content:
                 raise ValueError("Each message must contain 'role' and 'content' ")
             try:
-                maybe = self.memory.add_message(user_id, role=role, content=content)
-                if asyncio.iscoroutine(maybe):
-                    await maybe
+                with metrics.time_stage("memory_write"):
+                    maybe = self.memory.add_message(user_id, role=role, content=content)
+                    if asyncio.iscoroutine(maybe):
+                        await maybe
                 ###
                 if role=="user":
                     try: 
-                        await pgvec.store_message(user_id, content)
+                        with metrics.time_stage("embedding"):
+                            await pgvec.store_message(user_id, content)
                     except Exception:
                         logger.exception("Failed storing embedding for user message")
                         
                     ######feedback memory part- store memory in redis
                     try:
-                        message_id=await store_feedback_message(
-                            user_id=user_id,
-                            role="user",
-                            content=content,
-                            metadata={"source":"mcp_client"}
-                        )
+                        with metrics.time_stage("memory_write"):
+                            message_id=await store_feedback_message(
+                                user_id=user_id,
+                                role="user",
+                                content=content,
+                                metadata={"source":"mcp_client"}
+                            )
                         logger.info(f"Stored user message {message_id} for feedback learning")
                     except Exception:
                         logger.exception("Failed storing user message for feedback memory")
@@ -300,7 +305,8 @@ class MCPAgent:
         
         user_input=messages[-1].content.strip()  
         
-        relevant_feedback=await self._fetch_relevant_feedback(user_id, user_input)
+        with metrics.time_stage("feedback_fetch"):
+            relevant_feedback=await self._fetch_relevant_feedback(user_id, user_input)
         feedback_context="\n".join([f"{f['role']}: {f['content']}" for f in relevant_feedback])
         
         llm_input= f"{feedback_context}\nUser: {user_input}" if feedback_context else user_input
@@ -353,12 +359,6 @@ class MCPAgent:
             else:
                 return {"error": "Memory tool not available."}
         
-        #rate limiting 
-        if self.ratelimiter_tool:
-            allowed= self.ratelimiter_tool.run({"user_id":user_id})
-            if not allowed.get("allowed",True):
-                return {"error":"Rate limit exceeded."}   
-            
         #enforce he required-field check BEFORE generating SQL
         if self._looks_like_write_intent(user_input):
             extracted= await self._extract_required_fields_llm(user_input)
@@ -385,41 +385,43 @@ class MCPAgent:
             )    
             
         ###
-        prompt_messages=[]
+        context_items=[]
         try:
-            context= await pgvec.get_context_for_query(user_id, user_input, top_k=3, recent_window=3)
-            memory_parts=[]
+            with metrics.time_stage("context_fetch"):
+                context= await pgvec.get_context_for_query(user_id, user_input, top_k=3, recent_window=3)
             if context.get("summary"):
-                memory_parts.append("Summary of past conversation:" + context["summary"])
-            if context.get("similar"):
-                for s in context["similar"]:
-                    memory_parts.append(f"Similar past message (dist={s['distance']:.4f}): {s['message']}")
-            if context.get("recent"):
-                memory_parts.append("Recent messages:\n" + "\n".join(context["recent"]))
-            memory_system_msg = {"role": "system", "content": "\n\n".join(memory_parts)[:4000]}
-            
-            prompt_messages=[memory_system_msg]
+                context_items.append(ContextItem("summary", context["summary"]))
+            for rank, s in enumerate(context.get("similar") or []):
+                context_items.append(ContextItem("similar", s["message"], rank=rank, order=rank,
+                                                 prefix=f"Similar past message (dist={s['distance']:.4f}): "))
+            recent=context.get("recent") or []
+            for position, m in enumerate(recent):
+                context_items.append(ContextItem("recent", m, rank=len(recent)-position, order=position))
         
         except Exception:
             logger.exception("Failed to fetch semantic memory; continuing without it")  
             
     ####feedback memory part
         try:
-            recent_messages= await get_user_messages(user_id=user_id, limit=20, reverse=True)
-            conversation_history=[]
-            for msg in recent_messages:
+            with metrics.time_stage("context_fetch"):
+                recent_messages= await get_user_messages(user_id=user_id, limit=20, reverse=True,
+                                                         fields=["role", "content", "timestamp", "score"])
+            for rank, msg in enumerate(recent_messages):
                 if msg.get("score") is not None and msg["score"] <3:
                     continue
-                role=msg["role"]
-                content=msg["content"]
-                conversation_history.append({"role":role, "content":content})
-                
-            system_msg={"role":"system", "content":"You are an AI assistant learning from this user's message."}
-            prompt_messages= [system_msg] + conversation_history+ [{"role":"user","content": user_input}]
+                context_items.append(ContextItem("feedback", msg["content"], rank=rank,
+                                                 order=msg.get("timestamp") or -rank, role=msg["role"]))
             
         except Exception:
             logger.exception("Failed to fetch feedback messages; continuing without them")
-            prompt_messages=[{"role":"user","content":user_input}]
+        
+        with metrics.time_stage("context_pack"):
+            packed=context_packer.pack(
+                "You are an AI assistant learning from this user's message.",
+                user_input,
+                context_items,
+            )
+        prompt_messages=packed.messages
             
         ####
         
@@ -428,10 +430,13 @@ class MCPAgent:
             if self.openai_tool:
                 # openai_result=await self.openai_tool.run({"instruction":user_input,"user_id":user_id})
                 try:
-                    openai_result=await self.openai_tool.run({
-                        "messages": prompt_messages,
-                        "user_id":user_id
-                    })
+                    with metrics.time_stage("llm_sql"):
+                        openai_result=await self.openai_tool.run({
+                            "messages": prompt_messages,
+                            "user_id":user_id
+                        })
+                except deadline.DeadlineExceeded:
+                    raise
                 except Exception as e:
                     logger.exception("OpenAI tool failed")
                     return {"source": "openai","response":f"Error in OpenAI tool: {str(e)}"}
@@ -458,7 +463,8 @@ class MCPAgent:
                 
                 #validate SQL
                 if self.sql_validator:
-                    valid= await self.sql_validator.run({"query":sql_query})
+                    with metrics.time_stage("validation"):
+                        valid= await self.sql_validator.run({"query":sql_query})
                     is_valid=valid.get("valid", True) if isinstance(valid,dict) else True
                     if not is_valid or "error" in valid:
                         answer = "Invalid SQL generated."
@@ -472,7 +478,8 @@ class MCPAgent:
                     return {"source": "openai", "response": answer}
                 
                 #explain SQL if requested
-                db_result = await self.sql_executor.run({"query": sql_query})
+                with metrics.time_stage("execution"):
+                    db_result = await self.sql_executor.run({"query": sql_query})
                 if "error" in db_result:
                     answer = f"SQL Execution Error: {db_result['error']}"
                     self.memory.add_message(user_id, role="assistant", content=answer)
@@ -484,10 +491,11 @@ class MCPAgent:
                 #convert to natural language
                 final_result = db_result
                 if self.result_converter:
-                    final_result = await self.result_converter.run({
-                        "query": sql_query,
-                        "result": db_result
-                    })
+                    with metrics.time_stage("nl_render"):
+                        final_result = await self.result_converter.run({
+                            "query": sql_query,
+                            "result": db_result
+                        })
                 answer=str(final_result)
                 
                 if 'extracted' in locals() and extracted:
@@ -536,6 +544,8 @@ class MCPAgent:
                 )
                 
                 
+        except deadline.DeadlineExceeded:
+            raise
         except Exception as e:
             logger.exception("MCPAgent main try/except caught")
             if self.fallback_tool:
@@ -553,12 +563,14 @@ class MCPAgent:
             history = []
 
         prompt_messages = generate_prompt(history)
-        completion = await self.client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=prompt_messages,
-            temperature=0.7,
-            stream=False
-        )
+        with metrics.time_stage("llm_chat"):
+            completion = await llm.chat(
+                "chat",
+                model="gpt-3.5-turbo",
+                messages=prompt_messages,
+                temperature=0.7,
+                stream=False
+            )
         answer = completion.choices[0].message.content.strip()
         # try:
         #     maybe = self.memory.add_message(user_id, role="assistant", content=answer)
@@ -648,8 +660,15 @@ class MCPAgent:
         """
         Core handler for MCP stdio transport.
         Interprets JSON-RPC messages from Claude or MCP CLI.
-        Returns the inner data only (no 'id' or 'result' keys) for main_stdio.py to wrap
+        Returns the inner data only (no 'id' or 'result' keys) for main_stdio.py to wrap.
+        Continues the caller's trace when params._meta carries a traceparent.
         """
+        params = request.get("params")
+        meta = params.get("_meta") if isinstance(params, dict) else None
+        with tracing.span(f"jsonrpc {request.get('method')}", kind="server", meta=meta):
+            return await self._dispatch_request(request)
+
+    async def _dispatch_request(self, request: dict) -> dict:
         method = request.get("method")
         # req_id = request.get("id")
         try:
@@ -809,49 +828,11 @@ class MCPAgent:
             logger.exception("Failed to clear user memory")
 
 async def stdio_loop(agent: MCPAgent):
-    """Continuously read JSON-RPC requests from stdin and respond on stdout."""
-    import sys
-    while True:
-        try:
-            line = await asyncio.to_thread(sys.stdin.readline)
-            if line == "":  
-                logger.info("Stdio EOF received, exiting loop")
-                break
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                request = json.loads(line)
-            except Exception:
-                logger.exception("Failed to parse JSON from stdin")
-                response_envelope = {
-                        "jsonrpc": "2.0",
-                        "id": None,
-                        "error": {"code": -32700, "message": "Parse error"}
-                    }
-                sys.stdout.write(json.dumps(response_envelope, separators=(",", ":")) + "\n")
-                sys.stdout.flush()
-                continue
-            try:
-                result = await agent.handle_request(request)
-                response_envelope = {
-                    "jsonrpc": "2.0",
-                    "id": request.get("id"),
-                    "result": result
-                }
-            except Exception as e:
-                logger.exception("Failed to handle request")
-                response_envelope = {
-                    "jsonrpc": "2.0",
-                    "id": request.get("id"),
-                    "error": {"code": -32000, "message": str(e)}
-                }
-
-            sys.stdout.write(json.dumps(response_envelope, separators=(",", ":")) + "\n")
-            sys.stdout.flush()
-
-        except Exception:
-            logger.exception("Fatal stdio loop error")
+    """
+    Continuously read JSON-RPC requests from stdin and respond on stdout until EOF.
+    Shares its transport with main_stdio.py (see sdk.stdio_transport.serve_stdio).
+    """
+    await serve_stdio(agent.handle_request)
             
 if __name__ == "__main__":
     import asyncio
@@ -1,4 +1,4 @@
-from typing import List, Dict, Union
+from typing import Any, Dict, Iterable, List, Optional, Union
 
 SYSTEM_PROMPT = """
 You are an intelligent assistant working within a modular AI system called MCP (Model Context Protocol).
@@ -71,20 +71,84 @@ Additional Best Practices:
 """
 
 
+SQL_SYSTEM_PROMPT = """
+You are an expert SQL generator for PostgreSQL.
+Use only this table:
+
+Table: user_vendor_info
+Columns:
+- user_id (int)
+- user_name (text)
+- email (text)
+- vendor_id (text)
+- vendor_name (text)
+- vendor_status (text)
+- last_updated (date)
+
+- Important Rules:
+1. Only use the columns explicity mentioned in the user's request.
+2. If a column value is not provided by the user, set it to NULL (or leave unchanged for UPDATE).
+3. Never invent or predict values such as email, vendor_id or user_id.
+4. For INSERT: only include columns the user actually specified.
+5. For UPDATE: only update columns the user explicity mentioned.
+6. If the user refers to pronouns ('it', 'its', 'them', 'they'), assume they mean the last mentioned entity given in the "Conversation context" message.
+Do not ask for more context. Use the last mentioned entity from that message if needed; it is 'unknown' when there is none.
+7. Always include a WHERE clause when updating/deleting, using ILIKE for case-insensitive matching.
+8. Always generate syntactically correct PostgreSQL.
+Always use case-insensitive matching for text comparisons using ILIKE.
+Generate valid PostgreSQL queries using this schema only.
+9. You can generate SELECT, INSERT, UPDATE, or DELETE statements as needed.
+10. When the user uses pronouns like it, his, her, their, its, resolve them using the most recent result from memory (not just the text of the last query). Always prefer specific attributes like email, user_id, or vendor_id for SQL filtering.
+"""
+
+
+def _as_message(msg: Any) -> Optional[Dict[str, str]]:
+    if isinstance(msg, dict) and "role" in msg and "content" in msg:
+        return {"role": msg["role"], "content": msg["content"]}
+    if hasattr(msg, "role") and hasattr(msg, "content"):
+        return {"role": msg.role, "content": msg.content}
+    return None
+
+
+def assemble_prompt(
+    system: str,
+    history: Iterable[Any] = (),
+    context: Optional[str] = None,
+    user_input: Optional[str] = None,
+) -> List[Dict[str, str]]:
+    """
+    Lays out a chat prompt so the provider's prompt cache can reuse its prefix.
+
+    Providers cache the longest prompt prefix they have already seen, so the
+    order is static to variable: [system prompt, conversation history,
+    per-turn context, user message]. `system` must not contain anything that
+    changes between turns (entities, memory, timestamps); put that in
+    `context`, which is sent as a system message just before the user's.
+    """
+    prompt = [{"role": "system", "content": system.strip()}]
+    for msg in history:
+        converted = _as_message(msg)
+        if converted is not None:
+            prompt.append(converted)
+    if context:
+        prompt.append({"role": "system", "content": context})
+    if user_input is not None:
+        prompt.append({"role": "user", "content": user_input})
+    return prompt
+
+
+def entity_context(last_entity: Optional[Dict[str, Any]]) -> str:
+    """Per-turn context message naming the last mentioned entity (see rule 6 of SQL_SYSTEM_PROMPT)."""
+    if last_entity and last_entity.get("value"):
+        kind = last_entity.get("type") or "entity"
+        return f"Conversation context:\nLast mentioned entity: {kind} = {last_entity['value']}"
+    return "Conversation context:\nLast mentioned entity: unknown"
+
+
 def generate_prompt(chat_history:List[Union[Dict[str,str]]])->List[Dict[str,str]]:
     """
     Converts chat history into an OpenAI-compatible prompt list.
     Adds a system prompt at the beginning.
     Supports both dict-style and object-style messages.
-    Optionally injects context (e.g., last known memory).
     """
-    
-    prompt=[{"role":"system","content":SYSTEM_PROMPT.strip()}]
-    
-    for msg in chat_history:
-        if isinstance(msg,dict) and "role" in msg and "content" in msg:
-            prompt.append({"role":msg["role"],"content":msg["content"]})
-        elif hasattr(msg,"role") and hasattr(msg,"content"):
-            prompt.append({"role":msg.role,"content":msg.content})
-            
-    return prompt
\ No newline at end of file
+    return assemble_prompt(SYSTEM_PROMPT, chat_history)
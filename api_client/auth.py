@@ -1,84 +1,301 @@
-import httpx
+import asyncio
+import hashlib
+import hmac
 import logging
+import os
+import secrets
 import time
 from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
 from fastapi import HTTPException
 
+from services import tracing
+from . import client
+from .singleflight import SingleFlight
+
 logger = logging.getLogger(__name__)
 
-API_BASE_URL = "https://lincoln-api.vartopia.com"
+T = TypeVar("T")
 
-_token_cache = {}  
+# refresh this many seconds before ATExpirationTime
+REFRESH_MARGIN = float(os.getenv("VARTOPIA_TOKEN_REFRESH_MARGIN", "120"))
+# tokens without ATExpirationTime are treated as valid for this long
+DEFAULT_TOKEN_LIFETIME = 3600
+TOKEN_REDIS_PREFIX = os.getenv("REDIS_KEY_PREFIX", "vartopia:") + "token:"
+TOKEN_REDIS_ENABLED = os.getenv("VARTOPIA_TOKEN_REDIS", "true").lower() not in ("0", "false", "no")
+# keys the Redis token-cache names and credential checks; without it tokens are not shared via Redis
+TOKEN_CACHE_SECRET = os.getenv("VARTOPIA_TOKEN_CACHE_SECRET", "")
+# cached tokens (bearer and refresh) are live credentials: keep them in Redis at most this long
+TOKEN_REDIS_TTL = int(os.getenv("VARTOPIA_TOKEN_REDIS_TTL", "900"))
 
-async def get_token(username: str, password: str) -> str:
-    """
-    Obtain a valid JWT access token for the given user.
-    
-    - Uses username/password login.
-    - Caches token in memory until expiry.
-    - Automatically refreshes token if expired.
-    """
-    now = time.time()
-    
-    cache = _token_cache.get(username, {})
-    if cache.get("access_token") and now < cache.get("expires_at", 0):
-        return cache["access_token"]
 
-    logger.info(f"Fetching Vartopia API token for user: {username}")
+def _extract_tokens(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Find the Tokens block in a login/refresh response (shape differs between endpoints)."""
+    if not isinstance(data, dict):
+        return {}
+    return (
+        data.get("Tokens")
+        or (data.get("Data") or {}).get("Tokens")
+        or (data.get("data") or {}).get("Tokens")
+        or {}
+    )
 
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(
-                f"{API_BASE_URL}/api/Account/Login",
-                headers={"Content-Type": "application/json", "Accept": "application/json"},
-                json={"username": username, "password": password},
-            )
 
-        if response.status_code != 200:
-            logger.error(f"Auth failed: {response.status_code} {response.text}")
-            raise HTTPException(
-                status_code=response.status_code,
-                detail={
-                    "code": "E_AUTH_UNAUTHORIZED",
-                    "message": "Failed to authenticate with Vartopia API",
-                    "details": response.json() if response.text else {},
-                },
-            )
+def _extract_email(data: Dict[str, Any]) -> Optional[str]:
+    if not isinstance(data, dict):
+        return None
+    return data.get("Email") or (data.get("Data") or {}).get("Email")
 
-        data = response.json()
-        logger.debug(f"Login response JSON: {data}")
 
-        tokens = data.get("Tokens") or data.get("data", {}).get("Tokens", {})
-        access_token = tokens.get("AccessToken")
-        refresh_token = tokens.get("RefreshToken")
-        exp_time_str = tokens.get("ATExpirationTime")
+def _parse_expiry(value: Optional[str], now: float) -> float:
+    if value:
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except Exception:
+            logger.warning("Failed to parse ATExpirationTime, using 1h fallback.")
+    return now + DEFAULT_TOKEN_LIFETIME
 
+
+class TokenSet:
+    """Access/refresh token pair for one set of credentials."""
+
+    def __init__(self, access_token: str, refresh_token: Optional[str], expires_at: float,
+                 user_email: Optional[str] = None, credential: Optional[str] = None):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.user_email = user_email
+        # HMAC of the password the tokens were issued for (see TokenManager._credential)
+        self.credential = credential
+
+    def remaining(self, now: Optional[float] = None) -> float:
+        return self.expires_at - (now if now is not None else time.time())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "access_token": self.access_token,
+            "refresh_token": self.refresh_token,
+            "expires_at": self.expires_at,
+            "user_email": self.user_email,
+            "credential": self.credential,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TokenSet":
+        return cls(data["access_token"], data.get("refresh_token"), float(data["expires_at"]),
+                   data.get("user_email"), data.get("credential"))
+
+    @classmethod
+    def from_response(cls, data: Dict[str, Any], previous: Optional["TokenSet"] = None) -> "TokenSet":
+        tokens = _extract_tokens(data)
+        access_token = tokens.get("AccessToken")
         if not access_token:
             raise HTTPException(
                 status_code=500,
                 detail={
                     "code": "E_AUTH_TOKEN_MISSING",
-                    "message": "No AccessToken returned in Vartopia login response",
+                    "message": "No AccessToken returned in Vartopia response",
                     "details": data,
                 },
             )
-        expires_at = now + 3600 
-        if exp_time_str:
+        return cls(
+            access_token=access_token,
+            refresh_token=tokens.get("RefreshToken") or (previous.refresh_token if previous else None),
+            expires_at=_parse_expiry(tokens.get("ATExpirationTime"), time.time()),
+            user_email=_extract_email(data) or (previous.user_email if previous else None),
+        )
+
+
+class TokenManager:
+    """
+    Per-credential Vartopia token cache shared by every caller in the process.
+
+    - Concurrent requests for the same credentials share one login/refresh (single-flight).
+    - Tokens inside REFRESH_MARGIN of ATExpirationTime are refreshed in the background
+      with the stored RefreshToken while the still-valid token keeps being served;
+      expired tokens are refreshed inline. A failed refresh falls back to a full login.
+    - Tokens are mirrored to Redis so the backend, sql_tool and API layer reuse
+      each other's logins. Cached tokens are live credentials, so this needs
+      VARTOPIA_TOKEN_CACHE_SECRET: keys are HMAC(secret, username) and entries
+      carry HMAC(secret, username, password) to check the caller's password,
+      so nothing in Redis allows offline password guessing. Entries expire
+      after VARTOPIA_TOKEN_REDIS_TTL (default 15 min) or at token expiry.
+      Treat that Redis as sensitive all the same.
+    - call_with_token() drops a token the API rejects with 401 (revoked or
+      rotated before its expiry), logs in again and retries the call once.
+    """
+
+    def __init__(self, refresh_margin: float = REFRESH_MARGIN, use_redis: bool = TOKEN_REDIS_ENABLED,
+                 secret: str = TOKEN_CACHE_SECRET, redis_ttl: int = TOKEN_REDIS_TTL):
+        self.refresh_margin = refresh_margin
+        if use_redis and not secret:
+            logger.warning("VARTOPIA_TOKEN_CACHE_SECRET is not set; Vartopia tokens are cached in-process only")
+        self.use_redis = use_redis and bool(secret)
+        self.redis_ttl = redis_ttl
+        # a random secret still keeps in-process keys unguessable when none is configured
+        self._secret = secret.encode("utf-8") if secret else secrets.token_bytes(32)
+        self._tokens: Dict[str, TokenSet] = {}
+        self._flights = SingleFlight()
+        self._background: set = set()
+
+    def _key(self, username: str) -> str:
+        return hmac.new(self._secret, username.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def _credential(self, username: str, password: str) -> str:
+        return hmac.new(self._secret, f"{username}\0{password}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def _matches(tokens: Optional[TokenSet], credential: str) -> bool:
+        return tokens is not None and hmac.compare_digest(tokens.credential or "", credential)
+
+    async def _redis(self):
+        if not self.use_redis:
+            return None
+        try:
+            from services.feedback_memory import init_redis_pool
+            return await init_redis_pool()
+        except Exception:
+            logger.warning("Redis unavailable for token cache; using in-process cache only")
+            return None
+
+    async def _load_shared(self, key: str, credential: str) -> Optional[TokenSet]:
+        r = await self._redis()
+        if r is None:
+            return None
+        try:
+            data = await r.hgetall(TOKEN_REDIS_PREFIX + key)
+            tokens = TokenSet.from_dict(data) if data else None
+        except Exception:
+            logger.warning("Failed reading cached Vartopia token from Redis")
+            return None
+        return tokens if self._matches(tokens, credential) else None
+
+    async def _store(self, key: str, tokens: TokenSet) -> None:
+        self._tokens[key] = tokens
+        r = await self._redis()
+        if r is None:
+            return
+        try:
+            redis_key = TOKEN_REDIS_PREFIX + key
+            mapping = {k: v for k, v in tokens.to_dict().items() if v is not None}
+            async with r.pipeline(transaction=True) as pipe:
+                pipe.delete(redis_key)
+                pipe.hset(redis_key, mapping=mapping)
+                pipe.expireat(redis_key, int(min(tokens.expires_at, time.time() + self.redis_ttl)))
+                await pipe.execute()
+        except Exception:
+            logger.warning("Failed writing Vartopia token to Redis")
+
+    async def get_tokens(self, username: str, password: str) -> TokenSet:
+        """Return a valid token set for the credentials, logging in or refreshing as needed."""
+        if not username or not password:
+            raise ValueError("Username and password are required.")
+        key, credential = self._key(username), self._credential(username, password)
+        tokens = self._tokens.get(key)
+        if self._matches(tokens, credential):
+            remaining = tokens.remaining()
+            if remaining > self.refresh_margin:
+                return tokens
+            if remaining > 0:
+                self._refresh_in_background(key, credential, username, password)
+                return tokens
+        # flights are per credential so a wrong password never shares another caller's login
+        return await self._flights.do(credential, lambda: self._acquire(key, username, password))
+
+    async def get_token(self, username: str, password: str) -> str:
+        return (await self.get_tokens(username, password)).access_token
+
+    async def invalidate(self, username: str, password: str, access_token: Optional[str] = None) -> None:
+        """
+        Drop cached tokens, e.g. after the API rejected them with 401. With
+        `access_token`, only that token is dropped, so a fresh one obtained by a
+        concurrent caller survives.
+        """
+        key, credential = self._key(username), self._credential(username, password)
+        cached = self._tokens.get(key)
+        if self._matches(cached, credential) and (access_token is None or cached.access_token == access_token):
+            self._tokens.pop(key, None)
+        r = await self._redis()
+        if r is not None:
             try:
-                exp_dt = datetime.fromisoformat(exp_time_str.replace("Z", "+00:00"))
-                expires_at = exp_dt.timestamp()
+                redis_key = TOKEN_REDIS_PREFIX + key
+                access, stored = await r.hmget(redis_key, "access_token", "credential")
+                if hmac.compare_digest(stored or "", credential) and access_token in (None, access):
+                    await r.delete(redis_key)
             except Exception:
-                logger.warning("Failed to parse ATExpirationTime, using 1h fallback.")
+                logger.warning("Failed deleting Vartopia token from Redis")
 
-        _token_cache[username] = {
-            "access_token": access_token,
-            "refresh_token": refresh_token,
-            "expires_at": expires_at - 30, 
-        }
+    async def call_with_token(self, username: str, password: str, call: Callable[[str], Awaitable[T]]) -> T:
+        """Await call(access_token); on 401 drop that token, log in again and retry once."""
+        token = await self.get_token(username, password)
+        try:
+            return await call(token)
+        except HTTPException as e:
+            if e.status_code != 401:
+                raise
+        logger.warning("Vartopia rejected the cached token for %s (401); logging in again", username)
+        await self.invalidate(username, password, token)
+        return await call(await self.get_token(username, password))
+
+    def _refresh_in_background(self, key: str, credential: str, username: str, password: str) -> None:
+        if self._flights.in_flight(credential):
+            return
+        task = asyncio.ensure_future(self._flights.do(credential, lambda: self._acquire(key, username, password)))
+        self._background.add(task)
+        task.add_done_callback(self._background_done)
+
+    def _background_done(self, task: asyncio.Future) -> None:
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Background Vartopia token refresh failed: %s", task.exception())
 
-        logger.info(f"Vartopia API token acquired successfully for user: {username}")
-        return access_token
+    async def _acquire(self, key: str, username: str, password: str) -> TokenSet:
+        credential = self._credential(username, password)
+        # another backend may already have logged in or refreshed
+        shared = await self._load_shared(key, credential)
+        if shared is not None and shared.remaining() > self.refresh_margin:
+            self._tokens[key] = shared
+            return shared
 
+        current = self._tokens.get(key)
+        current = current if self._matches(current, credential) else shared
+        if current is not None and current.refresh_token:
+            try:
+                tokens = TokenSet.from_response(
+                    await client.refresh_token(current.access_token, current.refresh_token), current
+                )
+                tokens.credential = credential
+                await self._store(key, tokens)
+                logger.info("Vartopia API token refreshed for user: %s", username)
+                return tokens
+            except Exception as e:
+                logger.warning("Vartopia token refresh failed for %s (%s); logging in again", username, e)
+
+        logger.info("Fetching Vartopia API token for user: %s", username)
+        tokens = TokenSet.from_response(await client.login(username, password))
+        tokens.credential = credential
+        await self._store(key, tokens)
+        logger.info("Vartopia API token acquired successfully for user: %s", username)
+        return tokens
+
+
+token_manager = TokenManager()
+
+
+async def get_token(username: str, password: str) -> str:
+    """
+    Obtain a valid JWT access token for the given user.
+
+    - Uses username/password login, deduplicated across concurrent callers.
+    - Caches tokens in memory and Redis until expiry.
+    - Refreshes with the RefreshToken shortly before ATExpirationTime.
+    """
+    try:
+        with tracing.span("vartopia.get_token", username=username):
+            return await token_manager.get_token(username, password)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("Error while getting Vartopia token")
         raise HTTPException(
@@ -88,4 +305,4 @@ async def get_token(username: str, password: str) -> str:
                 "message": str(e),
                 "details": {},
             },
-        )
\ No newline at end of file
+        )
@@ -0,0 +1,212 @@
+"""
+Bulk deal upsert for /api/DealReg/Upsert.
+
+Deals come from a list or a JSONL file (streamed; one deal per line), are
+grouped into chunks of the API batch size, and the chunks are submitted
+concurrently (bounded) through client.submit_deal, so retries, the circuit
+breaker and the global concurrency cap still apply. Each deal's outcome is
+reported under its uniqueID (or "#<index>" when a deal has none); when a
+uniqueID appears more than once the last outcome is kept under it, but the
+totals count every deal and "duplicates" says how many were collapsed.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from services import tracing
+from . import client
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.getenv("VARTOPIA_UPSERT_BATCH_SIZE", "100"))
+CONCURRENCY = int(os.getenv("VARTOPIA_UPSERT_CONCURRENCY", "4"))
+
+_UNIQUE_ID_KEYS = ("uniqueID", "UniqueID", "uniqueId", "unique_id")
+
+
+def unique_id_of(item: Any) -> Optional[str]:
+    if isinstance(item, dict):
+        for key in _UNIQUE_ID_KEYS:
+            if item.get(key):
+                return str(item[key])
+    return None
+
+
+def iter_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    """Stream deals from a JSONL file; blank lines are skipped."""
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                deal = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid JSON on line {line_no} of {path}: {e}")
+            if not isinstance(deal, dict):
+                raise HTTPException(status_code=400,
+                                    detail=f"Line {line_no} of {path} is not a deal object: {type(deal).__name__}")
+            yield deal
+
+
+def _chunks(deals: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Tuple[int, Dict[str, Any]]]]:
+    numbered = enumerate(deals)
+    while True:
+        chunk = list(itertools.islice(numbered, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _response_items(response: Any) -> Optional[List[Any]]:
+    """Per-deal entries in an Upsert response, when the API returns them."""
+    if isinstance(response, list):
+        return response
+    if isinstance(response, dict):
+        for key in ("Data", "data", "Results", "results"):
+            if isinstance(response.get(key), list):
+                return response[key]
+    return None
+
+
+def _response_errors(response: Any) -> Dict[str, Any]:
+    """Errors keyed by uniqueID, for responses that report them that way."""
+    errors: Dict[str, Any] = {}
+    if isinstance(response, dict):
+        for error in response.get("errors") or response.get("Errors") or []:
+            uid = unique_id_of(error)
+            if uid:
+                errors.setdefault(uid, []).append(error)
+    return errors
+
+
+Outcomes = List[Tuple[str, Dict[str, Any]]]
+
+
+def _map_results(chunk: List[Tuple[int, Dict[str, Any]]], response: Any) -> Outcomes:
+    items = _response_items(response)
+    errors = _response_errors(response)
+    chunk_ok = not (isinstance(response, dict) and response.get("success") is False and not errors)
+
+    by_uid: Dict[str, Any] = {}
+    if items is not None:
+        for item in items:
+            uid = unique_id_of(item)
+            if uid:
+                by_uid[uid] = item
+
+    outcomes: Outcomes = []
+    for position, (index, deal) in enumerate(chunk):
+        uid = unique_id_of(deal) or f"#{index}"
+        item = by_uid.get(uid)
+        if item is None and items is not None and len(items) == len(chunk):
+            item = items[position]
+        if uid in errors:
+            outcomes.append((uid, {"success": False, "errors": errors[uid]}))
+        elif isinstance(item, dict) and item.get("success") is False:
+            outcomes.append((uid, {"success": False, "errors": item.get("errors") or [item]}))
+        else:
+            outcomes.append((uid, {"success": chunk_ok, "response": item}))
+    return outcomes
+
+
+def _failed(chunk: List[Tuple[int, Dict[str, Any]]], error: Any) -> Outcomes:
+    return [(unique_id_of(deal) or f"#{index}", {"success": False, "errors": [error]}) for index, deal in chunk]
+
+
+async def bulk_upsert(
+    with_token: Callable[[Callable[[str], Awaitable[Any]]], Awaitable[Any]],
+    user_email: str,
+    deals: Iterable[Dict[str, Any]],
+    batch_size: int = BATCH_SIZE,
+    concurrency: int = CONCURRENCY,
+    prepare: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """
+    Upsert `deals` in chunks of `batch_size`, at most `concurrency` chunks in flight.
+
+    Each chunk is submitted through `with_token(call)`, which runs call(access_token)
+    with a current token (see auth.TokenManager.call_with_token), so long runs pick
+    up refreshed tokens and a rejected token is replaced once.
+    `prepare` (optional) normalises each deal before submission. Iteration of
+    `deals` happens off the event loop, so a JSONL generator does not block it.
+
+    If reading `deals` fails (HTTPException, e.g. a bad JSONL line) before any
+    chunk was submitted, the error is raised. Otherwise the chunks already
+    submitted are finished and reported, with the error under "input_error".
+    """
+    batch_size = max(1, int(batch_size))
+    concurrency = max(1, int(concurrency))
+    results: Dict[str, Dict[str, Any]] = {}
+    counts = {"failed": 0, "duplicates": 0}
+    input_error: Optional[HTTPException] = None
+    chunks = _chunks((prepare(d) if prepare else d for d in deals), batch_size)
+    pending: set = set()
+    submitted = 0
+
+    def collect(outcomes: Outcomes) -> None:
+        for uid, outcome in outcomes:
+            counts["duplicates"] += uid in results
+            counts["failed"] += not outcome["success"]
+            results[uid] = outcome
+
+    async def submit(chunk: List[Tuple[int, Dict[str, Any]]]) -> Outcomes:
+        try:
+            response = await with_token(lambda access_token: client.submit_deal(
+                access_token=access_token,
+                user_email=user_email,
+                deal_data=[deal for _, deal in chunk],
+            ))
+        except HTTPException as e:
+            logger.warning("Bulk upsert chunk of %d deals failed: %s", len(chunk), e.detail)
+            return _failed(chunk, {"status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            logger.exception("Bulk upsert chunk of %d deals failed", len(chunk))
+            return _failed(chunk, {"status": 500, "detail": str(e)})
+        return _map_results(chunk, response)
+
+    with tracing.span("vartopia.bulk_upsert", batch_size=batch_size, concurrency=concurrency) as span:
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.to_thread(next, chunks, None)
+                except HTTPException as e:
+                    if not submitted:
+                        raise
+                    logger.warning("Bulk upsert input failed after %d deals: %s", submitted, e.detail)
+                    input_error = e
+                    break
+                if chunk is None:
+                    break
+                submitted += len(chunk)
+                pending.add(asyncio.create_task(submit(chunk)))
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        collect(task.result())
+        finally:
+            # never leave submitted chunks running unobserved
+            for task in asyncio.as_completed(pending):
+                collect(await task)
+
+        failed = counts["failed"]
+        span.set_attribute("deals", submitted)
+        span.set_attribute("failed", failed)
+
+    logger.info("Bulk upsert finished: %d deals, %d failed", submitted, failed)
+    report: Dict[str, Any] = {
+        "total": submitted,
+        "succeeded": submitted - failed,
+        "failed": failed,
+        "duplicates": counts["duplicates"],
+        "results": results,
+    }
+    if input_error is not None:
+        report["input_error"] = {"status": input_error.status_code, "detail": input_error.detail}
+    return report
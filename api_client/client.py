@@ -1,15 +1,49 @@
-import httpx
+import os
 import uuid
 import json
 import logging
+
+import httpx
 from fastapi import HTTPException
 
 # from .auth import get_token
-from .errors import map_error
+from .errors import map_error, upstream_error
+from . import http, resilience
+from services import tracing
 
 logger = logging.getLogger(__name__)
 
-API_BASE_URL = "https://lincoln-api.vartopia.com"
+# point at benchmarks/vartopia_mock.py (e.g. http://localhost:8200) for offline runs
+API_BASE_URL = os.getenv("VARTOPIA_API_BASE_URL", "https://lincoln-api.vartopia.com").rstrip("/")
+REFRESH_TOKEN_PATH = os.getenv("VARTOPIA_REFRESH_PATH", "/api/Account/RefreshToken")
+
+
+async def _send(method: str, endpoint: str, correlation_id: str, headers: dict,
+                idempotent: bool = None, **kwargs) -> httpx.Response:
+    """
+    Perform one Vartopia call through the shared client and the resilience layer
+    (retries, circuit breaker, concurrency cap). Failures without a usable
+    response are raised as MCP-standard HTTPExceptions (502/503/504).
+    """
+    kwargs.setdefault("timeout", http.timeout_for(endpoint))
+    url = f"{API_BASE_URL}{endpoint}"
+
+    with tracing.span(f"vartopia {method} {endpoint}", kind="client", correlation_id=correlation_id) as span:
+        client = await http.get_client()
+
+        async def call() -> httpx.Response:
+            return await client.request(method, url, headers=tracing.inject_headers(headers), **kwargs)
+
+        try:
+            response = await resilience.send(method, endpoint, call, idempotent=idempotent)
+        except resilience.CircuitOpenError as e:
+            raise upstream_error(503, "E_UPSTREAM_UNAVAILABLE", str(e), correlation_id)
+        except httpx.TimeoutException as e:
+            raise upstream_error(504, "E_UPSTREAM_TIMEOUT", f"Vartopia API timed out: {e!r}", correlation_id)
+        except httpx.TransportError as e:
+            raise upstream_error(502, "E_UPSTREAM_UNAVAILABLE", f"Vartopia API unreachable: {e!r}", correlation_id)
+        span.set_attribute("http.status_code", response.status_code)
+    return response
 
 
 async def _request(
@@ -17,6 +51,7 @@ async def _request(
     endpoint: str,
     token: str,
     correlation_id: str,
+    idempotent: bool = None,
     **kwargs
 ) -> dict:
     """
@@ -27,6 +62,7 @@ async def _request(
         endpoinjt (str): API endpoint path starting with "/".
         token (str, optional): Bearer token for Authorization header.
         correlation_id (str, optional): Unique identifier for logging/tracing.
+        idempotent (bool, optional): Allow retries on 5xx/timeouts (defaults to True for GET).
         **kwargs: Additional arguments passed to httpx request (json, params, etc.)
         
     Returns:
@@ -62,7 +98,7 @@ async def _request(
     #         detail={"code": "E_INTERNAL", "message": str(e), "correlationId": correlation_id},
     #     )
     if not correlation_id:
-        correlation_id=str(uuid.uuid4())
+        correlation_id=tracing.current_correlation_id() or str(uuid.uuid4())
     
     headers={
         "Authorization": f"Bearer {token}",
@@ -74,14 +110,15 @@ async def _request(
     #     headers["Authorization"]=f"Bearer {token}"
         
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.request(method, f"{API_BASE_URL}{endpoint}", headers=headers, **kwargs)
+        response = await _send(method, endpoint, correlation_id, headers, idempotent=idempotent, **kwargs)
             
         if response.status_code>=400:
             logger.error(f"[{correlation_id}] API Error {response.status_code}:{response.text}")
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+            raise map_error(response, correlation_id)
         return response.json()
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"[{correlation_id}] API request failed:{method}{endpoint}")
         raise HTTPException (status_code=500, detail=f"Internal error:{str(e)}")
@@ -119,7 +156,7 @@ async def login(username: str, password: str) -> dict:
     if not username or not password:
         raise ValueError("Username and password are required.")
     
-    correlation_id = str(uuid.uuid4())
+    correlation_id = tracing.current_correlation_id() or str(uuid.uuid4())
     payload = {"Username": username, "Password": password}
     headers = {
         "X-Correlation-Id": correlation_id,
@@ -129,16 +166,15 @@ async def login(username: str, password: str) -> dict:
     }
 
     try:
-        async with httpx.AsyncClient(timeout=20.0) as client:
-            res = await client.post(
-                f"{API_BASE_URL}/api/Account/Login", json=payload, headers=headers
-            )
+        res = await _send("POST", "/api/Account/Login", correlation_id, headers, json=payload)
 
         if res.status_code != 200:
             raise map_error(res, correlation_id)
 
         return res.json()
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"[{correlation_id}] Login request failed.")
         raise HTTPException(
@@ -147,6 +183,40 @@ async def login(username: str, password: str) -> dict:
         )
 
 
+async def refresh_token(access_token: str, refresh_token: str) -> dict:
+    """
+    Exchange a refresh token for a new token pair.
+    
+    Args:
+        access_token(str): The current (possibly expired) access token.
+        refresh_token(str): RefreshToken returned by login or a previous refresh.
+        
+    Returns:
+        dict: Refresh response including Tokens.
+        
+    Raises:
+        ValueError: If refresh_token is missing.
+        HTTPException: If the API rejects the refresh token.
+    """
+    if not refresh_token:
+        raise ValueError("refresh_token is required.")
+
+    correlation_id = tracing.current_correlation_id() or str(uuid.uuid4())
+    payload = {"AccessToken": access_token, "RefreshToken": refresh_token}
+    headers = {
+        "X-Correlation-Id": correlation_id,
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "Partner": "Vartopia",
+    }
+
+    res = await _send("POST", REFRESH_TOKEN_PATH, correlation_id, headers, json=payload)
+
+    if res.status_code != 200:
+        raise map_error(res, correlation_id)
+    return res.json()
+
+
 # async def get_vendors(access_token:str, user_email: str) -> dict:
 #     """
 #     List vendors for the user.
@@ -219,15 +289,17 @@ async def submit_deal(access_token: str, user_email: str, deal_data: dict) -> di
     if not access_token or not user_email or not deal_data:
         raise ValueError("access_token, user_email, and deal_data are required")
     
-    correlation_id = str(uuid.uuid4())
+    correlation_id = tracing.current_correlation_id() or str(uuid.uuid4())
     # payload = {"deals": deal_data}  
     payload=deal_data if isinstance(deal_data, list) else [deal_data]
 
+    # upserts are keyed by uniqueID, so replaying one after a 5xx/timeout is safe
     return await _request(
         "POST",
         "/api/DealReg/Upsert",
         access_token,
         correlation_id,
+        idempotent=True,
         json=payload
     )
 
@@ -261,7 +333,7 @@ async def get_registration_updates(
     if not access_token:
         raise ValueError("access_token is required")
     
-    correlation_id=str(uuid.uuid4())
+    correlation_id=tracing.current_correlation_id() or str(uuid.uuid4())
     
     params={
         "uniqueID": unique_id,
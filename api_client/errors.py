@@ -6,6 +6,9 @@ ERROR_MAP = {
     404: "E_NOT_FOUND",
     422: "E_VALIDATION_SCHEMA",
     429: "E_RATE_LIMIT",
+    502: "E_UPSTREAM_UNAVAILABLE",
+    503: "E_UPSTREAM_UNAVAILABLE",
+    504: "E_UPSTREAM_TIMEOUT",
 }
 
 
@@ -50,4 +53,23 @@ def map_error(response, correlation_id: str) -> HTTPException:
     if error_code == "E_INTERNAL":
         status = 500
 
-    return HTTPException(status_code=status, detail=detail)
+    headers = None
+    retry_after = getattr(response, "headers", {}).get("Retry-After") if status in (429, 503) else None
+    if retry_after:
+        detail["retryAfter"] = retry_after
+        headers = {"Retry-After": retry_after}
+
+    return HTTPException(status_code=status, detail=detail, headers=headers)
+
+
+def upstream_error(status: int, code: str, message: str, correlation_id: str) -> HTTPException:
+    """MCP-standard error for failures with no Vartopia response (timeouts, open circuit, network)."""
+    return HTTPException(
+        status_code=status,
+        detail={
+            "code": code,
+            "message": message,
+            "correlationId": correlation_id,
+            "details": {},
+        },
+    )
@@ -0,0 +1,96 @@
+"""
+Shared, pooled httpx client for outbound Vartopia API calls.
+
+One AsyncClient is reused across requests so TCP/TLS connections to the API
+host are kept alive instead of being re-established per call. HTTP/2 is used
+when the `h2` package is installed (httpx[http2]), which multiplexes
+concurrent deal submissions and update polls over a single connection.
+
+Lifecycle:
+    - FastAPI apps call open_client() on startup and close_client() on shutdown.
+    - get_client() lazily opens the client for callers without a lifespan
+      (stdio server, scripts).
+
+Tuning (env):
+    VARTOPIA_HTTP_MAX_CONNECTIONS      total pooled connections (default 100)
+    VARTOPIA_HTTP_MAX_KEEPALIVE        idle keep-alive connections (default VARTOPIA_MAX_CONCURRENCY, 32)
+    VARTOPIA_HTTP_KEEPALIVE_EXPIRY     seconds an idle connection is kept (default 30)
+    VARTOPIA_HTTP2                     auto | true | false (default auto)
+"""
+
+import logging
+import os
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+MAX_CONNECTIONS = int(os.getenv("VARTOPIA_HTTP_MAX_CONNECTIONS", "100"))
+# keep at least as many idle connections as calls allowed in flight (resilience.MAX_CONCURRENCY),
+# otherwise bursts close and re-open connections
+MAX_KEEPALIVE = int(os.getenv("VARTOPIA_HTTP_MAX_KEEPALIVE", os.getenv("VARTOPIA_MAX_CONCURRENCY", "32")))
+KEEPALIVE_EXPIRY = float(os.getenv("VARTOPIA_HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_SETTING = os.getenv("VARTOPIA_HTTP2", "auto").lower()
+
+CONNECT_TIMEOUT = 5.0
+DEFAULT_TIMEOUT = httpx.Timeout(60.0, connect=CONNECT_TIMEOUT)
+
+# read/write timeouts per API path; connects always fail fast
+ENDPOINT_TIMEOUTS = {
+    "/api/Account/Login": httpx.Timeout(20.0, connect=CONNECT_TIMEOUT),
+    "/api/Account/RefreshToken": httpx.Timeout(20.0, connect=CONNECT_TIMEOUT),
+    "/api/DealReg/Upsert": httpx.Timeout(60.0, connect=CONNECT_TIMEOUT),
+    "/api/DealReg/GetRegistrationUpdatesList": httpx.Timeout(30.0, connect=CONNECT_TIMEOUT),
+}
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_enabled() -> bool:
+    if HTTP2_SETTING in ("0", "false", "no"):
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        if HTTP2_SETTING in ("1", "true", "yes"):
+            logger.warning("VARTOPIA_HTTP2 is set but 'h2' is not installed; using HTTP/1.1")
+        return False
+    return True
+
+
+def timeout_for(endpoint: str) -> httpx.Timeout:
+    return ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+
+
+async def open_client() -> httpx.AsyncClient:
+    """Create the shared client (idempotent)."""
+    global _client
+    if _client is None or _client.is_closed:
+        http2 = _http2_enabled()
+        _client = httpx.AsyncClient(
+            http2=http2,
+            timeout=DEFAULT_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+        )
+        logger.info("Vartopia HTTP client opened (http2=%s, max_connections=%d)", http2, MAX_CONNECTIONS)
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        logger.info("Vartopia HTTP client closed")
+
+
+async def get_client() -> httpx.AsyncClient:
+    """Return the shared client, opening it on first use."""
+    if _client is None or _client.is_closed:
+        return await open_client()
+    return _client
@@ -0,0 +1,231 @@
+"""
+Retry, backoff and circuit breaking for outbound Vartopia calls.
+
+send() wraps a single HTTP exchange with:
+
+- A process-wide concurrency cap (VARTOPIA_MAX_CONCURRENCY), so a slow API
+  cannot absorb every worker.
+- Retries with full-jitter exponential backoff:
+    * 429 is retried for any method, waiting for Retry-After when given
+      (seconds or HTTP date, capped at VARTOPIA_RETRY_AFTER_CAP).
+    * 5xx responses and transport errors/timeouts are retried only for
+      idempotent calls (GET/HEAD/PUT/DELETE, or callers passing idempotent=True).
+- A circuit breaker per endpoint: after VARTOPIA_BREAKER_THRESHOLD consecutive
+  5xx/transport failures the endpoint fails fast with CircuitOpenError for
+  VARTOPIA_BREAKER_RESET seconds, then lets a single probe through.
+
+Retries, breaker state and outcomes are exported via services.metrics.
+"""
+
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(os.getenv("VARTOPIA_RETRY_ATTEMPTS", "3"))
+BASE_DELAY = float(os.getenv("VARTOPIA_RETRY_BASE_DELAY", "0.2"))
+MAX_DELAY = float(os.getenv("VARTOPIA_RETRY_MAX_DELAY", "5"))
+RETRY_AFTER_CAP = float(os.getenv("VARTOPIA_RETRY_AFTER_CAP", "30"))
+BREAKER_THRESHOLD = int(os.getenv("VARTOPIA_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET = float(os.getenv("VARTOPIA_BREAKER_RESET", "30"))
+MAX_CONCURRENCY = int(os.getenv("VARTOPIA_MAX_CONCURRENCY", "32"))
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+VARTOPIA_REQUESTS = metrics.counter(
+    "mcp_vartopia_requests_total",
+    "Vartopia API attempts by endpoint and outcome (status code, transport_error, circuit_open).",
+    ["endpoint", "outcome"],
+)
+VARTOPIA_RETRIES = metrics.counter(
+    "mcp_vartopia_retries_total",
+    "Vartopia API retries by endpoint and reason.",
+    ["endpoint", "reason"],
+)
+VARTOPIA_BREAKER_STATE = metrics.gauge(
+    "mcp_vartopia_circuit_state",
+    "Circuit breaker state per Vartopia endpoint (0=closed, 1=half_open, 2=open).",
+    ["endpoint"],
+)
+VARTOPIA_IN_FLIGHT = metrics.gauge(
+    "mcp_vartopia_in_flight",
+    "Vartopia API requests currently holding a concurrency slot.",
+)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(f"Circuit open for {endpoint}; retry in {retry_in:.1f}s")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> half_open (one probe) -> closed."""
+
+    def __init__(self, endpoint: str, threshold: int = BREAKER_THRESHOLD, reset_timeout: float = BREAKER_RESET):
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._export()
+
+    def _export(self) -> None:
+        VARTOPIA_BREAKER_STATE.set(_STATE_VALUES[self.state], endpoint=self.endpoint)
+
+    def _set(self, state: str) -> None:
+        if state != self.state:
+            logger.warning("Vartopia circuit for %s: %s -> %s", self.endpoint, self.state, state)
+            self.state = state
+            self._export()
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError unless a call may proceed."""
+        if self.state == OPEN:
+            elapsed = time.monotonic() - self.opened_at
+            if elapsed < self.reset_timeout:
+                raise CircuitOpenError(self.endpoint, self.reset_timeout - elapsed)
+            self._set(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probe_in_flight:
+                raise CircuitOpenError(self.endpoint, 0.0)
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._probe_in_flight = False
+        self._set(CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == HALF_OPEN or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self._set(OPEN)
+
+    def release_probe(self) -> None:
+        """The call ended without an outcome (cancelled, unexpected error); let the next call probe."""
+        self._probe_in_flight = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def breaker_for(endpoint: str) -> CircuitBreaker:
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        breaker = _breakers[endpoint] = CircuitBreaker(endpoint)
+    return breaker
+
+
+def _slots() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    return _semaphore
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff for the given (1-based) attempt."""
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * (2 ** (attempt - 1))))
+
+
+def retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+async def send(
+    method: str,
+    endpoint: str,
+    call: Callable[[], Awaitable[httpx.Response]],
+    idempotent: Optional[bool] = None,
+) -> httpx.Response:
+    """
+    Run `call()` (one HTTP exchange) with retries, breaker and concurrency limit.
+
+    Returns the final response, which may still be an error status once retries
+    are exhausted. Raises CircuitOpenError, or the last transport error.
+    """
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    breaker = breaker_for(endpoint)
+
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            breaker.before_call()
+        except CircuitOpenError:
+            VARTOPIA_REQUESTS.inc(endpoint=endpoint, outcome="circuit_open")
+            raise
+
+        try:
+            async with _slots():
+                VARTOPIA_IN_FLIGHT.inc()
+                try:
+                    response = await call()
+                finally:
+                    VARTOPIA_IN_FLIGHT.dec()
+        except httpx.TransportError as e:
+            breaker.record_failure()
+            VARTOPIA_REQUESTS.inc(endpoint=endpoint, outcome="transport_error")
+            if not idempotent or attempt >= MAX_ATTEMPTS:
+                raise
+            delay = backoff_delay(attempt)
+            reason = "timeout" if isinstance(e, httpx.TimeoutException) else "transport"
+            VARTOPIA_RETRIES.inc(endpoint=endpoint, reason=reason)
+            logger.warning("Vartopia %s %s failed (%s); retry %d in %.2fs", method, endpoint, e, attempt, delay)
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            # cancellation (client gone, turn deadline) or a non-transport error says
+            # nothing about the endpoint, but must not leave a half-open probe claimed
+            breaker.release_probe()
+            raise
+
+        status = response.status_code
+        VARTOPIA_REQUESTS.inc(endpoint=endpoint, outcome=str(status))
+        if status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+        retryable = status == 429 or (status >= 500 and idempotent)
+        if not retryable or attempt >= MAX_ATTEMPTS:
+            return response
+
+        delay = retry_after_seconds(response)
+        if delay is None:
+            delay = backoff_delay(attempt)
+        elif delay > RETRY_AFTER_CAP:
+            # the caller is better off failing now than holding a worker that long
+            return response
+        VARTOPIA_RETRIES.inc(endpoint=endpoint, reason=str(status))
+        logger.warning("Vartopia %s %s returned %d; retry %d in %.2fs", method, endpoint, status, attempt, delay)
+        await asyncio.sleep(delay)
@@ -0,0 +1,42 @@
+"""
+Single-flight call coalescing for asyncio.
+
+Concurrent callers asking for the same key share one in-flight execution and
+all receive its result (or exception). Used to collapse login/refresh storms
+and duplicate reads into a single upstream request.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run `fn()` once for all concurrent callers of `key`.
+        A caller being cancelled does not cancel the shared call for the others.
+        """
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda f, k=key: self._done(k, f))
+        return await asyncio.shield(future)
+
+    def _done(self, key: Hashable, future: "asyncio.Future[Any]") -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        # mark the exception as retrieved when every waiter was cancelled
+        if not future.cancelled() and future.exception() is not None:
+            logger.debug("Single-flight call for %r failed: %s", key, future.exception())
@@ -0,0 +1,110 @@
+"""
+Cached, coalesced access to /api/DealReg/GetRegistrationUpdatesList.
+
+- Successful responses are kept in a short-TTL in-process cache keyed by
+  (scope, unique_id, varcrm_opportunity_id, vartopia_transaction_id); the
+  scope is the Vartopia login, so users never see each other's results.
+- Concurrent identical requests share one in-flight call (single-flight).
+- fetch_many() fans a list of IDs out with bounded concurrency.
+
+Tuning (env):
+    VARTOPIA_UPDATES_CACHE_TTL     seconds a response is reused (default 15)
+    VARTOPIA_UPDATES_CACHE_SIZE    max cached keys (default 10000)
+    VARTOPIA_UPDATES_CONCURRENCY   parallel requests for fetch_many (default 8)
+"""
+
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Tuple, Union
+
+from cachetools import TTLCache
+from fastapi import HTTPException
+
+from services import metrics
+from . import client
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = float(os.getenv("VARTOPIA_UPDATES_CACHE_TTL", "15"))
+CACHE_SIZE = int(os.getenv("VARTOPIA_UPDATES_CACHE_SIZE", "10000"))
+CONCURRENCY = int(os.getenv("VARTOPIA_UPDATES_CONCURRENCY", "8"))
+
+UpdateKey = Tuple[str, str, str]
+
+_cache: "TTLCache[Tuple[str, UpdateKey], Any]" = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+_flights = SingleFlight()
+
+
+def update_key(item: Union[str, Dict[str, Any]]) -> UpdateKey:
+    """Normalise a unique_id string or an ID dict to (unique_id, varcrm_opportunity_id, vartopia_transaction_id)."""
+    if isinstance(item, str):
+        return (item, "", "")
+    if isinstance(item, dict):
+        return (
+            str(item.get("unique_id") or item.get("uniqueID") or ""),
+            str(item.get("varcrm_opportunity_id") or item.get("varCrmOpportunityId") or ""),
+            str(item.get("vartopia_transaction_id") or item.get("vartopiaTransactionId") or ""),
+        )
+    raise HTTPException(status_code=400, detail=f"Invalid registration ID: {item!r}")
+
+
+def _label(key: UpdateKey) -> str:
+    return "|".join(key) if any(key[1:]) else key[0]
+
+
+def invalidate(scope: str, key: UpdateKey) -> None:
+    _cache.pop((scope, key), None)
+
+
+async def fetch(
+    with_token: Callable[[Callable[[str], Awaitable[Any]]], Awaitable[Any]],
+    scope: str,
+    key: UpdateKey,
+    refresh: bool = False,
+) -> Any:
+    """Return registration updates for `key`, from cache when fresh; `refresh` bypasses the cache."""
+    cache_key = (scope, key)
+    if not refresh and cache_key in _cache:
+        metrics.record_cache("vartopia_updates", hit=True)
+        return _cache[cache_key]
+    metrics.record_cache("vartopia_updates", hit=False)
+
+    async def load() -> Any:
+        result = await with_token(lambda access_token: client.get_registration_updates(
+            access_token=access_token,
+            unique_id=key[0],
+            varcrm_opportunity_id=key[1],
+            vartopia_transaction_id=key[2],
+        ))
+        _cache[cache_key] = result
+        return result
+
+    return await _flights.do(cache_key, load)
+
+
+async def fetch_many(
+    with_token: Callable[[Callable[[str], Awaitable[Any]]], Awaitable[Any]],
+    scope: str,
+    items: List[Union[str, Dict[str, Any]]],
+    concurrency: int = CONCURRENCY,
+    refresh: bool = False,
+) -> Dict[str, Any]:
+    """Fetch updates for many IDs with at most `concurrency` requests in flight; results keyed by ID."""
+    keys = list(dict.fromkeys(update_key(item) for item in items))
+    slots = asyncio.Semaphore(max(1, int(concurrency)))
+
+    async def one(key: UpdateKey) -> Tuple[str, Dict[str, Any]]:
+        async with slots:
+            try:
+                return _label(key), {"success": True, "data": await fetch(with_token, scope, key, refresh)}
+            except HTTPException as e:
+                return _label(key), {"success": False, "error": {"status": e.status_code, "detail": e.detail}}
+            except Exception as e:
+                logger.exception("Registration updates failed for %s", _label(key))
+                return _label(key), {"success": False, "error": {"status": 500, "detail": str(e)}}
+
+    results = dict(await asyncio.gather(*(one(key) for key in keys)))
+    failed = sum(1 for r in results.values() if not r["success"])
+    return {"total": len(results), "succeeded": len(results) - failed, "failed": failed, "results": results}
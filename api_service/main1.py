@@ -4,13 +4,27 @@ from pydantic import BaseModel
 import logging
 
 from mcp_tools.vartopia_tools import VartopiaTool
+from services import tracing
+from api_client import http as vartopia_http
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Vartopia API Layer", version="1.0.0")
+app.add_middleware(tracing.TracingMiddleware, service_name="vartopia_api")
 vartopia_tool = VartopiaTool()
 
+
+@app.on_event("startup")
+async def open_http_clients():
+    await vartopia_http.open_client()
+
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await vartopia_http.close_client()
+
+
 class VendorRequest(BaseModel):
     user_email: str
 
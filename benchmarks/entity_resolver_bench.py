@@ -0,0 +1,181 @@
+"""
+Micro-benchmark for sql_tool.entity_resolver.
+
+Compares the entity/pronoun step OpenAITool used to run inline (up to five
+regex searches per call plus a pronoun pattern rebuilt each time, and the
+`<user>_last_entity` history list read twice) with the precompiled
+single-pass resolver:
+
+- cpu:   scan + rewrite over a corpus of typical instructions, no I/O. Both
+         implementations must pick the same entity for every instruction.
+- redis: the state round trips per turn against a real Redis (--redis-url):
+         legacy LRANGE + RPUSH/LTRIM + LRANGE vs. one HGETALL or one
+         pipelined HSET/EXPIRE. Skipped without --redis-url.
+
+Usage:
+    python -m benchmarks.entity_resolver_bench -n 200000
+    python -m benchmarks.entity_resolver_bench -n 20000 --redis-url redis://localhost:6379
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from benchmarks.stats import format_table, summarize
+from sql_tool.entity_resolver import rewrite, scan
+
+INSTRUCTIONS = [
+    "show me the vendor details for user 100001",
+    "what is the vendor status for Alice?",
+    "update its vendor_status to active",
+    "get the email for them",
+    "email: carla.diaz@example.com show vendors",
+    "list vendors for bob.123@example.com",
+    "vendor_name = Acme Corp",
+    "when was it last updated",
+    "delete the vendor about Globex",
+    "insert a new vendor named Initech with status pending for user 554433",
+    "what did they buy",
+    "show me everything",
+]
+
+
+def legacy_extract(instruction: str, stored: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """The extraction OpenAITool ran inline before the resolver (I/O left out)."""
+    last_entity = stored
+    user_match = re.search(
+        r"(user_id|user_name|email|vendor_id|vendor_name|last_updated)\s*[:=]?\s*([\w@.\-: ]+)?",
+        instruction,
+        re.IGNORECASE
+    )
+    if user_match and user_match.group(2):
+        last_entity = {"type": user_match.group(1).lower(), "value": user_match.group(2).strip()}
+    else:
+        match_id = re.search(r"\b\d{3,}\b", instruction)
+        if match_id:
+            last_entity = {"type": "user_id", "value": match_id.group()}
+        elif re.search(r"[\w\.-]+@[\w\.-]+\.\w+", instruction):
+            email_match = re.search(r"[\w\.-]+@[\w\.-]+\.\w+", instruction)
+            if email_match:
+                last_entity = {"type": "email", "value": email_match.group()}
+        else:
+            match_name = re.search(r"(?:for|about)\s+([A-Za-z][A-Za-z0-9_-]*)", instruction, re.IGNORECASE)
+            if match_name:
+                entity_value = match_name.group(1)
+                if entity_value.lower() not in ["of"]:
+                    last_entity = {"type": "user_name", "value": entity_value}
+            else:
+                last_entity = stored
+    return last_entity
+
+
+def legacy_rewrite(instruction: str, last_entity: Optional[Dict[str, Any]]) -> str:
+    if last_entity and last_entity.get("value"):
+        pronouns = ["it", "its", "them", "they", "he", "she", "his", "her", "their"]
+        pattern = r"\b(" + "|".join(pronouns) + r")\b"
+        instruction = re.sub(pattern, str(last_entity["value"]), instruction, flags=re.IGNORECASE)
+    if last_entity and "value" in last_entity and last_entity["value"]:
+        if last_entity["value"].lower() not in instruction.lower():
+            instruction += f" for {last_entity['value']}"
+    return instruction
+
+
+def check_equivalence() -> List[str]:
+    stored = {"type": "user_id", "value": "100042"}
+    mismatches = []
+    for text in INSTRUCTIONS:
+        old = legacy_extract(text, stored)
+        new = scan(text) or stored
+        if old != new or legacy_rewrite(text, old) != rewrite(text, new):
+            mismatches.append(f"{text!r}: legacy={old} resolver={new}")
+    return mismatches
+
+
+def bench_cpu(n: int) -> Dict[str, Dict[str, Any]]:
+    stored = {"type": "user_id", "value": "100042"}
+    corpus = [INSTRUCTIONS[i % len(INSTRUCTIONS)] for i in range(n)]
+    report = {}
+    for name, step in (
+        ("legacy", lambda text: legacy_rewrite(text, legacy_extract(text, stored))),
+        ("resolver", lambda text: rewrite(text, scan(text) or stored)),
+    ):
+        started = time.perf_counter()
+        for text in corpus:
+            step(text)
+        elapsed = time.perf_counter() - started
+        report[name] = {"calls": n, "elapsed_s": round(elapsed, 3), "us_per_call": round(elapsed / n * 1e6, 2)}
+    return report
+
+
+async def bench_redis(url: str, n: int) -> Dict[str, Dict[str, Any]]:
+    import redis.asyncio as aioredis
+
+    r = aioredis.from_url(url, decode_responses=True)
+    legacy_key, hash_key = "bench:user:u1_last_entity:history", "bench:entity:u1"
+    entity = {"type": "user_id", "value": "100042"}
+    report = {}
+    try:
+        latencies: List[float] = []
+        started = time.perf_counter()
+        for _ in range(n):
+            began = time.perf_counter()
+            await r.lrange(legacy_key, 0, -1)                      # initial read
+            await r.rpush(legacy_key, json.dumps(entity))          # add_message ...
+            await r.ltrim(legacy_key, -5, -1)                      # ... and trim
+            await r.lrange(legacy_key, 0, -1)                      # second read in the fallback branch
+            latencies.append(time.perf_counter() - began)
+        report["legacy"] = summarize(latencies, time.perf_counter() - started)
+
+        latencies = []
+        started = time.perf_counter()
+        for i in range(n):
+            began = time.perf_counter()
+            if i % 2:
+                await r.hgetall(hash_key)
+            else:
+                await r.pipeline(transaction=False).hset(hash_key, mapping=entity).expire(hash_key, 3600).execute()
+            latencies.append(time.perf_counter() - began)
+        report["resolver"] = summarize(latencies, time.perf_counter() - started)
+    finally:
+        await r.delete(legacy_key, hash_key)
+        await r.aclose()
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the precompiled entity resolver against the inline version.")
+    parser.add_argument("-n", "--iterations", type=int, default=100000, help="instructions resolved in the cpu run")
+    parser.add_argument("--redis-url", default=None, help="also measure Redis round trips against this server")
+    parser.add_argument("--redis-iterations", type=int, default=5000)
+    parser.add_argument("--json-out", default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    mismatches = check_equivalence()
+    for line in mismatches:
+        print(f"MISMATCH {line}", file=sys.stderr)
+
+    report: Dict[str, Any] = {"cpu": bench_cpu(args.iterations)}
+    for name, rows in report["cpu"].items():
+        print(format_table(f"cpu: {name}", rows))
+        print()
+    if args.redis_url:
+        report["redis"] = asyncio.run(bench_redis(args.redis_url, args.redis_iterations))
+        for name, rows in report["redis"].items():
+            print(format_table(f"redis per turn: {name}", rows))
+            print()
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
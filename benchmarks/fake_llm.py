@@ -0,0 +1,249 @@
+"""
+Local OpenAI-compatible stub for load testing.
+
+Implements just enough of the OpenAI REST API for AsyncOpenAI:
+    POST /v1/chat/completions  -> canned SQL (or JSON for field-extraction prompts)
+    POST /v1/embeddings        -> deterministic unit vectors derived from the input text
+    GET  /stats                -> call counts, tokens and time spent per endpoint
+    POST /stats/reset
+    POST /config               -> change latency / prompt-cache settings at runtime
+
+Point the services at it with:
+    OPENAI_BASE_URL=http://localhost:8100/v1 OPENAI_API_KEY=bench
+
+Latency is configurable per endpoint (with jitter) so benchmarks can model a
+slow or fast provider, plus an optional cost per 1k uncached prompt tokens.
+
+Chat completions simulate provider prompt caching the way OpenAI does it: a
+prompt of at least 1024 tokens is cached in 128-token blocks, a later prompt
+sharing a prefix with it reports the reused blocks as
+usage.prompt_tokens_details.cached_tokens, and only uncached tokens add
+prompt latency.
+
+Usage:
+    python -m benchmarks.fake_llm --port 8100 --latency-ms 400 --jitter-ms 150
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import struct
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+
+CONFIG: Dict[str, Any] = {
+    "chat_latency_ms": float(os.getenv("FAKE_LLM_LATENCY_MS", "300")),
+    "embed_latency_ms": float(os.getenv("FAKE_LLM_EMBED_LATENCY_MS", "40")),
+    "jitter_ms": float(os.getenv("FAKE_LLM_JITTER_MS", "100")),
+    "embed_dim": int(os.getenv("FAKE_LLM_EMBED_DIM", "1536")),
+    "sql": os.getenv("FAKE_LLM_SQL", "SELECT * FROM user_vendor_info WHERE user_id = 100001;"),
+    "prompt_ms_per_1k": float(os.getenv("FAKE_LLM_PROMPT_MS_PER_1K", "0")),
+    "prompt_cache": os.getenv("FAKE_LLM_PROMPT_CACHE", "true").lower() not in ("0", "false", "no"),
+    "cache_min_tokens": int(os.getenv("FAKE_LLM_CACHE_MIN_TOKENS", "1024")),
+    "cache_block_tokens": int(os.getenv("FAKE_LLM_CACHE_BLOCK_TOKENS", "128")),
+}
+CACHE_MAX_ENTRIES = 100_000
+
+REQUIRED_FIELDS = ["user_id", "user_name", "email", "vendor_name", "vendor_status", "last_updated"]
+
+_stats: Dict[str, Dict[str, float]] = {}
+_prefix_cache: "OrderedDict[bytes, None]" = OrderedDict()
+
+app = FastAPI(title="Fake OpenAI API")
+
+
+def _record(endpoint: str, elapsed: float, prompt_tokens: int, completion_tokens: int = 0,
+            cached_tokens: int = 0) -> None:
+    s = _stats.setdefault(endpoint, {"calls": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0,
+                                     "cached_tokens": 0})
+    s["calls"] += 1
+    s["seconds"] += elapsed
+    s["prompt_tokens"] += prompt_tokens
+    s["completion_tokens"] += completion_tokens
+    s["cached_tokens"] += cached_tokens
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+async def _sleep(base_ms: float) -> None:
+    jitter = random.uniform(-CONFIG["jitter_ms"], CONFIG["jitter_ms"]) if CONFIG["jitter_ms"] else 0.0
+    delay = max(0.0, base_ms + jitter) / 1000.0
+    if delay:
+        await asyncio.sleep(delay)
+
+
+def _cached_prefix_tokens(model: str, messages: List[Dict[str, Any]]) -> Tuple[int, int]:
+    """
+    (prompt tokens, tokens served from the simulated prompt cache).
+
+    Hashes the rendered prompt block by block; the cached length is the
+    longest run of leading blocks seen before. Every block boundary of this
+    prompt is then remembered (LRU), as a provider would after the call.
+    """
+    text = "".join(f"{m.get('role', '')}\n{m.get('content', '')}\n" for m in messages)
+    prompt_tokens = sum(_estimate_tokens(str(m.get("content", ""))) for m in messages)
+    if not CONFIG["prompt_cache"] or len(text) // 4 < CONFIG["cache_min_tokens"]:
+        return prompt_tokens, 0
+    block = CONFIG["cache_block_tokens"] * 4
+    first = CONFIG["cache_min_tokens"] * 4
+    digest = hashlib.sha256(model.encode("utf-8"))
+    digest.update(text[:first].encode("utf-8"))
+    boundaries = [digest.digest()]
+    for start in range(first, len(text) - block + 1, block):
+        digest.update(text[start:start + block].encode("utf-8"))
+        boundaries.append(digest.digest())
+
+    cached_blocks = 0
+    for key in boundaries:
+        if key not in _prefix_cache:
+            break
+        _prefix_cache.move_to_end(key)
+        cached_blocks += 1
+    for key in boundaries[cached_blocks:]:
+        _prefix_cache[key] = None
+    while len(_prefix_cache) > CACHE_MAX_ENTRIES:
+        _prefix_cache.popitem(last=False)
+
+    if not cached_blocks:
+        return prompt_tokens, 0
+    cached = CONFIG["cache_min_tokens"] + (cached_blocks - 1) * CONFIG["cache_block_tokens"]
+    return prompt_tokens, min(cached, prompt_tokens)
+
+
+def _chat_reply(messages: List[Dict[str, Any]]) -> str:
+    system = " ".join(str(m.get("content", "")) for m in messages if m.get("role") == "system")
+    if "strictly valid JSON" in system:
+        return json.dumps({field: f"bench-{field}" for field in REQUIRED_FIELDS})
+    if "Explain" in system:
+        return "This query selects vendor rows for a single user."
+    return CONFIG["sql"]
+
+
+def _embedding(text: str, dim: int) -> List[float]:
+    seed = struct.unpack("<Q", hashlib.sha256(text.encode("utf-8")).digest()[:8])[0]
+    rng = random.Random(seed)
+    vec = [rng.gauss(0.0, 1.0) for _ in range(dim)]
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    started = time.perf_counter()
+    body = await request.json()
+    messages = body.get("messages", [])
+    prompt_tokens, cached_tokens = _cached_prefix_tokens(str(body.get("model", "")), messages)
+    await _sleep(CONFIG["chat_latency_ms"] + CONFIG["prompt_ms_per_1k"] * (prompt_tokens - cached_tokens) / 1000)
+
+    content = _chat_reply(messages)
+    completion_tokens = _estimate_tokens(content)
+    _record("chat", time.perf_counter() - started, prompt_tokens, completion_tokens, cached_tokens)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        },
+    }
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    started = time.perf_counter()
+    body = await request.json()
+    inputs = body.get("input", "")
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    dim = int(body.get("dimensions") or CONFIG["embed_dim"])
+    await _sleep(CONFIG["embed_latency_ms"])
+
+    prompt_tokens = sum(_estimate_tokens(str(t)) for t in inputs)
+    _record("embeddings", time.perf_counter() - started, prompt_tokens)
+    return {
+        "object": "list",
+        "model": body.get("model", "fake-embedding"),
+        "data": [
+            {"object": "embedding", "index": i, "embedding": _embedding(str(text), dim)}
+            for i, text in enumerate(inputs)
+        ],
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
+
+
+@app.get("/stats")
+def stats():
+    return _stats
+
+
+@app.post("/stats/reset")
+def reset_stats():
+    _stats.clear()
+    return {"status": "reset"}
+
+
+@app.post("/config")
+async def update_config(request: Request):
+    """Update CONFIG keys at runtime; {"clear_prompt_cache": true} also empties the prefix cache."""
+    body = await request.json()
+    if body.pop("clear_prompt_cache", False):
+        _prefix_cache.clear()
+    for key, value in body.items():
+        if key in CONFIG:
+            CONFIG[key] = type(CONFIG[key])(value)
+    return CONFIG
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "config": CONFIG}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Run a local OpenAI-compatible stub.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=CONFIG["chat_latency_ms"])
+    parser.add_argument("--embed-latency-ms", type=float, default=CONFIG["embed_latency_ms"])
+    parser.add_argument("--jitter-ms", type=float, default=CONFIG["jitter_ms"])
+    parser.add_argument("--embed-dim", type=int, default=CONFIG["embed_dim"])
+    parser.add_argument("--sql", default=CONFIG["sql"], help="canned SQL returned for chat completions")
+    parser.add_argument("--prompt-ms-per-1k", type=float, default=CONFIG["prompt_ms_per_1k"],
+                        help="extra chat latency per 1k uncached prompt tokens")
+    parser.add_argument("--no-prompt-cache", action="store_true", help="disable the simulated prompt cache")
+    args = parser.parse_args(argv)
+
+    CONFIG.update({
+        "chat_latency_ms": args.latency_ms,
+        "embed_latency_ms": args.embed_latency_ms,
+        "jitter_ms": args.jitter_ms,
+        "embed_dim": args.embed_dim,
+        "sql": args.sql,
+        "prompt_ms_per_1k": args.prompt_ms_per_1k,
+        "prompt_cache": CONFIG["prompt_cache"] and not args.no_prompt_cache,
+    })
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+End-to-end load test for the MCP agent.
+
+Drives either the HTTP `/ask_agent` endpoint or the stdio JSON-RPC server
+(`main_stdio.py`, spawned as a subprocess) at a fixed concurrency and reports
+throughput and p50/p95/p99 latency. When the fake LLM stub is running
+(benchmarks/fake_llm.py), its call counters are sampled before and after the
+run to split each turn into LLM time vs. everything else. For the HTTP target
+the backend's /metrics stage histograms are sampled the same way, giving the
+mean time per pipeline stage during the run.
+
+Typical local setup:
+    docker compose -f benchmarks/docker-compose.bench.yml up -d
+    python -m benchmarks.load_test --target http --url http://localhost:8000/ask_agent -c 32 -n 2000
+    python -m benchmarks.load_test --target stdio -c 8 -n 200
+
+Exit code is non-zero when the error rate exceeds --max-error-rate, so the
+harness can gate CI runs.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmarks.stats import format_table, summarize
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                    format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_PROMPTS = [
+    "show me the vendor details for user 100001",
+    "what is the vendor status for user 100042?",
+    "list vendors for Alice Walker",
+    "get the email for user 100777",
+    "when was vendor VN-4821 last updated?",
+]
+
+
+class RunResult:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.error_samples: List[str] = []
+
+    def ok(self, latency: float) -> None:
+        self.latencies.append(latency)
+
+    def fail(self, reason: str) -> None:
+        self.errors += 1
+        if len(self.error_samples) < 5:
+            self.error_samples.append(reason)
+
+
+def _load_prompts(path: Optional[str]) -> List[str]:
+    if not path:
+        return DEFAULT_PROMPTS
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+async def _drive(concurrency: int, total: int, duration: Optional[float], send) -> RunResult:
+    """
+    Run `send(i)` from `concurrency` workers until `total` requests were issued
+    or `duration` seconds elapsed (whichever comes first).
+    """
+    result = RunResult()
+    counter = itertools.count()
+    deadline = time.perf_counter() + duration if duration else None
+
+    async def worker():
+        while True:
+            i = next(counter)
+            if i >= total or (deadline and time.perf_counter() >= deadline):
+                return
+            started = time.perf_counter()
+            try:
+                error = await send(i)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            if error:
+                result.fail(error)
+            else:
+                result.ok(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return result
+
+
+async def run_http(args, prompts: List[str]) -> RunResult:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+
+        async def send(i: int) -> Optional[str]:
+            user_id = f"bench-user-{i % args.users}"
+            messages = [{"role": "user", "content": random.choice(prompts)}]
+            if args.jsonrpc:
+                body = {"jsonrpc": "2.0", "id": i, "method": "ask_agent",
+                        "params": {"user_id": user_id, "messages": messages}}
+            else:
+                body = {"user_id": user_id, "messages": messages}
+            res = await client.post(args.url, json=body)
+            if res.status_code >= 400:
+                return f"HTTP {res.status_code}: {res.text[:200]}"
+            return None
+
+        return await _drive(args.concurrency, args.requests, args.duration, send)
+
+
+class StdioClient:
+    """Minimal JSON-RPC client over a subprocess' stdin/stdout, matching responses by id."""
+
+    def __init__(self, command: List[str]):
+        self.command = command
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.pending: Dict[Any, asyncio.Future] = {}
+        self.ids = itertools.count(1)
+        self._reader: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.proc = await asyncio.create_subprocess_exec(
+            *self.command,
+            cwd=REPO_ROOT,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=16 * 1024 * 1024,
+        )
+        self._reader = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self) -> None:
+        while True:
+            line = await self.proc.stdout.readline()
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            for item in message if isinstance(message, list) else [message]:
+                future = self.pending.pop(item.get("id"), None)
+                if future and not future.done():
+                    future.set_result(item)
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("stdio server exited"))
+
+    async def call(self, method: str, params: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        req_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[req_id] = future
+        payload = {"jsonrpc": "2.0", "id": req_id, "method": method, "params": params}
+        self.proc.stdin.write((json.dumps(payload, separators=(",", ":")) + "\n").encode("utf-8"))
+        await self.proc.stdin.drain()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(req_id, None)
+
+    async def close(self) -> None:
+        if self.proc and self.proc.returncode is None:
+            self.proc.stdin.close()
+            try:
+                await asyncio.wait_for(self.proc.wait(), 5)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+        if self._reader:
+            self._reader.cancel()
+
+
+async def run_stdio(args, prompts: List[str]) -> RunResult:
+    client = StdioClient([sys.executable, "-u", os.path.join(REPO_ROOT, "main_stdio.py")])
+    await client.start()
+    try:
+        await client.call("initialize", {"protocolVersion": "2025-06-18"}, args.timeout)
+
+        async def send(i: int) -> Optional[str]:
+            arguments = {"instruction": random.choice(prompts), "user_id": f"bench-user-{i % args.users}"}
+            response = await client.call("tools/call", {"name": args.tool, "arguments": arguments}, args.timeout)
+            if "error" in response:
+                return str(response["error"])[:200]
+            return None
+
+        return await _drive(args.concurrency, args.requests, args.duration, send)
+    finally:
+        await client.close()
+
+
+async def _llm_stats(url: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not url:
+        return None
+    try:
+        async with httpx.AsyncClient(timeout=5.0) as client:
+            return (await client.get(url)).json()
+    except Exception:
+        logger.warning("Could not read fake LLM stats from %s", url)
+        return None
+
+
+STAGE_SAMPLE = re.compile(r'^mcp_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$')
+
+
+async def _server_stages(url: Optional[str]) -> Optional[Dict[str, Dict[str, float]]]:
+    """Read per-stage sum/count from the backend's Prometheus /metrics endpoint."""
+    if not url:
+        return None
+    try:
+        async with httpx.AsyncClient(timeout=5.0) as client:
+            text = (await client.get(url)).text
+    except Exception:
+        logger.warning("Could not read backend metrics from %s", url)
+        return None
+    stages: Dict[str, Dict[str, float]] = {}
+    for line in text.splitlines():
+        match = STAGE_SAMPLE.match(line)
+        if match:
+            kind, stage, value = match.groups()
+            stages.setdefault(stage, {})[kind] = float(value)
+    return stages
+
+
+def _server_stage_means(before, after) -> Dict[str, Any]:
+    if before is None or after is None:
+        return {}
+    rows: Dict[str, Any] = {}
+    for stage, a in sorted(after.items()):
+        b = before.get(stage, {})
+        count = a.get("count", 0.0) - b.get("count", 0.0)
+        if count > 0:
+            mean_ms = (a.get("sum", 0.0) - b.get("sum", 0.0)) / count * 1000
+            rows[f"{stage}_mean_ms"] = round(mean_ms, 2)
+    return rows
+
+
+def _stage_breakdown(before: Optional[Dict], after: Optional[Dict], summary: Dict[str, float]) -> Dict[str, Any]:
+    if before is None or after is None or not summary["ok"]:
+        return {}
+    rows: Dict[str, Any] = {}
+    llm_ms = 0.0
+    for endpoint in ("chat", "embeddings"):
+        b = before.get(endpoint, {})
+        a = after.get(endpoint, {})
+        calls = a.get("calls", 0) - b.get("calls", 0)
+        seconds = a.get("seconds", 0.0) - b.get("seconds", 0.0)
+        per_request_ms = seconds / summary["ok"] * 1000
+        llm_ms += per_request_ms
+        rows[f"{endpoint}_calls_per_request"] = round(calls / summary["ok"], 2)
+        rows[f"{endpoint}_ms_per_request"] = round(per_request_ms, 2)
+    rows["non_llm_ms_per_request"] = round(max(0.0, summary["mean_ms"] - llm_ms), 2)
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test /ask_agent or the stdio JSON-RPC server.")
+    parser.add_argument("--target", choices=["http", "stdio"], default="http")
+    parser.add_argument("--url", default="http://localhost:8000/ask_agent")
+    parser.add_argument("--jsonrpc", action="store_true", help="send JSON-RPC envelopes to /ask_agent")
+    parser.add_argument("--tool", default="OpenAITool", help="tool invoked via tools/call on the stdio target")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-n", "--requests", type=int, default=500)
+    parser.add_argument("-d", "--duration", type=float, default=None, help="stop after N seconds")
+    parser.add_argument("--users", type=int, default=50, help="number of distinct user_ids to spread load over")
+    parser.add_argument("--prompts-file", default=None, help="one prompt per line")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--llm-stats-url", default="http://localhost:8100/stats")
+    parser.add_argument("--metrics-url", default=None,
+                        help="backend /metrics URL (defaults to the /ask_agent host for the http target)")
+    parser.add_argument("--json-out", default=None, help="also write the report as JSON to this path")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    return parser.parse_args(argv)
+
+
+async def _main(args) -> int:
+    prompts = _load_prompts(args.prompts_file)
+    metrics_url = args.metrics_url
+    if metrics_url is None and args.target == "http":
+        metrics_url = args.url.rsplit("/", 1)[0] + "/metrics"
+    before = await _llm_stats(args.llm_stats_url)
+    stages_before = await _server_stages(metrics_url)
+
+    started = time.perf_counter()
+    if args.target == "http":
+        result = await run_http(args, prompts)
+    else:
+        result = await run_stdio(args, prompts)
+    elapsed = time.perf_counter() - started
+
+    after = await _llm_stats(args.llm_stats_url)
+    stages_after = await _server_stages(metrics_url)
+    summary = summarize(result.latencies, elapsed, result.errors)
+    stages = _stage_breakdown(before, after, summary)
+    stages.update(_server_stage_means(stages_before, stages_after))
+
+    print(format_table(f"{args.target} @ concurrency {args.concurrency}", summary))
+    if stages:
+        print()
+        print(format_table("per-stage breakdown", stages))
+    for sample in result.error_samples:
+        logger.warning("sample error: %s", sample)
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({"target": args.target, "concurrency": args.concurrency,
+                       "summary": summary, "stages": stages}, f, indent=2)
+
+    error_rate = result.errors / summary["requests"] if summary["requests"] else 0.0
+    return 1 if error_rate > args.max_error_rate else 0
+
+
+def main(argv=None) -> None:
+    sys.exit(asyncio.run(_main(parse_args(argv))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Prompt-cache benchmark: old prompt layout vs. static-first layout.
+
+Simulates --users conversations of --turns turns each against the fake LLM
+(benchmarks/fake_llm.py, which models provider prompt caching) and sends
+every SQL-generation prompt twice, once per layout, through the real LLM
+gateway:
+
+- legacy:  the previous layout. The last mentioned entity is interpolated
+           into rule 6 of the SQL system prompt, and the memory block comes
+           before the conversation history.
+- static:  agent.prompt_template.assemble_prompt. The SQL system prompt is
+           constant, then history, then memory and the entity as a trailing
+           context message, then the user's message.
+
+The prompt cache is cleared between layouts. For each layout the report lists
+prompt tokens, cached prompt tokens and their ratio, and latency. Run the stub
+with --prompt-ms-per-1k (or pass it here) so uncached tokens cost time.
+
+Usage:
+    python -m benchmarks.fake_llm --port 8100 --jitter-ms 0 &
+    python -m benchmarks.prompt_cache_bench --users 8 --turns 20 --prompt-ms-per-1k 200
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmarks.stats import format_table, summarize
+
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING,
+                    format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+AGENT_PROMPT = "You are an AI assistant learning from this user's message."
+LEGACY_RULE = 'the last mentioned entity given in the "Conversation context" message.'
+NAMES = ["Alice Walker", "Bob Stone", "Carla Diaz", "Dev Patel", "Erin Moss", "Farid Haddad"]
+TEMPLATES = [
+    "show me the vendor details for user {id}",
+    "what is the vendor status for {name}?",
+    "update its vendor_status to active",
+    "when was vendor VN-{vn} last updated?",
+    "get the email for user {id}",
+    "list all vendors for {name}",
+]
+
+
+def _turn(rng: random.Random) -> Dict[str, str]:
+    user_id, name, vn = str(rng.randint(100000, 999999)), rng.choice(NAMES), rng.randint(1000, 9999)
+    question = rng.choice(TEMPLATES).format(id=user_id, name=name, vn=vn)
+    rows = [f"vendor VN-{rng.randint(1000, 9999)} ({rng.choice(['Acme', 'Globex', 'Initech', 'Umbrella'])}, "
+            f"{rng.choice(['active', 'pending', 'inactive'])}, last updated 2024-0{rng.randint(1, 9)}-1{rng.randint(0, 9)})"
+            for _ in range(rng.randint(2, 5))]
+    answer = f"{name} (user {user_id}, {name.split()[0].lower()}@example.com) has {len(rows)} vendors: " + "; ".join(rows) + "."
+    entity = {"type": "user_id", "value": user_id} if "user" in question else {"type": "user_name", "value": name}
+    return {"question": question, "answer": answer, "entity": json.dumps(entity)}
+
+
+def _prompts(history: List[Dict[str, str]], turn: Dict[str, str], rng: random.Random,
+             feedback_window: int) -> Dict[str, List[Dict[str, str]]]:
+    from agent.prompt_template import SQL_SYSTEM_PROMPT, assemble_prompt, entity_context
+    from services.context_packer import ContextItem, context_packer
+
+    items = [ContextItem("feedback", m["content"], rank=rank, order=-rank, role=m["role"])
+             for rank, m in enumerate(reversed(history[-feedback_window:]))]
+    items.append(ContextItem("summary", f"The user has asked about {len(history) // 2} vendor records so far."))
+    for rank, past in enumerate(rng.sample(history, min(3, len(history)))):
+        items.append(ContextItem("similar", past["content"], rank=rank, order=rank,
+                                 prefix=f"Similar past message (dist={rng.random():.4f}): "))
+    packed = context_packer.pack(AGENT_PROMPT, turn["question"], items)
+    entity = json.loads(turn["entity"])
+
+    static = assemble_prompt(SQL_SYSTEM_PROMPT, packed.messages[:-1], entity_context(entity), turn["question"])
+
+    # previous layout: entity inside the system rules, memory block ahead of the history
+    legacy_system = SQL_SYSTEM_PROMPT.strip().replace(LEGACY_RULE, f"the last mentioned user: {entity}.")
+    memory = [m for m in packed.messages[1:-1] if m["role"] == "system"]
+    rest = [m for m in packed.messages[1:-1] if m["role"] != "system"]
+    legacy = ([{"role": "system", "content": legacy_system}, packed.messages[0]] + memory + rest
+              + [packed.messages[-1]])
+    return {"legacy": legacy, "static": static}
+
+
+class LayoutResult:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.hits = 0
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        calls = len(self.latencies)
+        rows: Dict[str, Any] = summarize(self.latencies, elapsed, self.errors)
+        rows.update({
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_ratio": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0.0,
+            "calls_with_cache_hit": f"{self.hits}/{calls}",
+        })
+        return rows
+
+
+async def run_layout(layout: str, conversations: List[List[Dict[str, List[Dict[str, str]]]]]) -> Dict[str, Any]:
+    from services.llm_gateway import llm
+
+    result = LayoutResult()
+
+    async def converse(turns: List[Dict[str, List[Dict[str, str]]]]) -> None:
+        for prompts in turns:
+            started = time.perf_counter()
+            try:
+                response = await llm.chat("sql_generation", model="gpt-3.5-turbo", messages=prompts[layout])
+            except Exception as e:
+                result.errors += 1
+                logger.warning("%s call failed: %s", layout, e)
+                continue
+            result.latencies.append(time.perf_counter() - started)
+            usage = response.usage
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = getattr(details, "cached_tokens", None) or 0
+            result.prompt_tokens += usage.prompt_tokens
+            result.cached_tokens += cached
+            result.hits += 1 if cached else 0
+
+    started = time.perf_counter()
+    await asyncio.gather(*(converse(turns) for turns in conversations))
+    return result.report(time.perf_counter() - started)
+
+
+def build_conversations(args) -> List[List[Dict[str, List[Dict[str, str]]]]]:
+    rng = random.Random(args.seed)
+    conversations = []
+    for _ in range(args.users):
+        history: List[Dict[str, str]] = []
+        turns = []
+        for _ in range(args.turns):
+            turn = _turn(rng)
+            turns.append(_prompts(history, turn, rng, args.feedback_window))
+            history += [{"role": "user", "content": turn["question"]},
+                        {"role": "assistant", "content": turn["answer"]}]
+        conversations.append(turns)
+    return conversations
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare prompt-cache hit rates of the old and static-first prompt layouts.")
+    parser.add_argument("--llm-url", default=os.getenv("OPENAI_BASE_URL", "http://localhost:8100/v1"))
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--feedback-window", type=int, default=20, help="history messages offered to the packer")
+    parser.add_argument("--prompt-ms-per-1k", type=float, default=None,
+                        help="set the stub's latency per 1k uncached prompt tokens")
+    parser.add_argument("--cache-min-tokens", type=int, default=None,
+                        help="set the stub's minimum cacheable prompt length (1024 like OpenAI by default)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json-out", default=None)
+    return parser.parse_args(argv)
+
+
+async def _main(args) -> int:
+    # the gateway creates its OpenAI client lazily, from the environment
+    os.environ["OPENAI_BASE_URL"] = args.llm_url
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("LLM_HEDGE", "false")
+    # both layouts send the same tokens; keep the gateway's TPM budget from skewing the second run
+    os.environ.setdefault("LLM_CHAT_TPM", "0")
+    from services.llm_gateway import llm
+
+    stub = args.llm_url.rstrip("/").rsplit("/v1", 1)[0]
+    conversations = build_conversations(args)
+    report: Dict[str, Any] = {}
+    async with httpx.AsyncClient(timeout=10) as client:
+        try:
+            for layout in ("legacy", "static"):
+                config: Dict[str, Any] = {"clear_prompt_cache": True}
+                if args.prompt_ms_per_1k is not None:
+                    config["prompt_ms_per_1k"] = args.prompt_ms_per_1k
+                if args.cache_min_tokens is not None:
+                    config["cache_min_tokens"] = args.cache_min_tokens
+                (await client.post(f"{stub}/config", json=config)).raise_for_status()
+                report[layout] = await run_layout(layout, conversations)
+                if layout != "legacy":
+                    print()
+                print(format_table(f"{layout} layout ({args.users} users x {args.turns} turns)", report[layout]))
+        finally:
+            await llm.aclose()
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0 if all(r["errors"] == 0 for r in report.values()) else 1
+
+
+def main(argv=None) -> None:
+    sys.exit(asyncio.run(_main(parse_args(argv))))
+
+
+if __name__ == "__main__":
+    main()
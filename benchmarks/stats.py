@@ -0,0 +1,46 @@
+"""
+Small latency-statistics helpers shared by the benchmark harnesses.
+"""
+
+import math
+from typing import Dict, List, Sequence
+
+
+def percentile(sorted_values: Sequence[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted sequence.
+    Returns 0.0 for an empty sequence.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies: List[float], elapsed: float, errors: int = 0) -> Dict[str, float]:
+    """
+    Summarize per-request latencies (seconds) collected over `elapsed` wall-clock seconds.
+    Latencies are reported in milliseconds.
+    """
+    values = sorted(latencies)
+    count = len(values)
+    return {
+        "requests": count + errors,
+        "ok": count,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(count / elapsed, 2) if elapsed > 0 else 0.0,
+        "mean_ms": round(sum(values) / count * 1000, 2) if count else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if count else 0.0,
+    }
+
+
+def format_table(title: str, rows: Dict[str, object]) -> str:
+    width = max((len(k) for k in rows), default=0)
+    lines = [title, "-" * len(title)]
+    for key, value in rows.items():
+        lines.append(f"{key.ljust(width)}  {value}")
+    return "\n".join(lines)
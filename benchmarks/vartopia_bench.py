@@ -0,0 +1,182 @@
+"""
+Throughput benchmark for the Vartopia client stack (pooling, retries, batching, caching).
+
+Runs api_client in-process against benchmarks/vartopia_mock.py (or any
+compatible base URL) and reports:
+
+- upsert: bulk_upsert of --deals synthetic deals with --batch-size / --concurrency
+  (use --batch-size 1 --concurrency 1 for the one-deal-at-a-time baseline).
+- poll:   --pollers concurrent workers calling get_registration_updates for
+  --ids distinct deals, through the TTL cache + single-flight layer
+  (--no-cache bypasses the cache to measure raw polling).
+
+Upstream calls, status codes, peak concurrency and TCP connections opened are
+read from the mock's /stats endpoint, so pooling and retry behaviour are
+visible alongside client-side latency.
+
+Usage:
+    python -m benchmarks.vartopia_mock --port 8200 &
+    python -m benchmarks.vartopia_bench --scenario all --deals 5000 --batch-size 100 --concurrency 8
+    python -m benchmarks.vartopia_bench --scenario poll --pollers 64 -n 20000 --no-cache
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+from benchmarks.stats import format_table, summarize
+
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING,
+                    format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def _deal(i: int) -> Dict[str, Any]:
+    return {
+        "programName": "Bench Program",
+        "source": "benchmark",
+        "uniqueID": f"BENCH-{i:07d}",
+        "vendorName": f"Vendor {i % 50}",
+        "CommonFields": {"dealName": f"Bench deal {i}", "amount": 1000 + i % 9000},
+    }
+
+
+async def _mock_stats(base_url: str, reset: bool = False) -> Optional[Dict[str, Any]]:
+    try:
+        async with httpx.AsyncClient(timeout=5.0) as c:
+            if reset:
+                await c.post(f"{base_url}/stats/reset")
+            return (await c.get(f"{base_url}/stats")).json()
+    except Exception:
+        logger.warning("Could not read mock stats from %s (not the bundled mock?)", base_url)
+        return None
+
+
+def _upstream_rows(stats: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not stats:
+        return {}
+    rows: Dict[str, Any] = {
+        "upstream_tcp_connections": stats.get("tcp_connections"),
+        "upstream_peak_concurrency": stats.get("peak_concurrency"),
+    }
+    for endpoint, s in stats.get("endpoints", {}).items():
+        name = endpoint.rsplit("/", 1)[-1]
+        rows[f"{name}_calls"] = s["calls"]
+        rows[f"{name}_status"] = ", ".join(f"{k}:{v}" for k, v in sorted(s["status"].items()))
+    return rows
+
+
+async def run_upsert(args, with_token) -> Dict[str, Any]:
+    from api_client import bulk
+
+    await _mock_stats(args.base_url, reset=True)
+    started = time.perf_counter()
+    result = await bulk.bulk_upsert(
+        with_token=with_token,
+        user_email="bench@bench.local",
+        deals=(_deal(i) for i in range(args.deals)),
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+    )
+    elapsed = time.perf_counter() - started
+    rows = {
+        "deals": result["total"],
+        "succeeded": result["succeeded"],
+        "failed": result["failed"],
+        "elapsed_s": round(elapsed, 3),
+        "deals_per_s": round(result["total"] / elapsed, 1) if elapsed else 0.0,
+    }
+    rows.update(_upstream_rows(await _mock_stats(args.base_url)))
+    return rows
+
+
+async def run_poll(args, with_token) -> Dict[str, Any]:
+    from api_client import bulk, updates
+
+    # make sure the polled deals exist upstream
+    await bulk.bulk_upsert(with_token, "bench@bench.local", (_deal(i) for i in range(args.ids)),
+                           batch_size=100, concurrency=4)
+    await _mock_stats(args.base_url, reset=True)
+
+    latencies, errors = [], 0
+    remaining = args.requests
+
+    async def poller():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            key = (f"BENCH-{random.randrange(args.ids):07d}", "", "")
+            started = time.perf_counter()
+            try:
+                await updates.fetch(with_token, "bench", key, refresh=args.no_cache)
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(poller() for _ in range(args.pollers)))
+    rows: Dict[str, Any] = dict(summarize(latencies, time.perf_counter() - started, errors))
+    rows.update(_upstream_rows(await _mock_stats(args.base_url)))
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark bulk upsert and update polling against the Vartopia mock.")
+    parser.add_argument("--base-url", default=os.getenv("VARTOPIA_API_BASE_URL", "http://localhost:8200"))
+    parser.add_argument("--scenario", choices=["upsert", "poll", "all"], default="all")
+    parser.add_argument("--deals", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4, help="upsert chunks in flight")
+    parser.add_argument("--ids", type=int, default=200, help="distinct deals polled")
+    parser.add_argument("--pollers", type=int, default=32)
+    parser.add_argument("-n", "--requests", type=int, default=5000, help="total poll calls")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the registration-update cache")
+    parser.add_argument("--json-out", default=None)
+    return parser.parse_args(argv)
+
+
+async def _main(args) -> int:
+    # the client reads its configuration at import time
+    os.environ["VARTOPIA_API_BASE_URL"] = args.base_url
+    os.environ.setdefault("VARTOPIA_TOKEN_REDIS", "false")
+    from api_client import auth, http
+
+    def with_token(call):
+        return auth.token_manager.call_with_token("bench", "bench", call)
+
+    report: Dict[str, Any] = {}
+    await http.open_client()
+    try:
+        if args.scenario in ("upsert", "all"):
+            report["upsert"] = await run_upsert(args, with_token)
+            print(format_table(f"bulk upsert (batch {args.batch_size}, concurrency {args.concurrency})",
+                               report["upsert"]))
+        if args.scenario in ("poll", "all"):
+            if report:
+                print()
+            report["poll"] = await run_poll(args, with_token)
+            cache = "no cache" if args.no_cache else "cached"
+            print(format_table(f"update polling ({args.pollers} pollers, {args.ids} ids, {cache})", report["poll"]))
+    finally:
+        await http.close_client()
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+def main(argv=None) -> None:
+    sys.exit(asyncio.run(_main(parse_args(argv))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Local stand-in for the Vartopia partner API.
+
+Implements the endpoints api_client uses:
+    POST /api/Account/Login                     -> Tokens (AccessToken/RefreshToken/ATExpirationTime)
+    POST /api/Account/RefreshToken              -> rotated Tokens
+    POST /api/DealReg/Upsert                    -> per-deal results keyed by uniqueID
+    GET  /api/DealReg/GetRegistrationUpdatesList -> updates for a previously upserted deal
+    GET  /stats, POST /stats/reset              -> call/status counts, peak concurrency, TCP connections
+    GET  /config, POST /config                  -> read / change fault injection at runtime
+
+Bearer tokens are checked, so token caching and refresh are exercised too.
+Faults are injected per request, before any work is done:
+    latency (+ jitter) per endpoint, a 429 rate (with Retry-After), a 5xx rate,
+    a concurrency ceiling above which requests get 429, and a max Upsert batch.
+
+Point the services at it with:
+    VARTOPIA_API_BASE_URL=http://localhost:8200
+
+Usage:
+    python -m benchmarks.vartopia_mock --port 8200 --latency-ms 80 --rate-429 0.02 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import secrets
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+CONFIG: Dict[str, Any] = {
+    "login_latency_ms": float(os.getenv("VARTOPIA_MOCK_LOGIN_LATENCY_MS", "150")),
+    "upsert_latency_ms": float(os.getenv("VARTOPIA_MOCK_UPSERT_LATENCY_MS", "120")),
+    "upsert_per_deal_ms": float(os.getenv("VARTOPIA_MOCK_UPSERT_PER_DEAL_MS", "2")),
+    "updates_latency_ms": float(os.getenv("VARTOPIA_MOCK_UPDATES_LATENCY_MS", "80")),
+    "jitter_ms": float(os.getenv("VARTOPIA_MOCK_JITTER_MS", "20")),
+    "rate_429": float(os.getenv("VARTOPIA_MOCK_RATE_429", "0")),
+    "retry_after_s": float(os.getenv("VARTOPIA_MOCK_RETRY_AFTER_S", "0.5")),
+    "error_rate": float(os.getenv("VARTOPIA_MOCK_ERROR_RATE", "0")),
+    "max_concurrency": int(os.getenv("VARTOPIA_MOCK_MAX_CONCURRENCY", "0")),
+    "max_batch": int(os.getenv("VARTOPIA_MOCK_MAX_BATCH", "500")),
+    "token_ttl_s": float(os.getenv("VARTOPIA_MOCK_TOKEN_TTL_S", "3600")),
+}
+
+app = FastAPI(title="Vartopia API mock")
+
+_tokens: Dict[str, str] = {}          # access token -> username
+_refresh_tokens: Dict[str, str] = {}  # refresh token -> username
+_deals: Dict[str, Dict[str, Any]] = {}
+_stats: Dict[str, Any] = {}
+_connections: set = set()
+_in_flight = 0
+
+
+def _reset_stats() -> None:
+    _stats.clear()
+    _stats.update({"endpoints": {}, "peak_concurrency": 0, "deals_upserted": 0})
+    _connections.clear()
+
+
+_reset_stats()
+
+
+def _record(endpoint: str, status: int, elapsed: float) -> None:
+    s = _stats["endpoints"].setdefault(endpoint, {"calls": 0, "seconds": 0.0, "status": {}})
+    s["calls"] += 1
+    s["seconds"] += elapsed
+    s["status"][str(status)] = s["status"].get(str(status), 0) + 1
+
+
+async def _sleep(base_ms: float) -> None:
+    jitter = random.uniform(-CONFIG["jitter_ms"], CONFIG["jitter_ms"]) if CONFIG["jitter_ms"] else 0.0
+    delay = max(0.0, base_ms + jitter) / 1000.0
+    if delay:
+        await asyncio.sleep(delay)
+
+
+def _issue_tokens(username: str) -> Dict[str, Any]:
+    access, refresh = secrets.token_urlsafe(24), secrets.token_urlsafe(24)
+    _tokens[access] = username
+    _refresh_tokens[refresh] = username
+    expires = datetime.now(timezone.utc) + timedelta(seconds=CONFIG["token_ttl_s"])
+    return {"AccessToken": access, "RefreshToken": refresh, "ATExpirationTime": expires.isoformat()}
+
+
+def _injected_fault() -> Optional[JSONResponse]:
+    if CONFIG["max_concurrency"] and _in_flight > CONFIG["max_concurrency"]:
+        return JSONResponse({"message": "Too many concurrent requests"}, status_code=429,
+                            headers={"Retry-After": str(CONFIG["retry_after_s"])})
+    if CONFIG["rate_429"] and random.random() < CONFIG["rate_429"]:
+        return JSONResponse({"message": "Rate limit exceeded"}, status_code=429,
+                            headers={"Retry-After": str(CONFIG["retry_after_s"])})
+    if CONFIG["error_rate"] and random.random() < CONFIG["error_rate"]:
+        return JSONResponse({"message": "Injected failure"}, status_code=random.choice([500, 502, 503]))
+    return None
+
+
+def _authorized(request: Request) -> bool:
+    auth = request.headers.get("Authorization", "")
+    return auth.startswith("Bearer ") and auth[7:] in _tokens
+
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    global _in_flight
+    if not request.url.path.startswith("/api/"):
+        return await call_next(request)
+
+    started = time.perf_counter()
+    if request.client:
+        _connections.add((request.client.host, request.client.port))
+    _in_flight += 1
+    _stats["peak_concurrency"] = max(_stats["peak_concurrency"], _in_flight)
+    try:
+        response = _injected_fault() or await call_next(request)
+    finally:
+        _in_flight -= 1
+    _record(request.url.path, response.status_code, time.perf_counter() - started)
+    return response
+
+
+@app.post("/api/Account/Login")
+async def login(request: Request):
+    body = await request.json()
+    username = body.get("Username") or body.get("username")
+    password = body.get("Password") or body.get("password")
+    await _sleep(CONFIG["login_latency_ms"])
+    if not username or not password:
+        return JSONResponse({"message": "Invalid credentials"}, status_code=401)
+    return {"Data": {"Email": f"{username}@bench.local", "Tokens": _issue_tokens(username)}}
+
+
+@app.post("/api/Account/RefreshToken")
+async def refresh(request: Request):
+    body = await request.json()
+    await _sleep(CONFIG["login_latency_ms"])
+    username = _refresh_tokens.pop(body.get("RefreshToken") or "", None)
+    if username is None:
+        return JSONResponse({"message": "Invalid refresh token"}, status_code=401)
+    _tokens.pop(body.get("AccessToken") or "", None)
+    return {"Data": {"Email": f"{username}@bench.local", "Tokens": _issue_tokens(username)}}
+
+
+@app.post("/api/DealReg/Upsert")
+async def upsert(request: Request):
+    if not _authorized(request):
+        return JSONResponse({"message": "Unauthorized"}, status_code=401)
+    deals = await request.json()
+    if not isinstance(deals, list):
+        return JSONResponse({"message": "Body must be a list of deals"}, status_code=422)
+    if len(deals) > CONFIG["max_batch"]:
+        return JSONResponse({"message": f"Batch larger than {CONFIG['max_batch']}"}, status_code=422)
+    await _sleep(CONFIG["upsert_latency_ms"] + CONFIG["upsert_per_deal_ms"] * len(deals))
+
+    results = []
+    for deal in deals:
+        unique_id = str(deal.get("uniqueID") or uuid.uuid4())
+        existing = _deals.get(unique_id)
+        record = {
+            "uniqueID": unique_id,
+            "vartopiaTransactionId": existing["vartopiaTransactionId"] if existing else f"VT-{uuid.uuid4().hex[:10]}",
+            "status": "Submitted",
+            "updatedAt": datetime.now(timezone.utc).isoformat(),
+        }
+        _deals[unique_id] = record
+        results.append({"uniqueID": unique_id, "success": True, "vartopiaTransactionId": record["vartopiaTransactionId"]})
+    _stats["deals_upserted"] += len(deals)
+    return {"success": True, "Data": results, "errors": []}
+
+
+@app.get("/api/DealReg/GetRegistrationUpdatesList")
+async def registration_updates(request: Request, uniqueID: str = "", varCrmOpportunityId: str = "",
+                               vartopiaTransactionId: str = ""):
+    if not _authorized(request):
+        return JSONResponse({"message": "Unauthorized"}, status_code=401)
+    await _sleep(CONFIG["updates_latency_ms"])
+    record = _deals.get(uniqueID)
+    if record is None and vartopiaTransactionId:
+        record = next((d for d in _deals.values() if d["vartopiaTransactionId"] == vartopiaTransactionId), None)
+    return {"success": True, "Data": [record] if record else []}
+
+
+@app.get("/stats")
+def stats():
+    return {**_stats, "tcp_connections": len(_connections), "deals_stored": len(_deals)}
+
+
+@app.post("/stats/reset")
+def reset_stats():
+    _reset_stats()
+    return {"status": "reset"}
+
+
+@app.get("/config")
+def get_config():
+    return CONFIG
+
+
+@app.post("/config")
+async def update_config(request: Request):
+    updates = await request.json()
+    for key, value in updates.items():
+        if key in CONFIG:
+            CONFIG[key] = type(CONFIG[key])(value)
+    return CONFIG
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "config": CONFIG}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Run a local Vartopia API stand-in.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--latency-ms", type=float, default=None,
+                        help="shortcut: base latency for upsert and updates endpoints")
+    parser.add_argument("--jitter-ms", type=float, default=CONFIG["jitter_ms"])
+    parser.add_argument("--rate-429", type=float, default=CONFIG["rate_429"], help="probability of a 429 per request")
+    parser.add_argument("--retry-after", type=float, default=CONFIG["retry_after_s"])
+    parser.add_argument("--error-rate", type=float, default=CONFIG["error_rate"], help="probability of a 5xx per request")
+    parser.add_argument("--max-concurrency", type=int, default=CONFIG["max_concurrency"],
+                        help="answer 429 above this many concurrent requests (0 = unlimited)")
+    parser.add_argument("--max-batch", type=int, default=CONFIG["max_batch"])
+    parser.add_argument("--token-ttl", type=float, default=CONFIG["token_ttl_s"])
+    args = parser.parse_args(argv)
+
+    if args.latency_ms is not None:
+        CONFIG["upsert_latency_ms"] = CONFIG["updates_latency_ms"] = args.latency_ms
+    CONFIG.update({
+        "jitter_ms": args.jitter_ms,
+        "rate_429": args.rate_429,
+        "retry_after_s": args.retry_after,
+        "error_rate": args.error_rate,
+        "max_concurrency": args.max_concurrency,
+        "max_batch": args.max_batch,
+        "token_ttl_s": args.token_ttl,
+    })
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,14 @@
 from mcp.server.fastmcp import FastMCP
 from fastapi import FastAPI,HTTPException, Request, Body
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response
 from pydantic import BaseModel
-from typing import Optional,List
+from typing import Optional,List,Union
 import uvicorn
 from dotenv import load_dotenv
 import logging
 import asyncio
+import math
 import socket
 from pydantic import BaseModel
 
@@ -20,6 +22,14 @@ from services.tool_registry import get_available_tools
 from mcp_tools import vartopia_tools
 
 from services.feedback_memory import add_feedback
+from services.feedback_retention import feedback_retention
+from services import deadline, metrics, tracing
+from services.admission import AdmissionRejected, admission
+from services.llm_gateway import llm
+from sdk import json_codec
+from sdk.stdio_transport import (DEADLINE_EXCEEDED, INVALID_REQUEST, PARSE_ERROR, RATE_LIMITED, SERVER_ERROR,
+                                 SERVER_OVERLOADED, error_response)
+from api_client import http as vartopia_http
 
 from sdk.tool_router import register_vartopia_tools, ToolRouter
 
@@ -29,6 +39,7 @@ load_dotenv()
 
 app = FastAPI(title="MCP SQL Agent Server", root_path="/api")
 
+app.add_middleware(tracing.TracingMiddleware, service_name="backend")
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
@@ -36,7 +47,23 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+
+
+@app.on_event("startup")
+async def open_http_clients():
+    await vartopia_http.open_client()
+    feedback_retention.start()
+
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await feedback_retention.stop()
+    await vartopia_http.close_client()
+    await llm.aclose()
+
+
 memory_manager = MCPMemoryManager()
+metrics.track_redis_pool("chat_memory", memory_manager.redis)
 # tools_list = get_available_tools()
 # tools = {tool.name: tool for tool in tools_list}
 # for tool in tools_list:
@@ -188,56 +215,148 @@ def handle_smalltalk(user_prompt:str)->Optional[str]:
     
     return None
 
+def _codec_response(content, status_code: int = 200, headers: Optional[dict] = None) -> Response:
+    return Response(content=json_codec.dumps(content), status_code=status_code, headers=headers,
+                     media_type="application/json")
+
+
+def _rejection_status(result) -> Optional[int]:
+    """429/503 when the turn was refused by the rate limiter or admission control, else None."""
+    if isinstance(result, dict) and result.get("rate_limited"):
+        return result.get("status", 429)
+    return None
+
+
+def _retry_after_header(result: dict) -> str:
+    return str(max(1, math.ceil(result.get("retry_after") or 1)))
+
+
+def _rejection_rpc_error(request_id, result: dict) -> dict:
+    code = RATE_LIMITED if _rejection_status(result) == 429 else SERVER_OVERLOADED
+    return error_response(request_id, code, result["error"], {"retryAfter": result.get("retry_after")})
+
+
+def _deadline_rpc_error(request_id, e: deadline.DeadlineExceeded) -> dict:
+    return error_response(request_id, DEADLINE_EXCEEDED, "Deadline exceeded", {"detail": str(e)})
+
+
+def _turn_timeout(request: Request) -> float:
+    """Per-turn budget: AGENT_TURN_TIMEOUT, or a shorter X-Request-Timeout (seconds) from the caller."""
+    try:
+        requested = float(request.headers.get("X-Request-Timeout", ""))
+    except ValueError:
+        return deadline.TURN_TIMEOUT
+    return min(deadline.TURN_TIMEOUT, requested) if requested > 0 else deadline.TURN_TIMEOUT
+
+
+async def _run_agent(user_id: str, messages: list, trace_meta: Optional[dict],
+                     timeout: float = deadline.TURN_TIMEOUT) -> Union[str, dict]:
+    """
+    The agent's answer text, or a rejection dict ({"error", "rate_limited",
+    "status", "retry_after"}) when the rate limiter or admission control
+    refused the turn; callers check it with _rejection_status().
+    """
+    chat_messages = [ChatMessage(**m) for m in messages]
+    with tracing.span("agent.run", meta=trace_meta, user_id=user_id), deadline.budget(timeout):
+        try:
+            async with admission.admit(user_id, deadline=deadline.current()):
+                return await agent.run(
+                    user_id=user_id,
+                    messages=chat_messages,
+                    use_memory=True
+                )
+        except AdmissionRejected as e:
+            message = "Too many requests in progress for this user." if e.status == 429 else "Server busy, please retry."
+            return {"error": message, "rate_limited": True, "status": e.status, "retry_after": round(e.retry_after, 3)}
+
+
+async def _ask_agent_rpc(item, timeout: float) -> Optional[dict]:
+    """Handle one JSON-RPC request (or batch member); returns None for notifications."""
+    if not isinstance(item, dict) or "params" not in item:
+        return error_response(None, INVALID_REQUEST, "Invalid Request")
+    request_id = item.get("id")
+    params = item.get("params") or {}
+    try:
+        result_text = await _run_agent(params.get("user_id", "default"), params.get("messages", []),
+                                       params.get("_meta"), timeout)
+        if _rejection_status(result_text) and request_id is not None:
+            return _rejection_rpc_error(request_id, result_text)
+    except deadline.DeadlineExceeded as e:
+        logging.warning(f"ask_agent turn timed out: {e}")
+        return _deadline_rpc_error(request_id, e) if request_id is not None else None
+    except Exception as e:
+        logging.error(f"Error in ask_agent: {e}")
+        if request_id is None:
+            return None
+        return error_response(request_id, SERVER_ERROR, str(e), {"type": e.__class__.__name__})
+    if request_id is None:
+        return None
+    return {"jsonrpc": "2.0", "id": request_id, "result": {"response": result_text}}
+
+
 #main endpoint
 @app.post("/ask_agent")
 async def ask_agent(request: Request):
     try:
-        data = await request.json()
+        try:
+            data = json_codec.loads(await request.body())
+        except json_codec.DecodeError:
+            return _codec_response(error_response(None, PARSE_ERROR, "Parse error"), status_code=400)
         logging.info(f"Incoming request: {data}")
 
+        # JSON-RPC batch: members run concurrently, answered with one array
+        if isinstance(data, list):
+            if not data:
+                return _codec_response(error_response(None, INVALID_REQUEST, "Invalid Request"), status_code=400)
+            timeout = _turn_timeout(request)
+            results = await asyncio.gather(*(_ask_agent_rpc(item, timeout) for item in data))
+            responses = [r for r in results if r is not None]
+            return _codec_response(responses) if responses else Response(status_code=204)
+
         # Check if JSON-RPC (Claude-style)
         if "jsonrpc" in data and "params" in data:
             request_id = data.get("id")
             params = data.get("params", {})
             user_id = params.get("user_id", "default")
             messages = params.get("messages", [])
+            trace_meta = params.get("_meta")
 
         # Otherwise assume React frontend format
         else:
             request_id = None
             user_id = data.get("user_id", "default")
             messages = data.get("messages", [])
-            
-        chat_messages = [ChatMessage(**m) for m in messages]
+            trace_meta = None
 
         # Run the agent
-        result_text = await agent.run(
-            user_id=user_id,
-            messages=chat_messages,
-            use_memory=True
-        )
-        
-        # if asyncio.iscoroutine(result):
-        #     result =await result
+        try:
+            result_text = await _run_agent(user_id, messages, trace_meta, _turn_timeout(request))
+        except deadline.DeadlineExceeded as e:
+            logging.warning(f"ask_agent turn for {user_id} timed out: {e}")
+            if request_id is not None:
+                return _codec_response(_deadline_rpc_error(request_id, e), status_code=504)
+            return _codec_response({"error": str(e)}, status_code=504)
+
+        rejected = _rejection_status(result_text)
+        if rejected:
+            headers = {"Retry-After": _retry_after_header(result_text)}
+            if request_id is not None:
+                body = _rejection_rpc_error(request_id, result_text)
+            else:
+                body = {"error": result_text["error"], "retry_after": result_text.get("retry_after")}
+            return _codec_response(body, status_code=rejected, headers=headers)
 
         # Return response in JSON-RPC if Claude frontend
         if request_id is not None:
-            return {
+            return _codec_response({
                 "jsonrpc": "2.0",
                 "id": request_id,
                 "result": {"response": result_text}
-            }
+            })
 
         # Otherwise return simple response for React
-        return {"response": result_text} 
-
-        # result = await agent.run(
-        #     user_id=query.user_id,
-        #     messages=query.messages,
-        #     use_memory=query.use_memory
-        # )
-        # return {"response":result}
-    
+        return _codec_response({"response": result_text})
+
     except Exception as e:
         logging.error(f"Error in ask_agent: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -270,10 +389,11 @@ async def run_tool(tool_name:str, request:Request):
     #     raise HTTPException(status_code=400, detail="action is required")
 
     try:
-        if asyncio.iscoroutinefunction(tool.run):
-            result=await tool.run(body)
-        else:
-            result=tool.run(body)
+        with metrics.observe_tool(tool_name):
+            if asyncio.iscoroutinefunction(tool.run):
+                result=await tool.run(body)
+            else:
+                result=tool.run(body)
 
         return {"status": "success", "data": result}
         
@@ -305,7 +425,8 @@ async def submit_feedback(feedback_request: FeedbackRequest):
 @app.get("/get_sessions/{user_id}")
 def get_sessions(user_id: str):
     try:
-        history = memory_manager.get_history(user_id)
+        # the chat UI shows result rows, not the summaries kept for prompts
+        history = memory_manager.get_history(user_id, resolve_results=True)
         return {"sessions": [{"id": 1, "title": "Chat History", "messages": history}]}
     except Exception as e:
         return {"error": str(e)}
@@ -323,6 +444,11 @@ import socket
 @app.get("/health")
 def health_check():
     return {"status": "ok", "instance": socket.gethostname()}
+
+#prometheus scrape target---http://localhost/api/metrics
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render_latest(), media_type=metrics.CONTENT_TYPE_LATEST)
     
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000)
\ No newline at end of file
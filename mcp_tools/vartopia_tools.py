@@ -1,11 +1,30 @@
 from sdk.tool import BaseTool
 from fastapi import HTTPException
-from api_client import client
+from api_client import auth, bulk, client, updates
 import logging
 import json
+import os
+from typing import Any, Awaitable, Callable, Dict
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_SESSION = "default"
+# JSONL files for bulk_upsert_deals must live under this directory
+BULK_DIR = os.path.realpath(os.getenv("VARTOPIA_BULK_DIR", "data/bulk"))
+
+REQUIRED_DEAL_KEYS = [
+    "CommonFields", "CustomFields", "extensionAndRegUpdateDetails",
+    "PrimarySalesRepDetails", "SubmitterDetails", "CustomerDetails",
+    "ReviewerDetails", "flags"
+]
+
+
+def _with_required_keys(deal_data: dict) -> dict:
+    for key in REQUIRED_DEAL_KEYS:
+        if key not in deal_data:
+            deal_data[key]={}
+    return deal_data
+
 class VartopiaTool(BaseTool):
     """
     MCP Tool to interact with Vartopia API.
@@ -15,59 +34,53 @@ class VartopiaTool(BaseTool):
     def __init__(self):
         super().__init__(
             name="VartopiaTool",
-            description="Handles all Vartopia API actions: login, upsert_deal, get_updates, list_vendors, list_programs",
+            description="Handles all Vartopia API actions: login, upsert_deal, bulk_upsert_deals, get_updates, get_updates_bulk, list_vendors, list_programs",
             run_func=self.run
         )
-        self.access_token = None
-        # self.user_email = None
-        # self.username=None
-        # self.password=None
+        # per-user credentials; tokens themselves live in auth.token_manager
+        self.sessions: Dict[str, Dict[str, Any]] = {}
+
+    def _session(self, session_id: str) -> Dict[str, Any]:
+        session = self.sessions.get(session_id)
+        if not session:
+            raise HTTPException(status_code=401, detail="Not logged in. Call login first.")
+        return session
 
-    async def login(self, username: str, password: str):
+    async def _with_token(self, session_id: str, call: Callable[[str], Awaitable[Any]]) -> Any:
+        """Run call(access_token) for the session; a 401 triggers one re-login and retry."""
+        session = self._session(session_id)
+        return await auth.token_manager.call_with_token(session["username"], session["password"], call)
+
+    async def login(self, username: str, password: str, session_id: str = DEFAULT_SESSION):
         if not username or not password:
             raise HTTPException(status_code=400, detail="username and password are required for login")
         
         logger.info(f"Attempting login with username={username} password={'*' * len(password)}")
         try:
-            login_response = await client.login(username, password)
-            
-            
-            if isinstance(login_response, str):
-                try:
-                    login_response = json.loads(login_response)
-                except Exception as e:
-                    logger.error("Failed to parse login response JSON")
-                    raise HTTPException(status_code=500, detail=f"Invalid login response: {str(e)}")
-                
-            tokens = login_response.get("Tokens") or login_response.get("Data", {}).get("Tokens") or login_response.get("detail",{}).get("details",{}).get("Data",{}).get("Tokens")
-            
-            if not tokens or "AccessToken" not in tokens:
-                raise HTTPException(
-                    status_code=401,
-                    detail=f"No AccessToken returned. Full login response: {login_response}"
-                )
-
-            self.access_token = tokens["AccessToken"]
-            self.user_email = login_response.get("Email") or login_response.get("Data", {}).get("Email")
+            tokens = await auth.token_manager.get_tokens(username, password)
 
-            self.username=username
-            self.password=password
+            self.sessions[session_id] = {
+                "username": username,
+                "password": password,
+                "user_email": tokens.user_email,
+            }
             
-            logger.info(f"Login successful for {self.user_email}")
+            logger.info(f"Login successful for {tokens.user_email}")
             
             return {
                 "message": "Login successful",
-                "access_token": self.access_token,
-                "user_email": self.user_email,
+                "access_token": tokens.access_token,
+                "user_email": tokens.user_email,
             }
 
+        except HTTPException:
+            raise
         except Exception as e:
             logger.exception("Vartopia login failed")
             raise HTTPException(status_code=500, detail=str(e))
 
-    async def upsert_deal(self, deal_data: dict):
-        if not self.access_token:
-            raise HTTPException(status_code=401, detail="Not logged in. Call login first.")
+    async def upsert_deal(self, deal_data: dict, session_id: str = DEFAULT_SESSION):
+        self._session(session_id)
         
         if not deal_data:
             raise HTTPException(status_code=400, detail="deal_data is required")
@@ -77,43 +90,87 @@ class VartopiaTool(BaseTool):
         # payload={"deals":deal_data if isinstance(deal_data,list) else [deal_data]}
         # logger.info(f"Submitting deal data: {json.dumps(payload)}")
         
-        required_keys=[
-            "CommonFields", "CustomFields", "extensionAndRegUpdateDetails",
-            "PrimarySalesRepDetails", "SubmitterDetails", "CustomerDetails",
-            "ReviewerDetails", "flags"
-        ] 
-        for key in required_keys:
-            if key not in deal_data:
-                deal_data[key]={}
+        _with_required_keys(deal_data)
         
         payload = [deal_data] if isinstance(deal_data, dict) else deal_data
              
         try:
-            return await client.submit_deal(
-                access_token=self.access_token,
-                user_email=self.user_email, 
+            return await self._with_token(session_id, lambda access_token: client.submit_deal(
+                access_token=access_token,
+                user_email=self.sessions[session_id].get("user_email") or self.sessions[session_id]["username"],
                 deal_data=payload
-                )
+                ))
             
+        except HTTPException:
+            raise
         except Exception as e:
             logger.exception("upsert_deal failed")
             raise HTTPException(status_code=500, detail=str(e))
 
-    async def get_registration_updates(self, unique_id="", varcrm_opportunity_id="", vartopia_transaction_id=""):
-        if not self.access_token or not self.user_email:
-            raise HTTPException(status_code=401, detail="Not logged in. Call login first.")
+    async def get_registration_updates(self, unique_id="", varcrm_opportunity_id="", vartopia_transaction_id="",
+                                       session_id: str = DEFAULT_SESSION, refresh: bool = False):
+        session = self._session(session_id)
         try:
-            return await client.get_registration_updates(
-                access_token=self.access_token,
-                user_email=self.user_email,
-                unique_id=unique_id,
-                varcrm_opportunity_id=varcrm_opportunity_id,
-                vartopia_transaction_id=vartopia_transaction_id,
+            return await updates.fetch(
+                with_token=lambda call: self._with_token(session_id, call),
+                scope=session["username"],
+                key=(unique_id or "", varcrm_opportunity_id or "", vartopia_transaction_id or ""),
+                refresh=refresh,
             )
+        except HTTPException:
+            raise
         except Exception as e:
             logger.exception("get_registration_updates failed")
             raise HTTPException(status_code=500, detail=str(e))
 
+    async def get_registration_updates_bulk(self, params: dict, session_id: str = DEFAULT_SESSION):
+        """
+        Registration updates for many deals: params["ids"] is a list of unique_id strings or
+        {unique_id, varcrm_opportunity_id, vartopia_transaction_id} dicts. Results keyed by ID.
+        """
+        session = self._session(session_id)
+        ids = params.get("ids") or params.get("unique_ids")
+        if not ids or not isinstance(ids, list):
+            raise HTTPException(status_code=400, detail="ids must be a non-empty list")
+        return await updates.fetch_many(
+            with_token=lambda call: self._with_token(session_id, call),
+            scope=session["username"],
+            items=ids,
+            concurrency=params.get("concurrency") or updates.CONCURRENCY,
+            refresh=bool(params.get("refresh")),
+        )
+
+    async def bulk_upsert_deals(self, params: dict, session_id: str = DEFAULT_SESSION):
+        """
+        Upsert many deals: params["deals"] (list) or params["file"] (JSONL under VARTOPIA_BULK_DIR).
+        Optional batch_size / concurrency override the VARTOPIA_UPSERT_* defaults.
+        Returns totals plus per-deal results keyed by uniqueID.
+        """
+        session = self._session(session_id)
+        deals = params.get("deals")
+        path = params.get("file")
+
+        if deals is not None:
+            if not isinstance(deals, list) or not all(isinstance(d, dict) for d in deals):
+                raise HTTPException(status_code=400, detail="deals must be a list of deal objects")
+            source = deals
+        elif path:
+            resolved = os.path.realpath(os.path.join(BULK_DIR, path))
+            if os.path.commonpath([resolved, BULK_DIR]) != BULK_DIR or not os.path.isfile(resolved):
+                raise HTTPException(status_code=400, detail=f"file must be an existing JSONL file under {BULK_DIR}")
+            source = bulk.iter_jsonl(resolved)
+        else:
+            raise HTTPException(status_code=400, detail="deals or file is required for bulk_upsert_deals")
+
+        return await bulk.bulk_upsert(
+            with_token=lambda call: self._with_token(session_id, call),
+            user_email=session.get("user_email") or session["username"],
+            deals=source,
+            batch_size=params.get("batch_size") or bulk.BATCH_SIZE,
+            concurrency=params.get("concurrency") or bulk.CONCURRENCY,
+            prepare=_with_required_keys,
+        )
+
     # async def list_vendors(self):
     #     if not self.access_token or not self.user_email or not self.username or not self.password:
     #         raise HTTPException(status_code=401, detail="Not logged in. Call login first.")
@@ -165,7 +222,8 @@ class VartopiaTool(BaseTool):
             raise HTTPException(status_code=400, detail="Input must be a dictionary")
 
         action = input.get("action")
-        # user_id = input.get("user_id")
+        # sessions are per user; callers without a user_id share the default session
+        session_id = str(input.get("user_id") or DEFAULT_SESSION)
         params = input.get("params", {})
 
         if isinstance(params, str):
@@ -179,21 +237,32 @@ class VartopiaTool(BaseTool):
         # if not user_id:
             # raise HTTPException(status_code=400, detail="user_id is required")
 
-        logger.info(f"Running action '{action}' with params: {params}")
+        if action in ["bulk_upsert_deals", "bulk_upsert"]:
+            logger.info(f"Running action '{action}' with {len(params.get('deals') or [])} inline deals, file={params.get('file')}")
+        else:
+            logger.info(f"Running action '{action}' with params: {params}")
 
         if action == "login":
-            return await self.login(params.get("username"),params.get("password"))
+            return await self.login(params.get("username"),params.get("password"), session_id=session_id)
 
         elif action == "upsert_deal":
-            return await self.upsert_deal(params)
+            return await self.upsert_deal(params, session_id=session_id)
+
+        elif action in ["bulk_upsert_deals", "bulk_upsert"]:
+            return await self.bulk_upsert_deals(params, session_id=session_id)
 
         elif action in ["get_updates","get_registration_updates"]:
             return await self.get_registration_updates(
                 unique_id=params.get("unique_id", ""),
                 varcrm_opportunity_id=params.get("varcrm_opportunity_id", ""),
                 vartopia_transaction_id=params.get("vartopia_transaction_id", ""),
+                session_id=session_id,
+                refresh=bool(params.get("refresh")),
             )
 
+        elif action in ["get_updates_bulk", "get_registration_updates_bulk"]:
+            return await self.get_registration_updates_bulk(params, session_id=session_id)
+
         # elif action == "list_vendors":
         #     return await self.list_vendors()
 
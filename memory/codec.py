@@ -0,0 +1,123 @@
+"""
+Pluggable binary codec for chat memory stored in Redis (memory.mcp_memory).
+
+Every encoded value starts with a one-byte format tag, so the codec can be
+switched (or a new format added) without migrating what is already stored:
+
+    0x01  JSON (sdk.json_codec)
+    0x02  msgpack
+    0x11  zlib-compressed JSON
+    0x12  zlib-compressed msgpack
+
+Values without a tag are the legacy format, plain JSON text, and are decoded
+as such. JSON only starts with a control byte if it is whitespace (tab, LF,
+CR), so tags and legacy values cannot be confused.
+
+The format for new values is chosen once at import time from MEMORY_CODEC:
+
+    auto     (default) msgpack if installed, else JSON
+    msgpack  requires `msgpack`
+    json     JSON via sdk.json_codec (orjson when available)
+
+Payloads of MEMORY_CODEC_COMPRESS_MIN bytes or more (default 512) are
+zlib-compressed when that makes them smaller. Values that cannot be
+serialised natively (Decimal, datetime, ...) fall back to str(), like
+json.dumps(..., default=str).
+"""
+
+import logging
+import os
+import zlib
+from typing import Any, Callable, Optional, Tuple, Union
+
+from sdk import json_codec
+
+logger = logging.getLogger(__name__)
+
+DecodeError = ValueError
+
+TAG_JSON = 0x01
+TAG_MSGPACK = 0x02
+TAG_ZLIB = 0x10
+_TAGS = frozenset((TAG_JSON, TAG_MSGPACK, TAG_JSON | TAG_ZLIB, TAG_MSGPACK | TAG_ZLIB))
+_JSON_WHITESPACE = frozenset(b"\t\n\r")
+COMPRESS_MIN = int(os.getenv("MEMORY_CODEC_COMPRESS_MIN", "512"))
+COMPRESS_LEVEL = 6
+
+
+def _json() -> Tuple[int, Callable[[Any], bytes], Callable[[bytes], Any]]:
+    return TAG_JSON, json_codec.dumps, json_codec.loads
+
+
+def _msgpack() -> Tuple[int, Callable[[Any], bytes], Callable[[bytes], Any]]:
+    import msgpack
+
+    def dumps(obj: Any) -> bytes:
+        return msgpack.packb(obj, default=str, use_bin_type=True)
+
+    def loads(data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    return TAG_MSGPACK, dumps, loads
+
+
+_BACKENDS = {"msgpack": _msgpack, "json": _json}
+
+
+def _select(name: str):
+    if name != "auto":
+        if name not in _BACKENDS:
+            raise ValueError(f"Unknown MEMORY_CODEC {name!r}; expected one of auto, {', '.join(_BACKENDS)}")
+        return name, _BACKENDS[name]()
+    try:
+        return "msgpack", _msgpack()
+    except ImportError:
+        return "json", _json()
+
+
+CODEC, (_TAG, _dumps, _loads) = _select(os.getenv("MEMORY_CODEC", "auto").lower())
+logger.debug("Memory codec: %s", CODEC)
+_decoders = {_TAG: _loads}
+
+
+def _decoder(tag: int) -> Callable[[bytes], Any]:
+    loads = _decoders.get(tag)
+    if loads is None:
+        name = "json" if tag == TAG_JSON else "msgpack"
+        try:
+            loads = _decoders[tag] = _BACKENDS[name]()[2]
+        except ImportError as e:
+            raise DecodeError(f"Stored value uses the {name} codec, which is not installed") from e
+    return loads
+
+
+def encode(obj: Any) -> bytes:
+    """Serialise `obj` to tagged bytes, compressed when that pays off."""
+    payload = _dumps(obj)
+    if len(payload) >= COMPRESS_MIN:
+        packed = zlib.compress(payload, COMPRESS_LEVEL)
+        if len(packed) < len(payload):
+            return bytes((_TAG | TAG_ZLIB,)) + packed
+    return bytes((_TAG,)) + payload
+
+
+def decode(data: Optional[Union[bytes, bytearray, memoryview, str]]) -> Any:
+    """Decode a value written by encode() or legacy JSON text; None stays None."""
+    if data is None:
+        return None
+    if isinstance(data, str):
+        return json_codec.loads(data)
+    data = bytes(data)
+    if not data:
+        raise DecodeError("Empty memory value")
+    tag = data[0]
+    if tag not in _TAGS:
+        if tag < 0x20 and tag not in _JSON_WHITESPACE:
+            raise DecodeError(f"Unknown memory codec tag 0x{tag:02x}")
+        return json_codec.loads(data)  # legacy: untagged JSON
+    if tag & TAG_ZLIB:
+        try:
+            return _decoder(tag & ~TAG_ZLIB)(zlib.decompress(data[1:]))
+        except zlib.error as e:
+            raise DecodeError(f"Corrupt compressed memory value: {e}") from e
+    return _decoder(tag)(data[1:])
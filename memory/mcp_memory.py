@@ -1,4 +1,5 @@
 import redis
+import hashlib
 import json
 import os
 import socket
@@ -6,11 +7,48 @@ from typing import List, Dict,Optional, Any
 from dotenv import load_dotenv
 import logging
 
+from memory import codec
+
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+RESULT_TTL_SECONDS = int(os.getenv("MEMORY_RESULT_TTL", str(24 * 3600)))
+# "summary": history holds a result's row count, columns and key IDs; "full": the whole result
+RESULT_MEMORY_MODE = os.getenv("SQL_RESULT_MEMORY_MODE", "summary").lower()
+SUMMARY_MAX_IDS = int(os.getenv("SQL_RESULT_SUMMARY_IDS", "10"))
+
+def summarize_rows(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Columns of a result set plus up to SUMMARY_MAX_IDS distinct values of each
+    id column ("id" or "*_id"), in row order.
+    """
+    columns = list(rows[0]) if isinstance(rows[0], dict) else []
+    ids: Dict[str, List[Any]] = {}
+    for column in columns:
+        if column == "id" or column.endswith("_id"):
+            values = list(dict.fromkeys(row.get(column) for row in rows if row.get(column) is not None))
+            ids[column] = values[:SUMMARY_MAX_IDS]
+    return {"columns": columns, "ids": ids}
+
 class MCPMemoryManager:
+    """
+    Short per-user chat history and last-used fields in Redis.
+
+    Values are written with memory.codec (tagged msgpack/JSON, compressed when
+    large); values in the old plain-JSON format are still read. SQL result
+    sets are not stored inline in the history: add_result() keeps them under
+    a content-addressed "result:<digest>" key (expiring after
+    MEMORY_RESULT_TTL seconds, default one day) and the history entry only
+    references it together with a summary (row count, columns, key IDs).
+
+    With SQL_RESULT_MEMORY_MODE=summary (default) get_history() returns that
+    summary and a pointer (result_ref) instead of the rows, so history reads
+    for prompts stay small whatever the result size; get_result() fetches the
+    rows while they are cached. Read paths that show history to users
+    (/get_sessions, MemoryQueryTool) pass resolve_results=True and still get
+    the rows. With SQL_RESULT_MEMORY_MODE=full the rows are always resolved.
+    """
     MAX_HISTORY=5
     
     def __init__(self, redis_url=None):
@@ -31,7 +69,8 @@ class MCPMemoryManager:
 
         logger.info(f"[MCPMemoryManager] Connecting to Redis at {redis_url}")
         try:
-            self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+            # raw bytes: values are codec-encoded, not UTF-8 text
+            self.redis = redis.Redis.from_url(redis_url)
             self.redis.ping()  # Test connection
             logger.info("[MCPMemoryManager] Redis connection successful")
         except redis.RedisError as e:
@@ -43,21 +82,66 @@ class MCPMemoryManager:
         Add a message to user's history and keep only last N messages.
         """
         if self.redis:
-            message = {"role": role, "content": content}
-            key = f"user:{user_id}:history"
-            self.redis.rpush(key, json.dumps(message))
-            self.redis.ltrim(key,-self.MAX_HISTORY,-1)
+            self._push(self.redis.pipeline(transaction=False), user_id, {"role": role, "content": content})
         else:
             logger.warning(f"[MCPMemoryManager] Skipped adding message — Redis unavailable.")
 
-    def get_history(self, user_id: str) -> List[Dict[str, str]]:
+    def add_result(self, user_id: str, response: Dict[str, Any], role: str = "assistant"):
+        """
+        Add a tool response to the history. A non-empty result set
+        (response["result"]) is stored once under its own key and referenced.
+        """
+        rows = response.get("result") if isinstance(response, dict) else None
+        if not isinstance(rows, list) or not rows:
+            return self.add_message(user_id, role=role, content=json.dumps(response))
+        if not self.redis:
+            logger.warning(f"[MCPMemoryManager] Skipped adding result — Redis unavailable.")
+            return
+        blob = codec.encode(response)
+        ref = f"result:{hashlib.blake2b(blob, digest_size=16).hexdigest()}"
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(ref, blob, ex=RESULT_TTL_SECONDS)
+        self._push(pipe, user_id, {"role": role, "result_ref": ref, "rows": len(rows), **summarize_rows(rows)})
+
+    def get_result(self, ref: str) -> Optional[Dict[str, Any]]:
+        """
+        The response stored by add_result() under `ref`, or None once it expired.
+        """
+        if not self.redis:
+            return None
+        return codec.decode(self.redis.get(ref))
+
+    def _push(self, pipe, user_id: str, message: Dict[str, Any]):
+        key = f"user:{user_id}:history"
+        pipe.rpush(key, codec.encode(message))
+        pipe.ltrim(key,-self.MAX_HISTORY,-1)
+        pipe.execute()
+
+    def get_history(self, user_id: str, resolve_results: Optional[bool] = None) -> List[Dict[str, str]]:
         """
         Get last N messages for the user.
+        SQL results come back as their summary, or in full with
+        resolve_results=True (default: SQL_RESULT_MEMORY_MODE).
         """
         if self.redis:
             key = f"user:{user_id}:history"
-            messages = self.redis.lrange(key, 0, -1)
-            return [json.loads(m) for m in messages]
+            messages = [codec.decode(m) for m in self.redis.lrange(key, 0, -1)]
+            if resolve_results is None:
+                resolve_results = RESULT_MEMORY_MODE == "full"
+            refs = [m["result_ref"] for m in messages if "result_ref" in m] if resolve_results else []
+            results = dict(zip(refs, self.redis.mget(refs))) if refs else {}
+            for m in messages:
+                ref = m.pop("result_ref", None)
+                if ref is None:
+                    continue
+                summary = {"rows": m.pop("rows", None), "columns": m.pop("columns", []), "ids": m.pop("ids", {})}
+                if not resolve_results:
+                    m["content"] = json.dumps({"result_summary": {**summary, "result_ref": ref}})
+                    continue
+                blob = results.get(ref)
+                response = codec.decode(blob) if blob is not None else {"info": "Result expired.", **summary}
+                m["content"] = json.dumps(response)
+            return messages
         else:
             logger.warning(f"[MCPMemoryManager] Redis unavailable — returning empty history.")
             return []
@@ -81,7 +165,7 @@ class MCPMemoryManager:
         key=f"user:{user_id}:last_fields"
         data=self.redis.get(key)
         if data:
-            return json.loads(data)
+            return codec.decode(data)
         return None
     
     def set_last_user_field(self,user_id:str,fields:Dict[str,Any]):
@@ -91,7 +175,7 @@ class MCPMemoryManager:
         if not self.redis:
             return None
         key=f"user:{user_id}:last_fields"
-        self.redis.set(key,json.dumps(fields))
+        self.redis.set(key,codec.encode(fields))
         
     def update_last_fields(self, user_id: str,new_fields: Dict[str,Any]):
         """
@@ -49,7 +49,8 @@ from typing import List, Tuple, Dict, Any, Optional
 from dotenv import load_dotenv
 import psycopg2
 from psycopg2.extras import register_default_json, Json
-from openai import AsyncOpenAI
+
+from services.llm_gateway import PRIORITY_BACKGROUND, llm
 
 load_dotenv()
 logger = logging.getLogger(__name__)
@@ -67,7 +68,6 @@ SUMMARY_TRIGGER_THRESHOLD = 50
 
 if not OPENAI_API_KEY:
     logger.warning("OPENAI_API_KEY not set. Embedding calls will fail until it's provided.")
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
 def _connect():
     """
@@ -185,7 +185,7 @@ async def embed_text(text:str)-> List[float]:
     if not OPENAI_API_KEY:
         raise RuntimeError("OPENAI_API_KEY not configured")
     try:
-        resp= await openai_client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        resp= await llm.embed(model=EMBEDDING_MODEL, input=text)
         emb= resp.data[0].embedding
         return emb
     except Exception as e:
@@ -193,11 +193,12 @@ async def embed_text(text:str)-> List[float]:
         raise
     
 async def store_message(user_id:int, message:str):
-    print(f" Storing message for user={user_id}: {message[:50]}...")
     """
     Create embedding and store message+embedding into chat_history.
     This runs DB work in a thread to avoid blocking.
     """
+    # log to stderr: stdout carries the JSON-RPC stream in stdio mode
+    logger.debug("Storing message for user=%s: %s...", user_id, message[:50])
     emb=await embed_text(message)
     await asyncio.to_thread(_insert_message_sync, user_id, message, emb)
     return True
@@ -236,7 +237,9 @@ async def summarize_user_history(user_id: int, sample_limit: int=50)-> str:
         "from chat messages. keep it concise, factual, and useful for future retrieval."
     )
     try: 
-        resp=await openai_client.chat.completions.create(
+        resp=await llm.chat(
+            "summarization",
+            priority=PRIORITY_BACKGROUND,
             model="gpt-4o-mini",
             messages=[
                 {"role":"system","content": system},
@@ -0,0 +1,80 @@
+"""
+Pluggable JSON encoder/decoder for the MCP transports (stdio and /ask_agent).
+
+The backend is chosen once at import time from MCP_JSON_CODEC:
+
+    auto     (default) orjson, then msgspec, then the stdlib
+    orjson   requires `orjson`
+    msgspec  requires `msgspec`
+    json     stdlib json
+
+All backends produce compact UTF-8 bytes and fall back to str() for values
+they cannot serialise natively (Decimal, UUID, ...), matching the previous
+json.dumps(..., default=str) behaviour. Decode errors are always ValueError
+subclasses, so callers can catch DecodeError regardless of backend.
+"""
+
+import json
+import logging
+import os
+from typing import Any, Callable, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+DecodeError = ValueError
+
+
+def _stdlib() -> Tuple[Callable[[Any], bytes], Callable[[Union[bytes, str]], Any]]:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+
+    return dumps, json.loads
+
+
+def _orjson() -> Tuple[Callable[[Any], bytes], Callable[[Union[bytes, str]], Any]]:
+    import orjson
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+    return dumps, orjson.loads
+
+
+def _msgspec() -> Tuple[Callable[[Any], bytes], Callable[[Union[bytes, str]], Any]]:
+    import msgspec
+
+    encoder = msgspec.json.Encoder(enc_hook=str)
+    decoder = msgspec.json.Decoder()
+    return encoder.encode, decoder.decode
+
+
+_BACKENDS = {"orjson": _orjson, "msgspec": _msgspec, "json": _stdlib}
+
+
+def _select(name: str):
+    if name != "auto":
+        if name not in _BACKENDS:
+            raise ValueError(f"Unknown MCP_JSON_CODEC {name!r}; expected one of auto, {', '.join(_BACKENDS)}")
+        return name, _BACKENDS[name]()
+    for candidate in ("orjson", "msgspec"):
+        try:
+            return candidate, _BACKENDS[candidate]()
+        except ImportError:
+            continue
+    return "json", _stdlib()
+
+
+CODEC, (_dumps, _loads) = _select(os.getenv("MCP_JSON_CODEC", "auto").lower())
+logger.debug("JSON codec: %s", CODEC)
+
+
+def dumps(obj: Any) -> bytes:
+    """Serialise `obj` to compact UTF-8 JSON bytes."""
+    return _dumps(obj)
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    """Parse JSON from bytes or str; raises DecodeError (ValueError) on malformed input."""
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return _loads(data)
@@ -0,0 +1,394 @@
+"""
+Stdio transport and concurrent JSON-RPC dispatch for the MCP servers.
+
+serve_stdio(handler) is the single implementation behind both
+main_stdio.MCPServer and agent.mcp_agent.stdio_loop:
+
+- stdin is read through an asyncio StreamReader (connect_read_pipe). Where
+  that is unavailable (Windows selector loop, stdin redirected from a file) a
+  reader thread feeds the same StreamReader and signals EOF, so the process
+  shuts down cleanly when the client closes stdin.
+- Lines longer than the stream buffer (MCP_STDIO_BUFFER, default 1 MiB) are
+  reassembled from chunks, up to MCP_MAX_MESSAGE_BYTES (default 256 MiB).
+  Larger messages are discarded and answered with -32600 "Message too large",
+  using the request id when it leads the message, else null.
+- Each request runs in its own task; at most `max_in_flight` handlers execute
+  at once (MCP_MAX_IN_FLIGHT, default 16). Responses are written as soon as
+  they are ready, so they may arrive out of order; clients match them by `id`.
+- `$/cancelRequest` (params.id) and MCP's `notifications/cancelled`
+  (params.requestId) cancel a queued or running request. `$/cancelRequest`
+  answers the cancelled id with error -32800; MCP cancellations get no reply.
+- A handler that raises TimeoutError (e.g. services.deadline.DeadlineExceeded)
+  is answered with -32031 "Deadline exceeded" rather than -32000.
+- A JSON-RPC batch (array) runs its members concurrently and is answered
+  with a single array once all of them finish; notifications are omitted and
+  an all-notification batch gets no reply.
+- Messages are decoded/encoded with sdk.json_codec (orjson/msgspec/stdlib,
+  MCP_JSON_CODEC).
+- All stdout writes go through a single writer task that batches whatever
+  responses are ready into one write + flush, so concurrent responses never
+  interleave.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import sys
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Union
+
+from sdk import json_codec
+
+logger = logging.getLogger(__name__)
+
+MAX_IN_FLIGHT = int(os.getenv("MCP_MAX_IN_FLIGHT", "16"))
+STREAM_BUFFER = int(os.getenv("MCP_STDIO_BUFFER", str(1024 * 1024)))
+MAX_MESSAGE_BYTES = int(os.getenv("MCP_MAX_MESSAGE_BYTES", str(256 * 1024 * 1024)))
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+SERVER_ERROR = -32000
+REQUEST_CANCELLED = -32800
+RATE_LIMITED = -32029
+SERVER_OVERLOADED = -32030
+DEADLINE_EXCEEDED = -32031
+
+CANCEL_METHODS = {"$/cancelRequest": "id", "notifications/cancelled": "requestId"}
+
+_BOM = b"\xef\xbb\xbf"
+# bytes of an oversized message kept to find its id
+_HEAD_BYTES = 4096
+# "id" as the first member, or the second after "jsonrpc"; anything else is not trusted
+_LEADING_ID = re.compile(
+    rb'\s*(?:\xef\xbb\xbf)?\s*\{\s*(?:"jsonrpc"\s*:\s*"2\.0"\s*,\s*)?"id"\s*:\s*(-?\d+|"(?:[^"\\]|\\.)*")\s*[,}]'
+)
+
+
+def error_response(req_id: Any, code: int, message: str, data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    error: Dict[str, Any] = {"code": code, "message": message}
+    if data:
+        error["data"] = data
+    return {"jsonrpc": "2.0", "id": req_id, "error": error}
+
+
+def leading_id(head: bytes) -> Any:
+    """Request id from the start of a message too large to parse, or None when it is not up front."""
+    match = _LEADING_ID.match(head)
+    if match is None:
+        return None
+    try:
+        return json_codec.loads(match.group(1))
+    except json_codec.DecodeError:
+        return None
+
+
+class StreamLineWriter:
+    """Buffered line writer over an asyncio StreamWriter (stdout pipe)."""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self._writer = writer
+
+    def write(self, line: bytes) -> None:
+        self._writer.write(line + b"\n")
+
+    async def flush(self) -> None:
+        await self._writer.drain()
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class FileLineWriter:
+    """Buffered line writer over a binary file object; flushes off the event loop."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._pending: List[bytes] = []
+
+    def write(self, line: bytes) -> None:
+        self._pending.append(line + b"\n")
+
+    def _flush_sync(self, data: bytes) -> None:
+        self._stream.write(data)
+        self._stream.flush()
+
+    async def flush(self) -> None:
+        if self._pending:
+            data, self._pending = b"".join(self._pending), []
+            await asyncio.to_thread(self._flush_sync, data)
+
+    def close(self) -> None:
+        pass
+
+
+class JSONRPCDispatcher:
+    """
+    Dispatch newline-delimited JSON-RPC requests to `handler` concurrently.
+
+    Args:
+        handler: async callable taking the request dict and returning the `result` payload.
+        writer: line writer with write(line) and async flush() (StreamLineWriter/FileLineWriter).
+        max_in_flight: maximum number of handlers running at the same time.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Dict[str, Any]], Awaitable[Any]],
+        writer,
+        max_in_flight: int = MAX_IN_FLIGHT,
+    ):
+        self.handler = handler
+        self.writer = writer
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._in_flight: Dict[Any, asyncio.Task] = {}
+        self._tasks: set = set()
+        self._outbox: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue()
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_loop())
+
+    async def _write_loop(self) -> None:
+        while True:
+            line = await self._outbox.get()
+            done = line is None
+            try:
+                # batch every response that is already waiting into one flush
+                while line is not None:
+                    self.writer.write(line)
+                    if self._outbox.empty():
+                        break
+                    line = self._outbox.get_nowait()
+                    done = done or line is None
+                await self.writer.flush()
+            except Exception:
+                logger.exception("Failed writing JSON-RPC response")
+            if done:
+                return
+
+    def send(self, message: Union[Dict[str, Any], List[Dict[str, Any]]]) -> None:
+        self._outbox.put_nowait(json_codec.dumps(message))
+
+    def reject_oversized(self, head: bytes, size: int) -> None:
+        """Answer a message over MAX_MESSAGE_BYTES so the client does not wait for it forever."""
+        self.start()
+        self.send(error_response(leading_id(head), INVALID_REQUEST, "Message too large",
+                                 {"size": size, "limit": MAX_MESSAGE_BYTES}))
+
+    async def dispatch(self, line: Union[bytes, str]) -> None:
+        """Parse one incoming line and schedule it; returns without waiting for the handler."""
+        self.start()
+        if isinstance(line, str):
+            line = line.encode("utf-8")
+        line = line.strip()
+        if line.startswith(_BOM):
+            line = line[len(_BOM):]
+        if not line:
+            return
+
+        try:
+            request = json_codec.loads(line)
+        except json_codec.DecodeError:
+            logger.error("Invalid JSON: %s", line[:200].decode("utf-8", errors="replace"))
+            self.send(error_response(None, PARSE_ERROR, "Parse error"))
+            return
+
+        if isinstance(request, list):
+            self._schedule_batch(request)
+            return
+
+        if not isinstance(request, dict):
+            self.send(error_response(None, INVALID_REQUEST, "Invalid Request"))
+            return
+
+        if request.get("method") in CANCEL_METHODS:
+            self._cancel(request)
+            return
+
+        self._schedule(request)
+
+    def _track(self, task: asyncio.Task) -> asyncio.Task:
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _spawn(self, request: Dict[str, Any]) -> asyncio.Task:
+        req_id = request.get("id")
+        task = self._track(asyncio.create_task(self._call(request)))
+        if req_id is not None:
+            self._in_flight[req_id] = task
+            task.add_done_callback(lambda _t, rid=req_id: self._forget(rid, _t))
+        return task
+
+    def _schedule(self, request: Dict[str, Any]) -> None:
+        self._spawn(request).add_done_callback(self._send_result)
+
+    def _send_result(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.result() is not None:
+            self.send(task.result())
+
+    def _schedule_batch(self, batch: List[Any]) -> None:
+        if not batch:
+            self.send(error_response(None, INVALID_REQUEST, "Invalid Request"))
+            return
+
+        responses: List[Dict[str, Any]] = []
+        members: List[asyncio.Task] = []
+        for request in batch:
+            if not isinstance(request, dict):
+                responses.append(error_response(None, INVALID_REQUEST, "Invalid Request"))
+            elif request.get("method") in CANCEL_METHODS:
+                self._cancel(request)
+            else:
+                members.append(self._spawn(request))
+
+        if members:
+            self._track(asyncio.create_task(self._collect_batch(members, responses)))
+        elif responses:
+            self.send(responses)
+
+    async def _collect_batch(self, members: List[asyncio.Task], responses: List[Dict[str, Any]]) -> None:
+        results = await asyncio.gather(*members, return_exceptions=True)
+        responses.extend(r for r in results if isinstance(r, dict))
+        if responses:
+            self.send(responses)
+
+    def _forget(self, req_id: Any, task: asyncio.Task) -> None:
+        if self._in_flight.get(req_id) is task:
+            del self._in_flight[req_id]
+
+    def _cancel(self, request: Dict[str, Any]) -> None:
+        method = request["method"]
+        params = request.get("params") or {}
+        target = params.get(CANCEL_METHODS[method])
+        task = self._in_flight.get(target)
+        if task is None or task.done():
+            logger.info("Cancel for unknown or finished request %s", target)
+            return
+        task.cancel()
+        logger.info("Cancelled request %s", target)
+        if method == "$/cancelRequest":
+            self.send(error_response(target, REQUEST_CANCELLED, "Request cancelled"))
+
+    async def _call(self, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Run the handler for one request; returns its response, or None for notifications and cancellations."""
+        req_id = request.get("id")
+        try:
+            async with self._slots:
+                result = await self.handler(request)
+        except asyncio.CancelledError:
+            return None
+        except TimeoutError as e:
+            # services.deadline.DeadlineExceeded and other timeouts: not a crash, let callers retry
+            logger.warning("Request %s timed out: %s", req_id, e)
+            if req_id is None:
+                return None
+            return error_response(req_id, DEADLINE_EXCEEDED, "Deadline exceeded", {"detail": str(e)})
+        except Exception as e:
+            logger.exception("Error in MCPAgent")
+            if req_id is None:
+                return None
+            return error_response(req_id, SERVER_ERROR, str(e), {"type": e.__class__.__name__})
+
+        if req_id is None:
+            return None
+        return {"jsonrpc": "2.0", "id": req_id, "result": result}
+
+    async def drain(self) -> None:
+        """Wait for all scheduled requests to finish and their responses to be written."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        if self._writer is not None:
+            self._outbox.put_nowait(None)
+            await self._writer
+            self._writer = None
+
+
+async def read_lines(
+    reader: asyncio.StreamReader,
+    on_oversized: Optional[Callable[[bytes, int], None]] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Yield newline-terminated messages until EOF.
+    Messages larger than the reader's buffer limit are reassembled from chunks;
+    messages above MAX_MESSAGE_BYTES are dropped and reported to
+    on_oversized(first bytes, size).
+    """
+    chunks: List[bytes] = []
+    head = b""
+    size = 0
+    eof = False
+    while not eof:
+        try:
+            line = await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            line, eof = e.partial, True
+            if not (size or line):
+                return
+        except asyncio.LimitOverrunError as e:
+            chunk = await reader.readexactly(e.consumed)
+            head = head or chunk[:_HEAD_BYTES]
+            size += len(chunk)
+            if size <= MAX_MESSAGE_BYTES:
+                chunks.append(chunk)
+            else:
+                chunks = []  # dropped anyway; do not hold on to it
+            continue
+
+        size += len(line)
+        if size > MAX_MESSAGE_BYTES:
+            logger.error("Dropping %d-byte message (limit %d)", size, MAX_MESSAGE_BYTES)
+            if on_oversized is not None:
+                on_oversized(head or line[:_HEAD_BYTES], size)
+        else:
+            yield b"".join(chunks) + line if chunks else line
+        chunks, head, size = [], b"", 0
+
+
+def _start_stdin_thread(reader: asyncio.StreamReader, loop: asyncio.AbstractEventLoop) -> None:
+    """Feed stdin into `reader` from a daemon thread; signals EOF instead of spinning on it."""
+    stream = sys.stdin.buffer
+
+    def pump():
+        try:
+            while True:
+                chunk = stream.read1(65536) if hasattr(stream, "read1") else stream.readline()
+                if not chunk:
+                    break
+                loop.call_soon_threadsafe(reader.feed_data, chunk)
+        except Exception:
+            logger.exception("Error reading stdin")
+        finally:
+            loop.call_soon_threadsafe(reader.feed_eof)
+
+    threading.Thread(target=pump, name="stdin-reader", daemon=True).start()
+
+
+async def open_stdio(buffer_limit: int = STREAM_BUFFER):
+    """Return (StreamReader over stdin, line writer over stdout)."""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=buffer_limit)
+    try:
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except (NotImplementedError, ValueError, OSError):
+        _start_stdin_thread(reader, loop)
+
+    try:
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, sys.stdout)
+        writer = StreamLineWriter(asyncio.StreamWriter(transport, protocol, None, loop))
+    except (NotImplementedError, ValueError, OSError):
+        writer = FileLineWriter(sys.stdout.buffer)
+    return reader, writer
+
+
+async def serve_stdio(handler: Callable[[Dict[str, Any]], Awaitable[Any]], max_in_flight: int = MAX_IN_FLIGHT) -> None:
+    """Serve newline-delimited JSON-RPC on stdin/stdout until stdin reaches EOF."""
+    reader, writer = await open_stdio()
+    dispatcher = JSONRPCDispatcher(handler, writer, max_in_flight)
+    async for raw in read_lines(reader, dispatcher.reject_oversized):
+        await dispatcher.dispatch(raw)
+    logger.info("Stdio EOF received, shutting down")
+    await dispatcher.drain()
+    writer.close()
@@ -2,6 +2,7 @@ from typing import Any, Dict, List, Optional
 from sdk.tool import BaseTool
 import inspect
 import logging
+from services import metrics
 from mcp_tools.vartopia_tools import VartopiaTool
 from sql_tool.sql_tool import (
     SQLTool,
@@ -99,10 +100,11 @@ class ToolRouter:
             return None 
         
         try:            
-            if inspect.iscoroutinefunction(run_func):
-                return await run_func(**kwargs)
-            else:
-                return run_func (**kwargs)
+            with metrics.observe_tool(tool_name):
+                if inspect.iscoroutinefunction(run_func):
+                    return await run_func(**kwargs)
+                else:
+                    return run_func (**kwargs)
         
         except Exception as e:
             logging.exception(f"[ToolRouter] Error running tool {tool_name}: {e}")
@@ -0,0 +1,256 @@
+"""
+Admission control for agent turns.
+
+Every /ask_agent turn passes through `admission.admit(user_id)` before
+MCPAgent.run starts:
+
+- At most ADMISSION_MAX_CONCURRENT turns run at once in this worker, and at
+  most ADMISSION_PER_USER_INFLIGHT of them belong to one user.
+- Turns that cannot start yet wait in a per-user FIFO. Free slots go to users
+  in weighted fair order (start-time fair queuing over per-user virtual time),
+  so one user flooding the queue only delays their own turns; everyone else
+  keeps getting slots in proportion to their weight.
+- Waiting is bounded. A turn is shed with 503 when it has queued for
+  ADMISSION_QUEUE_TIMEOUT seconds (or past the caller's deadline) or when the
+  whole queue holds ADMISSION_MAX_QUEUE turns, and with 429 when its user
+  already has ADMISSION_PER_USER_QUEUE turns waiting.
+
+Rejections raise AdmissionRejected carrying the HTTP status and a
+Retry-After hint. Weights come from ADMISSION_USER_WEIGHTS ("user_id=2,...";
+default 1).
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "16"))
+PER_USER_INFLIGHT = int(os.getenv("ADMISSION_PER_USER_INFLIGHT", "2"))
+PER_USER_QUEUE = int(os.getenv("ADMISSION_PER_USER_QUEUE", "8"))
+MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+
+ADMISSION_IN_FLIGHT = metrics.gauge(
+    "mcp_admission_in_flight",
+    "Agent turns currently admitted and running.",
+)
+ADMISSION_QUEUED = metrics.gauge(
+    "mcp_admission_queued",
+    "Agent turns waiting for admission.",
+)
+ADMISSION_WAIT_SECONDS = metrics.histogram(
+    "mcp_admission_wait_seconds",
+    "Time agent turns spent queued before admission (admitted turns only).",
+)
+ADMISSION_DECISIONS = metrics.counter(
+    "mcp_admission_decisions_total",
+    "Admission outcomes: admitted, or the reason a turn was shed.",
+    ["outcome"],
+)
+
+
+class AdmissionRejected(Exception):
+    """A turn was shed; `status` is 429 (this user is over their share) or 503 (server saturated)."""
+
+    def __init__(self, status: int, reason: str, retry_after: float):
+        super().__init__(f"Request not admitted ({reason})")
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+@dataclass
+class _UserState:
+    weight: float
+    in_flight: int = 0
+    vtime: float = 0.0
+    waiters: Deque[asyncio.Future] = field(default_factory=deque)
+    scheduled: bool = False
+
+    def live_waiters(self) -> int:
+        return sum(1 for w in self.waiters if not w.done())
+
+
+def _parse_weights(spec: str) -> Dict[str, float]:
+    weights: Dict[str, float] = {}
+    for entry in spec.split(","):
+        user, _, weight = entry.partition("=")
+        try:
+            if user.strip() and float(weight) > 0:
+                weights[user.strip()] = float(weight)
+        except ValueError:
+            logger.warning("Ignoring malformed admission weight %r", entry)
+    return weights
+
+
+class AdmissionController:
+    """Global + per-user concurrency limits with a weighted fair queue across users."""
+
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT,
+        per_user_inflight: int = PER_USER_INFLIGHT,
+        per_user_queue: int = PER_USER_QUEUE,
+        max_queue: int = MAX_QUEUE,
+        queue_timeout: float = QUEUE_TIMEOUT,
+        weights: Optional[Dict[str, float]] = None,
+    ):
+        self.max_concurrent = max(1, max_concurrent)
+        self.per_user_inflight = max(1, per_user_inflight)
+        self.per_user_queue = max(0, per_user_queue)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.weights = weights if weights is not None else _parse_weights(os.getenv("ADMISSION_USER_WEIGHTS", ""))
+        self.in_flight = 0
+        self.queued = 0
+        self._users: Dict[str, _UserState] = {}
+        # users with a waiter and a free per-user slot, ordered by virtual start time
+        self._ready: List[Tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._vclock = 0.0
+        self._avg_turn = 1.0
+
+    def _user(self, user_id: str) -> _UserState:
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserState(weight=self.weights.get(user_id, 1.0), vtime=self._vclock)
+        return state
+
+    def _forget_if_idle(self, user_id: str, state: _UserState) -> None:
+        if state.in_flight == 0 and not state.waiters and not state.scheduled:
+            self._users.pop(user_id, None)
+
+    def _schedule(self, user_id: str, state: _UserState) -> None:
+        if not state.scheduled and state.waiters and state.in_flight < self.per_user_inflight:
+            state.scheduled = True
+            heapq.heappush(self._ready, (max(state.vtime, self._vclock), next(self._seq), user_id))
+
+    def _dispatch(self) -> None:
+        """Hand free global slots to waiting users in virtual-time order."""
+        while self.in_flight < self.max_concurrent and self._ready:
+            start, _, user_id = heapq.heappop(self._ready)
+            state = self._users[user_id]
+            state.scheduled = False
+            while state.waiters and state.waiters[0].done():
+                state.waiters.popleft()  # timed out or cancelled while queued
+            if not state.waiters or state.in_flight >= self.per_user_inflight:
+                self._forget_if_idle(user_id, state)
+                continue
+            waiter = state.waiters.popleft()
+            self._vclock = start
+            state.vtime = start + 1.0 / state.weight
+            state.in_flight += 1
+            self.in_flight += 1
+            waiter.set_result(None)
+            self._schedule(user_id, state)
+
+    def _retry_hint(self) -> float:
+        """Rough time until a queued turn would start: the queue drained at the recent turn rate."""
+        return self._avg_turn * (1 + self.queued / self.max_concurrent)
+
+    def _release(self, user_id: str, elapsed: float) -> None:
+        self._avg_turn = 0.9 * self._avg_turn + 0.1 * elapsed
+        state = self._users[user_id]
+        state.in_flight -= 1
+        self.in_flight -= 1
+        self._schedule(user_id, state)
+        self._dispatch()
+        self._forget_if_idle(user_id, state)
+        self._export()
+
+    def _reject(self, status: int, reason: str) -> AdmissionRejected:
+        ADMISSION_DECISIONS.inc(outcome=reason)
+        logger.warning("Shedding agent turn: %s (in_flight=%d queued=%d)", reason, self.in_flight, self.queued)
+        return AdmissionRejected(status, reason, self._retry_hint())
+
+    def _export(self) -> None:
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+        ADMISSION_QUEUED.set(self.queued)
+
+    async def _acquire(self, user_id: str, deadline: Optional[float]) -> None:
+        state = self._user(user_id)
+        if not self._ready and self.in_flight < self.max_concurrent and state.in_flight < self.per_user_inflight:
+            state.in_flight += 1
+            self.in_flight += 1
+            state.vtime = max(state.vtime, self._vclock) + 1.0 / state.weight
+            ADMISSION_WAIT_SECONDS.observe(0.0)
+            return
+
+        if state.live_waiters() >= self.per_user_queue:
+            self._forget_if_idle(user_id, state)
+            raise self._reject(429, "user_queue_full")
+        if self.queued >= self.max_queue:
+            self._forget_if_idle(user_id, state)
+            raise self._reject(503, "queue_full")
+
+        timeout = self.queue_timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+        if timeout <= 0:
+            self._forget_if_idle(user_id, state)
+            raise self._reject(503, "deadline")
+
+        waiter = asyncio.get_running_loop().create_future()
+        state.waiters.append(waiter)
+        self._schedule(user_id, state)
+        self._dispatch()
+        if waiter.done():
+            ADMISSION_WAIT_SECONDS.observe(0.0)
+            return
+        self.queued += 1
+        self._export()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiter.cancel()
+                raise self._reject(503, "queue_timeout")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release(user_id, 0.0)  # admitted just as the caller went away
+            else:
+                waiter.cancel()
+            raise
+        finally:
+            self.queued -= 1
+            self._export()
+            if waiter.cancelled():
+                self._forget_if_idle(user_id, state)
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started)
+
+    @asynccontextmanager
+    async def admit(self, user_id: str, deadline: Optional[float] = None) -> AsyncIterator[None]:
+        """
+        Hold one admission slot for `user_id` for the duration of the block.
+
+        `deadline` (time.monotonic() based) caps how long the turn may queue.
+        Raises AdmissionRejected when the turn is shed.
+        """
+        user_id = str(user_id)
+        await self._acquire(user_id, deadline)
+        ADMISSION_DECISIONS.inc(outcome="admitted")
+        self._export()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(user_id, time.monotonic() - started)
+
+
+admission = AdmissionController()
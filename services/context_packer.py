@@ -0,0 +1,212 @@
+"""
+Token-budgeted prompt context.
+
+MCPAgent gathers context from several places each turn: the pgvector summary,
+semantically similar messages, recent pgvector history and the Redis feedback
+history. ContextPacker fits them into one token budget:
+
+- Tokens are counted with tiktoken when it is installed (and its encoding
+  can be loaded), otherwise estimated at ~4 characters per token. Counts are
+  cached per text, and the encoding is loaded once per model.
+- The system prompt and the user's message are always kept. The remaining
+  budget goes to sources in priority order (CONTEXT_PRIORITY, default
+  "summary,similar,recent,feedback"), most relevant items first within a
+  source. Items that do not fit are skipped. The summary is capped at
+  CONTEXT_SUMMARY_SHARE of the budget and truncated rather than skipped.
+- The same text arriving from two sources (a recent message that is also a
+  "similar" hit, a feedback message repeating the user's question) is kept
+  once. Normalised dedup keys are cached. A summary/similar/recent item that
+  is also in the feedback history is kept at its history position (with its
+  own source's priority), so the history part of the prompt prefix does not
+  change with the turn's similarity hits.
+
+The packed prompt is [system prompt, feedback history in chronological order,
+memory block (summary / similar / recent), user message]: static first and the
+most turn-specific content last, so provider prompt caching can reuse the
+longest possible prefix (see agent.prompt_template.assemble_prompt).
+
+Tuning (env):
+    CONTEXT_TOKEN_BUDGET       total prompt budget in tokens (default 3000)
+    CONTEXT_PRIORITY           source order, comma separated
+    CONTEXT_SUMMARY_SHARE      largest share of the budget the summary may take (default 0.25)
+    CONTEXT_TOKENIZER_MODEL    model whose encoding is used (default gpt-3.5-turbo)
+"""
+
+import hashlib
+import logging
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence
+
+from agent.prompt_template import assemble_prompt
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+PRIORITY = [s.strip() for s in os.getenv("CONTEXT_PRIORITY", "summary,similar,recent,feedback").split(",") if s.strip()]
+TOKENIZER_MODEL = os.getenv("CONTEXT_TOKENIZER_MODEL", "gpt-3.5-turbo")
+SUMMARY_SHARE = float(os.getenv("CONTEXT_SUMMARY_SHARE", "0.25"))
+MESSAGE_OVERHEAD = 4  # role/separator tokens per chat message
+MIN_TRUNCATED = 32
+
+MEMORY_HEADERS = {"summary": "Summary of past conversation:", "recent": "Recent messages:"}
+
+PROMPT_TOKENS = metrics.histogram(
+    "mcp_context_prompt_tokens",
+    "Tokens in packed agent prompts.",
+    buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 16000),
+)
+CONTEXT_ITEMS = metrics.counter(
+    "mcp_context_items_total",
+    "Context items offered to the packer by source and outcome (kept, truncated, duplicate, over_budget).",
+    ["source", "outcome"],
+)
+
+_WS = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=8)
+def _encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # the BPE files are downloaded on first use; offline hosts fall back to estimates
+        logger.warning("tiktoken encoding for %s unavailable; estimating token counts", model)
+        return None
+
+
+@lru_cache(maxsize=int(os.getenv("CONTEXT_TOKEN_CACHE_SIZE", "8192")))
+def _count(text: str, model: str) -> int:
+    encoding = _encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_tokens(text: Optional[str], model: str = TOKENIZER_MODEL) -> int:
+    return _count(text, model) if text else 0
+
+
+def message_tokens(message: Dict[str, Any], model: str = TOKENIZER_MODEL) -> int:
+    return count_tokens(str(message.get("content") or ""), model) + MESSAGE_OVERHEAD
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = TOKENIZER_MODEL) -> str:
+    """The longest prefix of `text` within `max_tokens`."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    encoding = _encoding(model)
+    if encoding is None:
+        return text[: max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+
+@lru_cache(maxsize=8192)
+def dedup_key(text: str) -> str:
+    """Case- and whitespace-insensitive fingerprint used to drop repeated context."""
+    return hashlib.blake2b(_WS.sub(" ", text).strip().lower().encode("utf-8"), digest_size=16).hexdigest()
+
+
+@dataclass
+class ContextItem:
+    source: str            # summary / similar / recent / feedback
+    text: str
+    rank: int = 0          # relevance within the source, 0 = most relevant
+    order: float = 0.0     # output position within the source (e.g. timestamp)
+    role: str = "system"   # chat role for feedback history
+    prefix: str = ""       # rendered before the text, not used for dedup
+
+
+@dataclass
+class PackedContext:
+    messages: List[Dict[str, str]]
+    tokens: int
+    kept: Dict[str, int]
+    dropped: Dict[str, int]
+
+
+class ContextPacker:
+    def __init__(self, budget: int = TOKEN_BUDGET, priority: Sequence[str] = PRIORITY, model: str = TOKENIZER_MODEL):
+        self.budget = budget
+        self.priority = {source: i for i, source in enumerate(priority)}
+        self.model = model
+
+    def _tokens(self, item: ContextItem) -> int:
+        return count_tokens(item.prefix + item.text, self.model) + (MESSAGE_OVERHEAD if item.source == "feedback" else 1)
+
+    def pack(self, system_prompt: str, user_input: str, items: Sequence[ContextItem],
+             budget: Optional[int] = None) -> PackedContext:
+        budget = self.budget if budget is None else budget
+        system_msg = {"role": "system", "content": system_prompt}
+        user_msg = {"role": "user", "content": user_input}
+        # the memory block is one extra message with section headers
+        used = (message_tokens(system_msg, self.model) + message_tokens(user_msg, self.model)
+                + MESSAGE_OVERHEAD + sum(count_tokens(h, self.model) for h in MEMORY_HEADERS.values()))
+        left = budget - used
+
+        seen = {dedup_key(user_input)}
+        history_copies = {dedup_key(i.text): i for i in items if i.source == "feedback" and i.text}
+        chosen: List[ContextItem] = []
+        kept: Dict[str, int] = {}
+        dropped: Dict[str, int] = {}
+        last = len(self.priority)
+        for item in sorted(items, key=lambda i: (self.priority.get(i.source, last), i.rank)):
+            if not item.text:
+                continue
+            key = dedup_key(item.text)
+            if item.source != "feedback" and key in history_copies:
+                item = history_copies[key]
+            if key in seen:
+                outcome = "duplicate"
+            else:
+                cost = self._tokens(item)
+                limit = min(left, int(budget * SUMMARY_SHARE)) if item.source == "summary" else left
+                if cost <= limit:
+                    outcome = "kept"
+                elif item.source == "summary" and limit >= MIN_TRUNCATED:
+                    item = ContextItem(item.source, truncate_to_tokens(item.text, limit - 1, self.model), item.rank,
+                                       item.order, item.role, item.prefix)
+                    cost = self._tokens(item)
+                    outcome = "truncated"
+                else:
+                    outcome = "over_budget"
+                if outcome != "over_budget":
+                    seen.add(key)
+                    chosen.append(item)
+                    left -= cost
+                    used += cost
+            CONTEXT_ITEMS.inc(source=item.source, outcome=outcome)
+            counts = kept if outcome in ("kept", "truncated") else dropped
+            counts[item.source] = counts.get(item.source, 0) + 1
+
+        history = sorted((i for i in chosen if i.source == "feedback"), key=lambda i: i.order)
+        messages = assemble_prompt(system_prompt, ({"role": i.role, "content": i.prefix + i.text} for i in history),
+                                   self._memory_block(chosen), user_input)
+
+        PROMPT_TOKENS.observe(used)
+        return PackedContext(messages, used, kept, dropped)
+
+    def _memory_block(self, chosen: List[ContextItem]) -> str:
+        parts = []
+        for source in ("summary", "similar", "recent"):
+            lines = [i.prefix + i.text for i in sorted((i for i in chosen if i.source == source), key=lambda i: i.order)]
+            if not lines:
+                continue
+            header = MEMORY_HEADERS.get(source)
+            parts.append(f"{header}\n" + "\n".join(lines) if header else "\n".join(lines))
+        return "\n\n".join(parts)
+
+
+context_packer = ContextPacker()
@@ -0,0 +1,61 @@
+"""
+Per-turn deadlines carried in a ContextVar.
+
+/ask_agent opens `deadline.budget(seconds)` around a turn. Everything awaited
+inside it (admission, LLM gateway calls, tasks spawned from the turn) can then
+ask how much time is left without the value being threaded through every
+signature:
+
+    with deadline.budget(30):
+        ...
+        left = deadline.remaining()   # seconds, or None when no deadline is set
+
+Nested budgets can only tighten the deadline, never extend it. Deadlines are
+time.monotonic() based.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+TURN_TIMEOUT = float(os.getenv("AGENT_TURN_TIMEOUT", "60"))
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The current turn ran out of time."""
+
+
+def current() -> Optional[float]:
+    """Absolute deadline (time.monotonic()) of the current turn, if any."""
+    return _deadline.get()
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the deadline (may be negative), or None without one."""
+    value = _deadline.get()
+    return None if value is None else value - time.monotonic()
+
+
+def check(what: str = "operation") -> None:
+    """Raise DeadlineExceeded if the deadline has already passed."""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded before {what}")
+
+
+@contextmanager
+def budget(seconds: Optional[float]) -> Iterator[Optional[float]]:
+    """Run the block with at most `seconds` left (None keeps the current deadline)."""
+    value = _deadline.get()
+    if seconds is not None:
+        candidate = time.monotonic() + seconds
+        value = candidate if value is None else min(value, candidate)
+    token = _deadline.set(value)
+    try:
+        yield value
+    finally:
+        _deadline.reset(token)
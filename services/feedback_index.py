@@ -0,0 +1,223 @@
+"""
+Per-user inverted index over feedback-bearing messages, ranked with BM25.
+
+MCPAgent looks up past corrections relevant to the current request. Scanning
+a user's whole message history for that costs
+O(messages x words x input length). This index makes the lookup a few Redis
+round trips, however long the history is.
+
+Only assistant and feedback messages are indexed. A message's document is its
+content plus any feedback text attached to it. Layout per user (prefix
+FEEDBACK_INDEX_PREFIX, default "vartopia:fbidx:"):
+
+    <user>:t:<token>   zset  message_id -> term frequency (the postings list)
+    <user>:len         hash  message_id -> document length in tokens
+    <user>:terms       hash  message_id -> the document's distinct tokens
+    <user>:stats       hash  docs, total_len, built
+    <user>:gen         int   bumped by every write; rebuild() WATCHes it
+
+Tokens are lowercased words (emails and ids such as "vn-4821" stay whole).
+Stop words and one-character tokens are dropped. Search reads the top
+FEEDBACK_INDEX_MAX_POSTINGS postings of each query term (highest term
+frequency first) and scores them with BM25 (k1=1.2, b=0.75).
+
+Writers pass `ttl` (feedback_memory.MESSAGE_TTL_SECONDS) to refresh an
+expiry on every key they touch, so an index whose messages have all expired
+goes away with them even when the retention task is not running.
+
+Nothing in this module talks to Redis on its own: callers pass the client,
+or a pipeline, from services.feedback_memory.
+"""
+
+import math
+import os
+import re
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from redis.exceptions import WatchError
+
+INDEX_PREFIX = os.getenv("FEEDBACK_INDEX_PREFIX", os.getenv("REDIS_KEY_PREFIX", "vartopia:") + "fbidx:")
+MAX_POSTINGS = int(os.getenv("FEEDBACK_INDEX_MAX_POSTINGS", "1000"))
+K1 = 1.2
+B = 0.75
+
+STOP_WORDS = frozenset("""
+a an and are as at be but by can do does for from had has have how i if in into is it its me my no not of on
+or our please show so that the their them then there these they this to us was we were what when where which
+who why will with you your
+""".split())
+
+_TOKEN = re.compile(r"[\w@][\w@.\-]*")
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Index/query tokens of `text`, in order, duplicates kept."""
+    tokens = []
+    for raw in _TOKEN.findall((text or "").lower()):
+        token = raw.rstrip(".-")
+        if len(token) > 1 and token not in STOP_WORDS:
+            tokens.append(token)
+    return tokens
+
+
+def is_indexed_role(role: Optional[str]) -> bool:
+    role = role or ""
+    return "assistant" in role or "feedback" in role
+
+
+def document_text(content: Optional[str], feedback: Optional[str] = None) -> str:
+    return f"{content or ''}\n{feedback}" if feedback else (content or "")
+
+
+def _key(user_id: str, suffix: str) -> str:
+    return f"{INDEX_PREFIX}{user_id}:{suffix}"
+
+
+def _term_key(user_id: str, token: str) -> str:
+    return _key(user_id, f"t:{token}")
+
+
+def add_document(pipe: Any, user_id: str, message_id: str, text: str, ttl: Optional[int] = None) -> None:
+    """Queue the commands indexing one (not yet indexed) document on `pipe`; `ttl` refreshes key expiry."""
+    counts = Counter(tokenize(text))
+    length = sum(counts.values())
+    for token, tf in counts.items():
+        pipe.zadd(_term_key(user_id, token), {message_id: tf})
+        if ttl:
+            pipe.expire(_term_key(user_id, token), ttl)
+    pipe.hset(_key(user_id, "len"), message_id, length)
+    pipe.hset(_key(user_id, "terms"), message_id, " ".join(counts))
+    pipe.hincrby(_key(user_id, "stats"), "docs", 1)
+    pipe.hincrby(_key(user_id, "stats"), "total_len", length)
+    pipe.incr(_key(user_id, "gen"))
+    if ttl:
+        for suffix in ("len", "terms", "stats", "gen"):
+            pipe.expire(_key(user_id, suffix), ttl)
+
+
+async def remove_documents(r: Any, user_id: str, message_ids: List[str], pipe: Any = None) -> None:
+    """Remove documents from the index. The removal is queued on `pipe` when given, else executed."""
+    if not message_ids:
+        return
+    fetch = r.pipeline(transaction=False)
+    fetch.hmget(_key(user_id, "terms"), message_ids)
+    fetch.hmget(_key(user_id, "len"), message_ids)
+    all_terms, lengths = await fetch.execute()
+    indexed = [(mid, terms, int(length or 0))
+               for mid, terms, length in zip(message_ids, all_terms, lengths) if terms is not None]
+    if not indexed:
+        return
+    own = pipe is None
+    pipe = r.pipeline(transaction=False) if own else pipe
+    for message_id, terms, _ in indexed:
+        for token in terms.split():
+            pipe.zrem(_term_key(user_id, token), message_id)
+    ids = [mid for mid, _, _ in indexed]
+    pipe.hdel(_key(user_id, "len"), *ids)
+    pipe.hdel(_key(user_id, "terms"), *ids)
+    pipe.hincrby(_key(user_id, "stats"), "docs", -len(indexed))
+    pipe.hincrby(_key(user_id, "stats"), "total_len", -sum(length for _, _, length in indexed))
+    pipe.incr(_key(user_id, "gen"))
+    if own:
+        await pipe.execute()
+
+
+async def remove_document(r: Any, user_id: str, message_id: str, pipe: Any = None) -> None:
+    """Remove one document. The removal is queued on `pipe` when given, else executed."""
+    await remove_documents(r, user_id, [message_id], pipe)
+
+
+async def reindex_document(r: Any, user_id: str, message_id: str, text: str, ttl: Optional[int] = None) -> None:
+    """Replace the indexed text of one message (after feedback is attached or content edited)."""
+    pipe = r.pipeline(transaction=False)
+    await remove_document(r, user_id, message_id, pipe)
+    add_document(pipe, user_id, message_id, text, ttl)
+    await pipe.execute()
+
+
+async def _index_keys(r: Any, user_id: str) -> List[str]:
+    terms = await r.hvals(_key(user_id, "terms"))
+    tokens = {token for value in terms for token in value.split()}
+    return [_term_key(user_id, token) for token in tokens] + [_key(user_id, s) for s in ("len", "terms", "stats")]
+
+
+async def drop(r: Any, user_id: str) -> None:
+    """Delete a user's whole index."""
+    keys = await _index_keys(r, user_id)
+    for start in range(0, len(keys), 500):
+        await r.delete(*keys[start:start + 500])
+    await r.incr(_key(user_id, "gen"))  # abort a rebuild that read the messages before this
+
+
+async def is_built(r: Any, user_id: str) -> bool:
+    return bool(await r.hget(_key(user_id, "stats"), "built"))
+
+
+async def rebuild(
+    r: Any,
+    user_id: str,
+    load_documents: Callable[[], Awaitable[Iterable[Tuple[str, str]]]],
+    ttl: Optional[int] = None,
+) -> Optional[int]:
+    """
+    Rebuild a user's index from the (message_id, text) pairs `load_documents`
+    returns. The old index is replaced and "built" set in one MULTI/EXEC,
+    which is aborted if any write to the index (a message stored, feedback
+    added, retention, drop) happened after the documents were read. Returns
+    the number indexed, or None when aborted (the caller may retry later).
+    """
+    async with r.pipeline(transaction=True) as pipe:
+        await pipe.watch(_key(user_id, "gen"))
+        documents = list(await load_documents())
+        old_keys = await _index_keys(pipe, user_id)
+        pipe.multi()
+        pipe.delete(*old_keys)
+        for message_id, text in documents:
+            add_document(pipe, user_id, message_id, text, ttl)
+        pipe.hset(_key(user_id, "stats"), "built", 1)
+        if ttl:
+            pipe.expire(_key(user_id, "stats"), ttl)
+        try:
+            await pipe.execute()
+        except WatchError:
+            return None
+    return len(documents)
+
+
+async def search(r: Any, user_id: str, query: str, limit: int = 10) -> List[Tuple[str, float]]:
+    """Up to `limit` (message_id, BM25 score) pairs for `query`, best first."""
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms:
+        return []
+    pipe = r.pipeline(transaction=False)
+    pipe.hmget(_key(user_id, "stats"), "docs", "total_len")
+    for token in terms:
+        pipe.zcard(_term_key(user_id, token))
+        pipe.zrevrange(_term_key(user_id, token), 0, MAX_POSTINGS - 1, withscores=True)
+    results = await pipe.execute()
+    docs, total_len = (int(v or 0) for v in results[0])
+    if docs <= 0:
+        return []
+
+    postings: Dict[str, List[Tuple[float, float]]] = {}
+    for i in range(len(terms)):
+        df, hits = results[1 + 2 * i], results[2 + 2 * i]
+        if not df:
+            continue
+        idf = math.log(1 + (docs - df + 0.5) / (df + 0.5))
+        for message_id, tf in hits:
+            postings.setdefault(message_id, []).append((idf, tf))
+    if not postings:
+        return []
+
+    candidates = list(postings)
+    lengths = await r.hmget(_key(user_id, "len"), candidates)
+    avg_len = total_len / docs if total_len > 0 else 1.0
+    scored = []
+    for message_id, length in zip(candidates, lengths):
+        norm = K1 * (1 - B + B * int(length or 0) / avg_len)
+        score = sum(idf * tf * (K1 + 1) / (tf + norm) for idf, tf in postings[message_id])
+        scored.append((message_id, score))
+    scored.sort(key=lambda item: item[1], reverse=True)
+    return scored[:limit]
@@ -1,3 +1,15 @@
+"""
+Redis-backed store of chat messages and the feedback users give on them.
+
+Each message is a hash at "<prefix> message:<message_id>". Each user has a zset
+of their message ids by timestamp, secondary zsets by role and metadata type
+(see _message_index_zkey) and a BM25 index (services.feedback_index).
+
+Assumes a single Redis node (docker-compose runs one redis:7). The page and
+last-message scripts derive message hash keys from ARGV, and store_message
+and delete_user_messages run MULTI across message and user keys; running on
+Redis Cluster would need every key hash-tagged by user.
+"""
 import os
 import json
 import time
@@ -7,10 +19,51 @@ from typing import Optional, List, Dict, Any
 
 import redis.asyncio as aioredis
 
+from services import feedback_index, metrics, tracing
+
 logger=logging.getLogger(__name__)
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379")
 REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "vartopia:")
+FEEDBACK_BOOST = float(os.getenv("FEEDBACK_SEARCH_BOOST", "0.5"))
+# messages (including scored ones) are kept at most this long; see services.feedback_retention
+MAX_AGE_DAYS = float(os.getenv("FEEDBACK_MAX_AGE_DAYS", "90"))
+# backstop TTL in case the retention task is not running; the grace lets it aggregate first
+MESSAGE_TTL_SECONDS = int((MAX_AGE_DAYS + 2) * 86400)
+REBUILD_LOCK_SECONDS = 60
+MESSAGE_FIELDS = ("user_id", "role", "content", "timestamp", "feedback", "score", "metadata")
+
+# KEYS[1] = user zset; ARGV = hash key prefix, start, stop, reverse (1/0), fields...
+# Returns {message_id, {values...}} pairs; messages whose hash is gone have only nils.
+PAGE_LUA = """
+local ids
+if ARGV[4] == '1' then
+  ids = redis.call('ZREVRANGE', KEYS[1], ARGV[2], ARGV[3])
+else
+  ids = redis.call('ZRANGE', KEYS[1], ARGV[2], ARGV[3])
+end
+local out = {}
+for _, id in ipairs(ids) do
+  out[#out + 1] = id
+  out[#out + 1] = redis.call('HMGET', ARGV[1] .. id, unpack(ARGV, 5))
+end
+return out
+"""
+
+# KEYS[1] = message zset (user or secondary index), KEYS[2] = index registry; ARGV[1] = hash key prefix.
+# Returns {built (1/0), newest message_id whose hash still exists}; stale entries are removed on the way,
+# so the usual case is a single ZREVRANGE ... 0 0.
+LAST_LUA = """
+local built = redis.call('HEXISTS', KEYS[2], 'built')
+while true do
+  local id = redis.call('ZREVRANGE', KEYS[1], 0, 0)[1]
+  if not id then return {built, false} end
+  if redis.call('EXISTS', ARGV[1] .. id) == 1 then return {built, id} end
+  redis.call('ZREM', KEYS[1], id)
+end
+"""
+
+_scripts: Dict[str, Any] = {}
 
 _redis_client:Optional[aioredis.Redis]=None
 
@@ -23,6 +76,7 @@ async def init_redis_pool(url:str=REDIS_URL)-> aioredis.Redis:
     if _redis_client is None:
         logger.info("Initializing Redis client for feedback memory")
         _redis_client= aioredis.from_url(url, decode_responses=True)
+        metrics.track_redis_pool("feedback_memory", _redis_client)
         
         try:
             await _redis_client.ping()
@@ -37,6 +91,59 @@ def _user_messages_zkey(user_id:str)->str:
 def _message_hash_key(message_id:str)->str:
     return f"{REDIS_KEY_PREFIX} message:{message_id}"
 
+def _index_suffix(role:Optional[str]=None, message_type:Optional[str]=None)->str:
+    parts= []
+    if role:
+        parts.append(f"role:{role}")
+    if message_type:
+        parts.append(f"type:{message_type}")
+    return ":".join(parts)
+
+def _message_index_zkey(user_id:str, suffix:str)->str:
+    """
+    Secondary zset of a user's messages with a given role and/or metadata type
+    (message_id -> timestamp), e.g. suffix "role:assistant:type:sql".
+    """
+    return f"{_user_messages_zkey(user_id)}:{suffix}"
+
+def _message_index_registry(user_id:str)->str:
+    """
+    Hash listing the user's secondary zsets (one field per suffix) plus a
+    "built" field once messages stored before the indexes existed are in them.
+    """
+    return f"{_user_messages_zkey(user_id)}:indexes"
+
+def _index_suffixes(role:Optional[str], metadata:Optional[Dict[str,Any]])->List[str]:
+    message_type= (metadata or {}).get("type")
+    message_type= str(message_type) if message_type else None
+    suffixes= [_index_suffix(role=role)] if role else []
+    if message_type:
+        suffixes.append(_index_suffix(message_type=message_type))
+        if role:
+            suffixes.append(_index_suffix(role, message_type))
+    return suffixes
+
+def _add_to_message_indexes(pipe, user_id:str, message_id:str, ts:float, suffixes:List[str])->None:
+    registry= _message_index_registry(user_id)
+    for suffix in suffixes:
+        pipe.zadd(_message_index_zkey(user_id, suffix), {message_id: ts})
+        pipe.expire(_message_index_zkey(user_id, suffix), MESSAGE_TTL_SECONDS)
+        pipe.hset(registry, suffix, 1)
+    pipe.expire(registry, MESSAGE_TTL_SECONDS)
+
+async def _message_index_zkeys(r: aioredis.Redis, user_id:str)-> List[str]:
+    """
+    All secondary zsets of a user (to remove deleted messages from).
+    """
+    suffixes= await r.hkeys(_message_index_registry(user_id))
+    return [_message_index_zkey(user_id, suffix) for suffix in suffixes if suffix != "built"]
+
+def _script(r: aioredis.Redis, source:str):
+    script= _scripts.get(source)
+    if script is None or script.registered_client is not r:
+        script= _scripts[source]= r.register_script(source)
+    return script
+
 async def store_message(
     user_id:str,
     role:str,
@@ -67,8 +174,14 @@ async def store_message(
     
     pipe= r.pipeline()
     pipe.hset(message_key, mapping=record)
+    pipe.expire(message_key, MESSAGE_TTL_SECONDS)
     pipe.zadd(_user_messages_zkey(user_id),{message_id: ts})
-    await pipe.execute()
+    pipe.expire(_user_messages_zkey(user_id), MESSAGE_TTL_SECONDS)
+    _add_to_message_indexes(pipe, user_id, message_id, ts, _index_suffixes(role, metadata))
+    if feedback_index.is_indexed_role(role):
+        feedback_index.add_document(pipe, user_id, message_id, content, MESSAGE_TTL_SECONDS)
+    with tracing.span("redis.store_message", kind="client"):
+        await pipe.execute()
     
     logger.debug("Stored message %s for user %s", message_id, user_id)
     return message_id
@@ -82,8 +195,8 @@ async def add_feedback(message_id: str, feedback:str, score:Optional[int]=None)-
     """
     r= await init_redis_pool()
     message_key=_message_hash_key(message_id)
-    exists= await r.exists(message_key)
-    if not exists:
+    raw= await r.hgetall(message_key)
+    if not raw:
         logger.warning("Attempeted to add feedback to non-existent message %s", message_id)
         raise ValueError("message_id not found")
     
@@ -91,45 +204,102 @@ async def add_feedback(message_id: str, feedback:str, score:Optional[int]=None)-
     if score is not None:
         fields["score"]=str(score)
     await r.hset(message_key, mapping=fields)
+    if feedback_index.is_indexed_role(raw.get("role")):
+        await feedback_index.reindex_document(
+            r, raw.get("user_id"), message_id, feedback_index.document_text(raw.get("content"), feedback),
+            MESSAGE_TTL_SECONDS)
     logger.debug("Added feedback to message %s: %s (score=%s)", message_id, feedback, score)
     
-async def get_user_messages(user_id: str, limit:int=100, reverse:bool=False)-> List[Dict[str, Any]]:
+async def get_user_messages(
+    user_id: str,
+    limit:int=100,
+    reverse:bool=False,
+    fields:Optional[List[str]]=None,
+)-> List[Dict[str, Any]]:
     """
-    Retrieve up to `limit` messages for a user.
+    Retrieve up to `limit` messages for a user (limit=0 reads them all).
     - reverse = False => older-first, reverse = True => newest-first
+    - fields: message fields to read (default all); the others come back as None/{}
+    One round trip: a Lua script pages the zset and reads the fields of each message.
     Returns a list of message dicts with parsed metadata.
     """
     r = await init_redis_pool()
-    zkey= _user_messages_zkey(user_id)
-    if reverse:
-        message_ids= await r.zrevrange(zkey, 0, limit - 1)
-    else:
-        message_ids= await r.zrange(zkey, 0, limit -1 )
-        
+    fields= list(fields or MESSAGE_FIELDS)
+    args= [_message_hash_key(""), 0, limit - 1, 1 if reverse else 0, *fields]
+    with tracing.span("redis.get_user_messages", kind="client", limit=limit):
+        page= await _script(r, PAGE_LUA)(keys=[_user_messages_zkey(user_id)], args=args)
+    messages= []
+    for mid, values in zip(page[::2], page[1::2]):
+        if any(v is not None for v in values):
+            messages.append(_parse_message(mid, dict(zip(fields, values))))
+    return messages
+
+def _parse_message(message_id:str, raw:Dict[str,str])->Dict[str,Any]:
+    return {
+        "message_id": message_id,
+        "user_id": raw.get("user_id"),
+        "role": raw.get("role"),
+        "content": raw.get("content"),
+        "timestamp": float(raw.get("timestamp")) if raw.get("timestamp") else None,
+        "feedback": raw.get("feedback") or None,
+        "score": int(raw.get("score")) if raw.get("score") else None,
+        "metadata": json.loads(raw.get("metadata")) if raw.get("metadata") else {},
+    }
+
+async def get_messages(message_ids: List[str])-> List[Dict[str, Any]]:
+    """
+    Fetch messages by id, in the given order. Missing messages are skipped.
+    """
     if not message_ids:
         return []
-    
+    r = await init_redis_pool()
     pipe= r.pipeline()
     for mid in message_ids:
         pipe.hgetall(_message_hash_key(mid))
-    raw_results= await pipe.execute()
-    
-    out: List[Dict[str, Any]]=[]
-    for mid, raw in zip(message_ids, raw_results):
-        if not raw:
-            continue
-        item={
-            "message_id": mid,
-            "user_id": raw.get("user_id"),
-            "role": raw.get("role"),
-            "content": raw.get("content"),
-            "timestamp": float(raw.get("timestamp")) if raw.get("timestamp") else None,
-            "feedback": raw.get("feedback") or None,
-            "score": int(raw.get("score")) if raw.get("score") else None,
-            "metadata": json.loads(raw.get("metadata")) if raw.get("metadata") else {},
-        }
-        out.append(item)
-    return out
+    with tracing.span("redis.get_messages", kind="client", count=len(message_ids)):
+        raw_results= await pipe.execute()
+    return [_parse_message(mid, raw) for mid, raw in zip(message_ids, raw_results) if raw]
+
+async def _ensure_index(r: aioredis.Redis, user_id: str)-> None:
+    """
+    Build the user's feedback index from their stored messages on first use.
+    """
+    if await feedback_index.is_built(r, user_id):
+        return
+    lock= f"{feedback_index.INDEX_PREFIX}{user_id}:rebuilding"
+    if not await r.set(lock, 1, nx=True, ex=REBUILD_LOCK_SECONDS):
+        return  # another worker is building it; search what is there
+    async def documents():
+        messages= await get_user_messages(user_id, limit=0, fields=["role", "content", "feedback"])
+        return [(m["message_id"], feedback_index.document_text(m["content"], m["feedback"]))
+                for m in messages if feedback_index.is_indexed_role(m["role"])]
+    try:
+        count= await feedback_index.rebuild(r, user_id, documents, MESSAGE_TTL_SECONDS)
+        if count is None:
+            # messages changed while reading them; the next search builds it again
+            logger.info("Feedback index rebuild for user %s raced a write; will retry", user_id)
+        else:
+            logger.info("Built feedback index for user %s (%d messages)", user_id, count)
+    finally:
+        await r.delete(lock)
+
+async def search_feedback(user_id: str, query: str, top_k: int = 5)-> List[Dict[str, Any]]:
+    """
+    The user's assistant/feedback messages most relevant to `query`, best first.
+    Ranked by BM25 over the feedback index. Messages that carry feedback (a
+    correction or a score) get a FEEDBACK_SEARCH_BOOST bonus.
+    """
+    r= await init_redis_pool()
+    with tracing.span("redis.search_feedback", kind="client"):
+        await _ensure_index(r, user_id)
+        hits= await feedback_index.search(r, user_id, query, limit=top_k * 4)
+        messages= await get_messages([mid for mid, _ in hits])
+    scores= dict(hits)
+    def rank(m: Dict[str, Any])-> float:
+        boost= 1 + FEEDBACK_BOOST if (m["feedback"] or m["score"] is not None) else 1
+        return scores[m["message_id"]] * boost
+    messages.sort(key=rank, reverse=True)
+    return messages[:top_k]
 
 async def delete_user_messages(user_id:str)-> int:
     """
@@ -146,8 +316,9 @@ async def delete_user_messages(user_id:str)-> int:
     for mid in message_ids:
         pipe.delete(_message_hash_key(mid))
     
-    pipe.delete(zkey)
+    pipe.delete(zkey, _message_index_registry(user_id), *await _message_index_zkeys(r, user_id))
     await pipe.execute()
+    await feedback_index.drop(r, user_id)
     
     logger.info("Deleted %d messages for user %s", len(message_ids), user_id)
     return len(message_ids)
@@ -158,12 +329,16 @@ async def update_message_content(message_id: str ,new_content: str)-> None:
     """
     r=await init_redis_pool()
     message_key= _message_hash_key(message_id)
-    exists= await r.exists(message_key)
+    raw= await r.hgetall(message_key)
     
-    if not exists:
+    if not raw:
         raise ValueError("message_id not found")
     
     await r.hset(message_key, mapping={"content":new_content})
+    if feedback_index.is_indexed_role(raw.get("role")):
+        await feedback_index.reindex_document(
+            r, raw.get("user_id"), message_id, feedback_index.document_text(new_content, raw.get("feedback")),
+            MESSAGE_TTL_SECONDS)
     logger.debug("Updated content for message %s", message_id)
 
 def get_redis_client_sync()-> aioredis.Redis:
@@ -197,15 +372,34 @@ async def get_last_message_id(
     """
     Get the lastest message ID for a user.
     Optionally filter by role (assistant/user) or metadata type (e.g., 'sql').
+    Filtered lookups read the matching secondary zset, so this is one round trip.
     """
-    messages= await get_user_messages(user_id, limit=50, reverse=True)
-    for msg in messages:
-        if filter_role and msg["role"] != filter_role:
-            continue
-        if filter_type and msg["metadata"].get("type")!=filter_type:
-            continue
-        return msg["message_id"]
-    return None
+    r= await init_redis_pool()
+    suffix= _index_suffix(filter_role, filter_type)
+    zkey= _message_index_zkey(user_id, suffix) if suffix else _user_messages_zkey(user_id)
+    keys= [zkey, _message_index_registry(user_id)]
+    args= [_message_hash_key("")]
+    with tracing.span("redis.get_last_message_id", kind="client"):
+        built, message_id= await _script(r, LAST_LUA)(keys=keys, args=args)
+        if suffix and not int(built):
+            await _build_message_indexes(r, user_id)
+            built, message_id= await _script(r, LAST_LUA)(keys=keys, args=args)
+    return message_id or None
+
+async def _build_message_indexes(r: aioredis.Redis, user_id: str)-> None:
+    """
+    Add messages stored before the secondary zsets existed to them.
+    Idempotent, so concurrent builds are harmless.
+    """
+    messages= await get_user_messages(user_id, limit=0, fields=["role", "timestamp", "metadata"])
+    pipe= r.pipeline(transaction=False)
+    for m in messages:
+        _add_to_message_indexes(pipe, user_id, m["message_id"], m["timestamp"] or 0.0,
+                                _index_suffixes(m["role"], m["metadata"]))
+    pipe.hset(_message_index_registry(user_id), "built", 1)
+    pipe.expire(_message_index_registry(user_id), MESSAGE_TTL_SECONDS)
+    await pipe.execute()
+    logger.info("Built message role/type indexes for user %s (%d messages)", user_id, len(messages))
 
 
 async def provide_feedback(
@@ -226,6 +420,9 @@ __all__=[
     "store_message",
     "add_feedback",
     "get_user_messages",
+    "get_messages",
+    "get_last_message_id",
+    "search_feedback",
     "delete_user_messages",
     "update_message_content",
     "get_redis_client_sync",
@@ -0,0 +1,231 @@
+"""
+Retention for the Redis feedback message store (services.feedback_memory).
+
+store_message keeps one hash per message plus a zset entry per user. Without
+this task both grow forever. A background sweep, run every
+FEEDBACK_RETENTION_INTERVAL seconds by one replica at a time (Redis lock),
+applies the policy to every user's zset:
+
+- Compaction. Messages older than FEEDBACK_COMPACT_AFTER_DAYS (default 30), or
+  beyond the newest FEEDBACK_MAX_MESSAGES (default 1000) of a user, are rolled
+  into per-day aggregates and deleted.
+- Scored feedback is preserved. A message with a score or feedback text
+  stays intact for search and learning until it reaches FEEDBACK_MAX_AGE_DAYS
+  (default 90). After that it is aggregated too.
+- Expiry. Entries whose hash is already gone (the per-message TTL set by
+  store_message is a backstop) are removed from the zsets and the feedback
+  index.
+
+Aggregates are hashes at "<prefix>fbagg:<user_id>:<YYYY-MM-DD>" (UTC). They
+hold message counts (total and per role), how many messages carried feedback
+or a score, the score sum and how many scores were negative (< 3). They expire
+after FEEDBACK_AGGREGATE_TTL_DAYS (default 365).
+
+Work is done in pipelined batches of FEEDBACK_RETENTION_BATCH messages.
+FEEDBACK_RETENTION=false disables the task.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from services import feedback_index, metrics, tracing
+from services.feedback_memory import (
+    MAX_AGE_DAYS,
+    REDIS_KEY_PREFIX,
+    _message_hash_key,
+    _message_index_registry,
+    _message_index_zkeys,
+    _user_messages_zkey,
+    init_redis_pool,
+)
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("FEEDBACK_RETENTION", "true").lower() not in ("0", "false", "no")
+INTERVAL = float(os.getenv("FEEDBACK_RETENTION_INTERVAL", "3600"))
+MAX_MESSAGES = int(os.getenv("FEEDBACK_MAX_MESSAGES", "1000"))
+COMPACT_AFTER_DAYS = float(os.getenv("FEEDBACK_COMPACT_AFTER_DAYS", "30"))
+AGGREGATE_TTL_DAYS = float(os.getenv("FEEDBACK_AGGREGATE_TTL_DAYS", "365"))
+BATCH = int(os.getenv("FEEDBACK_RETENTION_BATCH", "500"))
+
+AGGREGATE_PREFIX = REDIS_KEY_PREFIX + "fbagg:"
+LOCK_KEY = REDIS_KEY_PREFIX + "fbretention:lock"
+USER_KEY_PATTERN = _user_messages_zkey("*")
+_ZKEY_HEAD, _ZKEY_TAIL = _user_messages_zkey("\0").split("\0")
+
+RETENTION_MESSAGES = metrics.counter(
+    "mcp_feedback_retention_messages_total",
+    "Feedback-store messages handled by the retention sweep (compacted, expired, missing, preserved).",
+    ["action"],
+)
+RETENTION_SWEEP_SECONDS = metrics.histogram(
+    "mcp_feedback_retention_sweep_seconds",
+    "Duration of feedback retention sweeps.",
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0),
+)
+
+
+def aggregate_key(user_id: str, day: str) -> str:
+    return f"{AGGREGATE_PREFIX}{user_id}:{day}"
+
+
+def _day(timestamp: Optional[str]) -> str:
+    try:
+        return datetime.fromtimestamp(float(timestamp), tz=timezone.utc).strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        return "unknown"
+
+
+class FeedbackRetention:
+    """Periodic retention sweep over every user's feedback messages."""
+
+    def __init__(
+        self,
+        max_messages: int = MAX_MESSAGES,
+        compact_after_days: float = COMPACT_AFTER_DAYS,
+        max_age_days: float = MAX_AGE_DAYS,
+        interval: float = INTERVAL,
+        batch: int = BATCH,
+    ):
+        self.max_messages = max_messages
+        self.compact_after = compact_after_days * 86400
+        self.max_age = max_age_days * 86400
+        self.interval = interval
+        self.batch = max(1, batch)
+        self._task: Optional[asyncio.Task] = None
+
+    async def sweep_user(self, r: Any, user_id: str, now: Optional[float] = None) -> Dict[str, int]:
+        """Apply the policy to one user; returns counts per action."""
+        now = time.time() if now is None else now
+        zkey = _user_messages_zkey(user_id)
+        pipe = r.pipeline(transaction=False)
+        pipe.zcard(zkey)
+        pipe.zrangebyscore(zkey, "-inf", now - self.compact_after)
+        total, old = await pipe.execute()
+        overflow = await r.zrange(zkey, 0, total - self.max_messages - 1) if total > self.max_messages else []
+        candidates = list(dict.fromkeys(old + overflow))
+
+        counts = {"compacted": 0, "expired": 0, "missing": 0, "preserved": 0}
+        index_zkeys = await _message_index_zkeys(r, user_id) if candidates else []
+        for start in range(0, len(candidates), self.batch):
+            await self._sweep_batch(r, user_id, candidates[start:start + self.batch], now, counts, index_zkeys)
+            await asyncio.sleep(0)  # keep request handling responsive during long sweeps
+
+        if candidates and not await r.exists(zkey):
+            await r.delete(_message_index_registry(user_id), *index_zkeys)
+            await feedback_index.drop(r, user_id)
+        for action, count in counts.items():
+            if count:
+                RETENTION_MESSAGES.inc(count, action=action)
+        return counts
+
+    async def _sweep_batch(self, r: Any, user_id: str, message_ids: List[str], now: float,
+                           counts: Dict[str, int], index_zkeys: List[str]) -> None:
+        fetch = r.pipeline(transaction=False)
+        for mid in message_ids:
+            fetch.hmget(_message_hash_key(mid), "role", "timestamp", "score", "feedback")
+        rows = await fetch.execute()
+
+        drop: List[str] = []
+        aggregates: Dict[str, Dict[str, int]] = {}
+        for mid, (role, timestamp, score, feedback) in zip(message_ids, rows):
+            if role is None and timestamp is None:
+                drop.append(mid)
+                counts["missing"] += 1
+                continue
+            scored = bool(score) or bool(feedback)
+            age = now - float(timestamp or 0)
+            if scored and age < self.max_age:
+                counts["preserved"] += 1
+                continue
+            drop.append(mid)
+            counts["expired" if scored else "compacted"] += 1
+            day = aggregates.setdefault(_day(timestamp), {})
+            for field, amount in (("messages", 1), (f"role:{role or 'unknown'}", 1),
+                                  ("with_feedback", 1 if feedback else 0), ("scored", 1 if score else 0),
+                                  ("score_sum", int(score) if score else 0),
+                                  ("negative", 1 if score and int(score) < 3 else 0)):
+                if amount:
+                    day[field] = day.get(field, 0) + amount
+        if not drop:
+            return
+
+        pipe = r.pipeline(transaction=False)
+        await feedback_index.remove_documents(r, user_id, drop, pipe)
+        for day, fields in aggregates.items():
+            key = aggregate_key(user_id, day)
+            for field, amount in fields.items():
+                pipe.hincrby(key, field, amount)
+            pipe.expire(key, int(AGGREGATE_TTL_DAYS * 86400))
+        pipe.delete(*(_message_hash_key(mid) for mid in drop))
+        for zkey in [_user_messages_zkey(user_id)] + index_zkeys:
+            pipe.zrem(zkey, *drop)
+        with tracing.span("redis.feedback_retention", kind="client", count=len(drop)):
+            await pipe.execute()
+
+    async def sweep(self) -> Dict[str, int]:
+        """One pass over every user. Returns summed counts per action."""
+        r = await init_redis_pool()
+        if not await r.set(LOCK_KEY, 1, nx=True, ex=max(60, int(self.interval))):
+            logger.debug("Feedback retention sweep already running elsewhere")
+            return {}
+        started = time.monotonic()
+        totals: Dict[str, int] = {}
+        users = 0
+        try:
+            async for zkey in r.scan_iter(match=USER_KEY_PATTERN, count=self.batch):
+                if not (zkey.startswith(_ZKEY_HEAD) and zkey.endswith(_ZKEY_TAIL)):
+                    continue
+                user_id = zkey[len(_ZKEY_HEAD):len(zkey) - len(_ZKEY_TAIL)]
+                for action, count in (await self.sweep_user(r, user_id)).items():
+                    totals[action] = totals.get(action, 0) + count
+                users += 1
+        finally:
+            # the lock expires on its own; keeping it spaces sweeps across replicas by `interval`
+            RETENTION_SWEEP_SECONDS.observe(time.monotonic() - started)
+        logger.info("Feedback retention swept %d users: %s", users, totals)
+        return totals
+
+    async def _loop(self) -> None:
+        while True:
+            # jitter so replicas that start together do not contend for the lock
+            await asyncio.sleep(self.interval * random.uniform(0.9, 1.1))
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Feedback retention sweep failed")
+
+    def start(self) -> None:
+        """Start the periodic sweep on the running loop (no-op when disabled or running)."""
+        if ENABLED and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+async def get_daily_aggregates(user_id: str, days: List[str]) -> Dict[str, Dict[str, int]]:
+    """Aggregates for the given UTC days ("YYYY-MM-DD"); days without one are omitted."""
+    r = await init_redis_pool()
+    pipe = r.pipeline(transaction=False)
+    for day in days:
+        pipe.hgetall(aggregate_key(user_id, day))
+    rows = await pipe.execute()
+    return {day: {k: int(v) for k, v in row.items()} for day, row in zip(days, rows) if row}
+
+
+feedback_retention = FeedbackRetention()
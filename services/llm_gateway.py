@@ -0,0 +1,376 @@
+"""
+Single entry point for OpenAI calls.
+
+Every chat completion and embedding in the service goes through `llm`:
+
+- One lazily created AsyncOpenAI client per process, so calls share its
+  connection pool instead of opening a new client per request.
+- Separate lanes for chat and embeddings, each with its own concurrency limit,
+  so a burst of embeddings cannot starve chat completions (or the reverse).
+- Requests-per-minute and tokens-per-minute budgets per lane (token buckets
+  refilled continuously). Prompt tokens are estimated up front (~4 chars per
+  token, plus max_tokens) and corrected from the response's `usage` block.
+- Waiting calls are served in priority order: user-facing turns
+  (PRIORITY_INTERACTIVE) before background work such as summarization
+  (PRIORITY_BACKGROUND); FIFO within a priority.
+- A provider 429 pauses the lane for its Retry-After (default 1s) so the
+  next callers queue here instead of hitting the provider again.
+- Every call is bounded by the current turn's deadline (services.deadline)
+  and raises deadline.DeadlineExceeded when it runs out.
+- chat(hedge=True) sends a second identical request when the first has not
+  answered within the LLM_HEDGE_PERCENTILE of recent latencies for that
+  purpose, and keeps whichever answers first. Hedges are capped at
+  LLM_HEDGE_MAX_RATIO of hedge-eligible calls so spend stays bounded.
+
+Tuning (env):
+    LLM_CHAT_CONCURRENCY / LLM_EMBED_CONCURRENCY   calls in flight per lane (16 / 32)
+    LLM_CHAT_RPM / LLM_CHAT_TPM                    chat budgets per minute (3500 / 90000, 0 = unlimited)
+    LLM_EMBED_RPM / LLM_EMBED_TPM                  embedding budgets per minute (3000 / 1000000)
+    LLM_DEFAULT_COMPLETION_TOKENS                  completion estimate when max_tokens is unset (256)
+    OPENAI_MAX_RETRIES / OPENAI_TIMEOUT            client retries and request timeout (2 / 60s)
+    LLM_HEDGE                                      "false" disables hedging
+    LLM_HEDGE_PERCENTILE / LLM_HEDGE_MAX_RATIO     hedge trigger percentile and cap (95 / 0.1)
+    LLM_HEDGE_DELAY / LLM_HEDGE_MIN_DELAY          delay before enough samples exist, and floor (3s / 0.5s)
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Deque, Dict, List, Optional, Tuple
+
+from openai import AsyncOpenAI, RateLimitError
+
+from services import deadline, metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+DEFAULT_COMPLETION_TOKENS = int(os.getenv("LLM_DEFAULT_COMPLETION_TOKENS", "256"))
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+THROTTLE_PAUSE = 1.0
+
+HEDGE_ENABLED = os.getenv("LLM_HEDGE", "true").lower() not in ("0", "false", "no")
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "3"))
+HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.1"))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 256
+
+LLM_IN_FLIGHT = metrics.gauge(
+    "mcp_llm_in_flight",
+    "OpenAI calls currently running, per gateway lane.",
+    ["lane"],
+)
+LLM_QUEUED = metrics.gauge(
+    "mcp_llm_queued",
+    "OpenAI calls waiting for a slot or budget, per gateway lane.",
+    ["lane"],
+)
+LLM_QUEUE_SECONDS = metrics.histogram(
+    "mcp_llm_queue_wait_seconds",
+    "Time OpenAI calls waited in the gateway before being sent.",
+    ["lane", "priority"],
+)
+LLM_HEDGES = metrics.counter(
+    "mcp_llm_hedges_total",
+    "Hedged LLM requests by purpose: sent, and which attempt answered first (primary_won/hedge_won).",
+    ["purpose", "outcome"],
+)
+LLM_DEADLINE_EXCEEDED = metrics.counter(
+    "mcp_llm_deadline_exceeded_total",
+    "LLM calls abandoned because the turn deadline passed.",
+    ["purpose"],
+)
+LLM_THROTTLED = metrics.counter(
+    "mcp_llm_provider_throttled_total",
+    "OpenAI 429 responses that reached the gateway (after client retries).",
+    ["lane"],
+)
+
+
+class _Budget:
+    """Token bucket holding `per_minute` units, refilled continuously; may go negative after corrections."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available (0 if they are now)."""
+        if self.unlimited:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)  # oversize requests only wait for a full bucket
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        if not self.unlimited:
+            self.level -= amount
+
+
+class _Lane:
+    """Concurrency slots + RPM/TPM budgets, granted to waiters in priority order."""
+
+    def __init__(self, name: str, concurrency: int, rpm: int, tpm: int):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.requests = _Budget(rpm)
+        self.tokens = _Budget(tpm)
+        self.active = 0
+        self.paused_until = 0.0
+        self._waiters: List[Tuple[int, int, float, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _export(self) -> None:
+        LLM_IN_FLIGHT.set(self.active, lane=self.name)
+        LLM_QUEUED.set(sum(1 for w in self._waiters if not w[3].done()), lane=self.name)
+
+    def _pump(self) -> None:
+        self._timer = None
+        while self._waiters and self.active < self.concurrency:
+            priority, _, tokens, waiter = self._waiters[0]
+            if waiter.done():  # caller gave up while queued
+                heapq.heappop(self._waiters)
+                continue
+            now = time.monotonic()
+            delay = max(self.paused_until - now, self.requests.wait_for(1, now), self.tokens.wait_for(tokens, now))
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._pump)
+                break
+            heapq.heappop(self._waiters)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.active += 1
+            waiter.set_result(None)
+        self._export()
+
+    async def acquire(self, priority: int, tokens: float) -> None:
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), tokens, waiter))
+        if self._timer is None:
+            self._pump()
+        if waiter.done():
+            return
+        self._export()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # granted just as the caller was cancelled
+            raise
+
+    def release(self) -> None:
+        self.active -= 1
+        if self._timer is None:
+            self._pump()
+        else:
+            self._export()
+
+    def correct(self, estimated: float, actual: float) -> None:
+        self.tokens.take(actual - estimated)
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def estimate_tokens(payload: Any) -> int:
+    """Cheap prompt-size estimate (~4 characters per token) for budgeting."""
+    if payload is None:
+        return 0
+    if isinstance(payload, str):
+        return len(payload) // 4 + 1
+    if isinstance(payload, dict):
+        return sum(estimate_tokens(v) for v in payload.values()) + 4
+    if isinstance(payload, (list, tuple)):
+        return sum(estimate_tokens(v) for v in payload)
+    return 1
+
+
+def _retry_after(error: RateLimitError) -> float:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return max(0.0, float(value)) if value else THROTTLE_PAUSE
+    except ValueError:
+        return THROTTLE_PAUSE
+
+
+class LLMGateway:
+    def __init__(self):
+        self._client: Optional[AsyncOpenAI] = None
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._hedge_eligible = 0
+        self._hedges_sent = 0
+        self.chat_lane = _Lane(
+            "chat",
+            int(os.getenv("LLM_CHAT_CONCURRENCY", "16")),
+            int(os.getenv("LLM_CHAT_RPM", "3500")),
+            int(os.getenv("LLM_CHAT_TPM", "90000")),
+        )
+        self.embed_lane = _Lane(
+            "embedding",
+            int(os.getenv("LLM_EMBED_CONCURRENCY", "32")),
+            int(os.getenv("LLM_EMBED_RPM", "3000")),
+            int(os.getenv("LLM_EMBED_TPM", "1000000")),
+        )
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        """The shared AsyncOpenAI client (created on first use)."""
+        if self._client is None:
+            self._client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=MAX_RETRIES, timeout=TIMEOUT)
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    @asynccontextmanager
+    async def _slot(self, lane: _Lane, priority: int, tokens: float) -> AsyncIterator[None]:
+        started = time.monotonic()
+        await lane.acquire(priority, tokens)
+        LLM_QUEUE_SECONDS.observe(time.monotonic() - started, lane=lane.name, priority=str(priority))
+        try:
+            yield
+        except RateLimitError as e:
+            LLM_THROTTLED.inc(lane=lane.name)
+            lane.pause(_retry_after(e))
+            logger.warning("OpenAI throttled the %s lane; pausing it", lane.name)
+            raise
+        finally:
+            lane.release()
+
+    async def _within_deadline(self, purpose: str, call: Awaitable[Any]) -> Any:
+        """Await `call`, bounded by the current turn's deadline (services.deadline)."""
+        left = deadline.remaining()
+        if left is None:
+            return await call
+        try:
+            if left <= 0:
+                raise asyncio.TimeoutError
+            return await asyncio.wait_for(call, left)
+        except asyncio.TimeoutError:
+            if asyncio.iscoroutine(call):
+                call.close()
+            LLM_DEADLINE_EXCEEDED.inc(purpose=purpose)
+            raise deadline.DeadlineExceeded(f"Deadline exceeded waiting for LLM ({purpose})") from None
+
+    async def _chat_once(self, purpose: str, priority: int, estimate: float, kwargs: Dict[str, Any],
+                         started: Optional[asyncio.Event] = None) -> Any:
+        model = kwargs.get("model", "")
+        async with self._slot(self.chat_lane, priority, estimate):
+            if started is not None:
+                started.set()
+            began = time.monotonic()
+            with tracing.span("openai.chat", kind="client", purpose=purpose, model=model):
+                response = await self.client.chat.completions.create(**kwargs)
+            self._latencies.setdefault(purpose, deque(maxlen=LATENCY_SAMPLES)).append(time.monotonic() - began)
+        self._account(self.chat_lane, response, estimate, model, purpose)
+        return response
+
+    def hedge_delay(self, purpose: str) -> float:
+        """How long the first attempt may run before a hedge: the HEDGE_PERCENTILE of recent latencies."""
+        samples = self._latencies.get(purpose)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE / 100.0))
+        return max(HEDGE_MIN_DELAY, ordered[index])
+
+    def _may_hedge(self) -> bool:
+        return self._hedges_sent < HEDGE_MAX_RATIO * self._hedge_eligible + 1
+
+    async def _hedged_chat(self, purpose: str, priority: int, estimate: float, kwargs: Dict[str, Any]) -> Any:
+        self._hedge_eligible += 1
+        started = asyncio.Event()
+        primary = asyncio.ensure_future(self._chat_once(purpose, priority, estimate, kwargs, started))
+        tasks = [primary]
+        try:
+            # the hedge timer starts once the primary holds a slot, so queueing in the
+            # gateway is not mistaken for a slow completion
+            holding = asyncio.ensure_future(started.wait())
+            tasks.append(holding)
+            await asyncio.wait({primary, holding}, return_when=asyncio.FIRST_COMPLETED)
+            if not primary.done():
+                await asyncio.wait({primary}, timeout=self.hedge_delay(purpose))
+            if primary.done() or not self._may_hedge():
+                return await primary
+
+            self._hedges_sent += 1
+            LLM_HEDGES.inc(purpose=purpose, outcome="sent")
+            hedge = asyncio.ensure_future(self._chat_once(purpose, priority, estimate, kwargs))
+            tasks.append(hedge)
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        LLM_HEDGES.inc(purpose=purpose, outcome="hedge_won" if task is hedge else "primary_won")
+                        return task.result()
+            return await primary  # both failed: surface the first attempt's error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def chat(self, purpose: str, priority: int = PRIORITY_INTERACTIVE, hedge: bool = False,
+                   **kwargs: Any) -> Any:
+        """
+        chat.completions.create(**kwargs) through the chat lane.
+
+        `purpose` labels the call in traces and token metrics (sql_generation, summarization, ...).
+        With `hedge`, a second identical request is sent when the first has not answered within
+        the recent latency percentile for `purpose`; the first answer wins and the other is
+        cancelled. Either way the call is bounded by the turn deadline (DeadlineExceeded).
+        """
+        estimate = estimate_tokens(kwargs.get("messages")) + (kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+        if hedge and HEDGE_ENABLED:
+            call = self._hedged_chat(purpose, priority, estimate, kwargs)
+        else:
+            call = self._chat_once(purpose, priority, estimate, kwargs)
+        return await self._within_deadline(purpose, call)
+
+    async def _embed_once(self, purpose: str, priority: int, kwargs: Dict[str, Any]) -> Any:
+        model = kwargs.get("model", "")
+        estimate = estimate_tokens(kwargs.get("input"))
+        async with self._slot(self.embed_lane, priority, estimate):
+            with tracing.span("openai.embeddings", kind="client", purpose=purpose, model=model):
+                response = await self.client.embeddings.create(**kwargs)
+        self._account(self.embed_lane, response, estimate, model, purpose)
+        return response
+
+    async def embed(self, purpose: str = "embedding", priority: int = PRIORITY_INTERACTIVE, **kwargs: Any) -> Any:
+        """embeddings.create(**kwargs) through the embedding lane, bounded by the turn deadline."""
+        return await self._within_deadline(purpose, self._embed_once(purpose, priority, kwargs))
+
+    @staticmethod
+    def _account(lane: _Lane, response: Any, estimate: float, model: str, purpose: str) -> None:
+        metrics.record_llm_usage(response, model, purpose)
+        usage = getattr(response, "usage", None)
+        total = getattr(usage, "total_tokens", None) if usage is not None else None
+        if total:
+            lane.correct(estimate, total)
+
+
+llm = LLMGateway()
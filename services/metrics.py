@@ -0,0 +1,328 @@
+"""
+Lightweight in-process metrics registry with Prometheus text exposition.
+
+Provides Counter, Gauge and Histogram types with label support, a few
+pre-registered metrics used across the pipeline, and helpers:
+
+- time_stage(stage): context manager timing one MCPAgent pipeline stage
+  (also opens a `stage.<name>` tracing span).
+- observe_tool(tool_name): context manager timing a tool call (status ok/error),
+  also traced as a `tool.<name>` span.
+- record_llm_usage(response, model, purpose): token counters (prompt, completion,
+  cached prompt) from an OpenAI response.
+- record_cache(cache, hit): cache hit/miss counters.
+- register_collector(fn): callback run before each scrape to refresh gauges
+  (e.g. DB/Redis pool utilisation).
+- render_latest(): Prometheus text format for the /metrics endpoint.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from services import tracing
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(str(v))}"' for n, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        return "\n".join(header + self.samples())
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                for k, v in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                for k, v in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # per label key: [bucket counts..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def get_sum_count(self, **labels) -> Tuple[float, float]:
+        state = self._values.get(self._key(labels))
+        if not state:
+            return 0.0, 0.0
+        return state[-2], state[-1]
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, state in sorted(self._values.items()):
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = ("le", _format_value(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {_format_value(cumulative)}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {_format_value(state[-1])}")
+        return lines
+
+
+_registry: Dict[str, _Metric] = {}
+_collectors: List[Callable[[], None]] = []
+
+
+def _get_or_create(cls, name: str, documentation: str, labelnames: Sequence[str], **kwargs):
+    with _lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, documentation, labelnames, **kwargs)
+    if not isinstance(metric, cls):
+        raise ValueError(f"Metric {name} already registered as {metric.type_name}")
+    return metric
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return _get_or_create(Counter, name, documentation, labelnames)
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return _get_or_create(Gauge, name, documentation, labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+    return _get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def register_collector(fn: Callable[[], None]) -> None:
+    """Register a callback that refreshes gauges right before each scrape."""
+    _collectors.append(fn)
+
+
+def render_latest() -> str:
+    for collect in list(_collectors):
+        try:
+            collect()
+        except Exception:
+            logger.exception("Metrics collector failed")
+    with _lock:
+        metrics = list(_registry.values())
+    return "\n".join(m.render() for m in metrics) + "\n"
+
+
+#### pipeline metrics
+STAGE_SECONDS = histogram(
+    "mcp_stage_duration_seconds",
+    "Time spent in each MCPAgent pipeline stage.",
+    ["stage"],
+)
+TOOL_SECONDS = histogram(
+    "mcp_tool_duration_seconds",
+    "Tool execution time by tool and outcome.",
+    ["tool", "status"],
+)
+LLM_TOKENS = counter(
+    "mcp_llm_tokens_total",
+    "LLM tokens reported by the provider (kind: prompt, completion, cached = prompt tokens served from the prompt cache).",
+    ["model", "purpose", "kind"],
+)
+LLM_REQUESTS = counter(
+    "mcp_llm_requests_total",
+    "LLM API calls by model and purpose.",
+    ["model", "purpose"],
+)
+CACHE_REQUESTS = counter(
+    "mcp_cache_requests_total",
+    "Cache lookups by cache name and result (hit/miss).",
+    ["cache", "result"],
+)
+CACHE_HIT_RATIO = gauge(
+    "mcp_cache_hit_ratio",
+    "Hit ratio per cache since process start.",
+    ["cache"],
+)
+DB_CONNECTIONS_IN_USE = gauge(
+    "mcp_db_connections_in_use",
+    "Postgres connections currently checked out.",
+)
+REDIS_POOL_CONNECTIONS = gauge(
+    "mcp_redis_pool_connections",
+    "Redis connection pool usage by client and state (in_use/available).",
+    ["client", "state"],
+)
+
+
+@contextmanager
+def time_stage(stage: str) -> Iterator[None]:
+    """Time a pipeline stage; recorded even when the stage raises."""
+    started = time.perf_counter()
+    try:
+        with tracing.span(f"stage.{stage}"):
+            yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+@contextmanager
+def observe_tool(tool_name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        with tracing.span(f"tool.{tool_name}"):
+            yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        TOOL_SECONDS.observe(time.perf_counter() - started, tool=tool_name, status=status)
+
+
+def record_llm_usage(response: Any, model: str, purpose: str) -> None:
+    """Count an LLM call and the prompt/completion/cached tokens from its `usage` block (if any)."""
+    LLM_REQUESTS.inc(model=model, purpose=purpose)
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+    completion_tokens = getattr(usage, "completion_tokens", None) or 0
+    if prompt_tokens:
+        LLM_TOKENS.inc(prompt_tokens, model=model, purpose=purpose, kind="prompt")
+    if completion_tokens:
+        LLM_TOKENS.inc(completion_tokens, model=model, purpose=purpose, kind="completion")
+    # prompt tokens served from the provider's prompt cache (a subset of "prompt")
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    if cached_tokens:
+        LLM_TOKENS.inc(cached_tokens, model=model, purpose=purpose, kind="cached")
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def _collect_cache_ratios() -> None:
+    caches = {key[0] for key in CACHE_REQUESTS._values}
+    for cache in caches:
+        hits = CACHE_REQUESTS.get(cache=cache, result="hit")
+        misses = CACHE_REQUESTS.get(cache=cache, result="miss")
+        total = hits + misses
+        CACHE_HIT_RATIO.set(hits / total if total else 0.0, cache=cache)
+
+
+register_collector(_collect_cache_ratios)
+
+
+def track_redis_pool(client_name: str, client: Any) -> None:
+    """
+    Export pool utilisation for a redis-py client (sync or asyncio).
+    Safe to call with None or with clients whose pool has no introspection attributes.
+    """
+    def collect():
+        pool = getattr(client, "connection_pool", None)
+        if pool is None:
+            return
+        in_use = len(getattr(pool, "_in_use_connections", ()) or ())
+        available = len(getattr(pool, "_available_connections", ()) or ())
+        REDIS_POOL_CONNECTIONS.set(in_use, client=client_name, state="in_use")
+        REDIS_POOL_CONNECTIONS.set(available, client=client_name, state="available")
+
+    if client is not None:
+        register_collector(collect)
@@ -0,0 +1,228 @@
+"""
+Per-user request rate limiting (GCRA, the token-bucket equivalent that keeps
+one timestamp per key).
+
+Each key stores only its "theoretical arrival time" (TAT), so a check is O(1)
+in time and space regardless of the limit:
+
+- In Redis the check is a single Lua script (atomic across every backend
+  replica), using the Redis server clock; the key expires once the bucket
+  would be full again, so idle users cost nothing.
+- If Redis is disabled or unreachable the same algorithm runs in-process on a
+  TTL cache (per-replica limits, but requests are still limited). After a
+  Redis error the local limiter is used for RATE_LIMIT_REDIS_RETRY seconds
+  before Redis is tried again.
+
+Tiers (env):
+    RATE_LIMIT_TIERS          "name=requests/period_seconds[:burst]", comma separated
+                              (default "default=5/60"); a tier with requests 0 is unlimited
+    RATE_LIMIT_DEFAULT_TIER   tier for users without an explicit one (default "default")
+    RATE_LIMIT_USER_TIERS     "user_id=tier", comma separated
+    RATE_LIMIT_REDIS          "false" for the in-process limiter only
+    RATE_LIMIT_REDIS_RETRY    seconds to stay on the local limiter after a Redis error (default 5)
+
+check() returns a RateLimitResult with `allowed`, `remaining` and
+`retry_after` (seconds until the next request would be accepted).
+"""
+
+import logging
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from cachetools import TTLCache
+
+from services import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "vartopia:") + "ratelimit:"
+REDIS_ENABLED = os.getenv("RATE_LIMIT_REDIS", "true").lower() not in ("0", "false", "no")
+REDIS_RETRY = float(os.getenv("RATE_LIMIT_REDIS_RETRY", "5"))
+LOCAL_MAX_KEYS = int(os.getenv("RATE_LIMIT_LOCAL_MAX_KEYS", "100000"))
+
+# KEYS[1] = bucket key; ARGV = emission interval (ms), burst tolerance (ms).
+# Returns {allowed (0/1), remaining, retry_after_ms}.
+GCRA_LUA = """
+local interval = tonumber(ARGV[1])
+local tolerance = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local tat = tonumber(redis.call('GET', KEYS[1])) or now
+if tat < now then tat = now end
+local new_tat = tat + interval
+local allow_at = new_tat - tolerance
+if now < allow_at then
+  return {0, 0, allow_at - now}
+end
+redis.call('SET', KEYS[1], new_tat, 'PX', math.max(1, new_tat - now))
+return {1, math.floor((now - allow_at) / interval), 0}
+"""
+
+RATE_LIMIT_DECISIONS = metrics.counter(
+    "mcp_rate_limit_decisions_total",
+    "Rate limiter decisions by tier, outcome (allowed/limited) and backend (redis/local).",
+    ["tier", "outcome", "backend"],
+)
+RATE_LIMIT_BACKEND_ERRORS = metrics.counter(
+    "mcp_rate_limit_backend_errors_total",
+    "Redis errors that made the rate limiter fall back to the in-process limiter.",
+)
+
+
+@dataclass(frozen=True)
+class Tier:
+    name: str
+    requests: int
+    period: float
+    burst: int
+
+    @property
+    def unlimited(self) -> bool:
+        return self.requests <= 0
+
+    @property
+    def interval(self) -> float:
+        """Seconds between requests at the sustained rate."""
+        return self.period / self.requests
+
+    @property
+    def tolerance(self) -> float:
+        """How far ahead of `now` the TAT may run: `burst` requests back to back."""
+        return self.interval * self.burst
+
+
+@dataclass
+class RateLimitResult:
+    allowed: bool
+    tier: str
+    remaining: int = 0
+    retry_after: float = 0.0
+    backend: str = "local"
+
+    def retry_after_header(self) -> str:
+        """Retry-After value in whole seconds (never 0 for a rejection)."""
+        return str(max(1, math.ceil(self.retry_after)))
+
+    def to_dict(self) -> Dict[str, object]:
+        result: Dict[str, object] = {"allowed": self.allowed, "tier": self.tier, "remaining": self.remaining}
+        if not self.allowed:
+            result["retry_after"] = round(self.retry_after, 3)
+            result["error"] = "Rate limit exceeded"
+        return result
+
+
+def parse_tiers(spec: str) -> Dict[str, Tier]:
+    """Parse "name=requests/period[:burst],..." into tiers; malformed entries are skipped."""
+    tiers: Dict[str, Tier] = {}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            name, limit = entry.split("=", 1)
+            limit, _, burst = limit.partition(":")
+            requests, _, period = limit.partition("/")
+            requests_n = int(requests)
+            period_s = float(period or 60)
+            burst_n = int(burst) if burst else max(1, requests_n)
+            if period_s <= 0 or burst_n <= 0:
+                raise ValueError("period and burst must be positive")
+        except ValueError:
+            logger.warning("Ignoring malformed rate limit tier %r", entry)
+            continue
+        tiers[name.strip()] = Tier(name.strip(), requests_n, period_s, burst_n)
+    return tiers
+
+
+def _parse_user_tiers(spec: str) -> Dict[str, str]:
+    pairs = (entry.split("=", 1) for entry in spec.split(",") if "=" in entry)
+    return {user.strip(): tier.strip() for user, tier in pairs}
+
+
+class RateLimiter:
+    """GCRA limiter with an atomic Redis backend and an in-process fallback."""
+
+    def __init__(
+        self,
+        tiers: Optional[Dict[str, Tier]] = None,
+        default_tier: str = os.getenv("RATE_LIMIT_DEFAULT_TIER", "default"),
+        user_tiers: Optional[Dict[str, str]] = None,
+        use_redis: bool = REDIS_ENABLED,
+    ):
+        self.tiers = tiers if tiers is not None else parse_tiers(os.getenv("RATE_LIMIT_TIERS", "default=5/60"))
+        if default_tier not in self.tiers:
+            logger.warning("Rate limit tier %r is not configured; using 5 requests/60s", default_tier)
+            self.tiers[default_tier] = Tier(default_tier, 5, 60.0, 5)
+        self.default_tier = default_tier
+        self.user_tiers = user_tiers if user_tiers is not None else _parse_user_tiers(
+            os.getenv("RATE_LIMIT_USER_TIERS", ""))
+        self.use_redis = use_redis
+        self._script = None
+        self._redis_down_until = 0.0
+        # a bucket is back to full once `tolerance` has passed, so that is all a key needs to live
+        ttl = max((t.tolerance for t in self.tiers.values() if not t.unlimited), default=60.0)
+        self._local: "TTLCache[str, float]" = TTLCache(maxsize=LOCAL_MAX_KEYS, ttl=ttl)
+
+    def tier_for(self, user_id: str, tier: Optional[str] = None) -> Tier:
+        name = tier or self.user_tiers.get(user_id) or self.default_tier
+        return self.tiers.get(name) or self.tiers[self.default_tier]
+
+    async def _redis_script(self):
+        if not self.use_redis or time.monotonic() < self._redis_down_until:
+            return None
+        if self._script is None:
+            try:
+                from services.feedback_memory import init_redis_pool
+                r = await init_redis_pool()
+            except Exception:
+                self._redis_failed("connect")
+                return None
+            self._script = r.register_script(GCRA_LUA)
+        return self._script
+
+    def _redis_failed(self, what: str) -> None:
+        RATE_LIMIT_BACKEND_ERRORS.inc()
+        self._redis_down_until = time.monotonic() + REDIS_RETRY
+        logger.warning("Rate limiter Redis %s failed; using in-process limiter for %.0fs", what, REDIS_RETRY)
+
+    async def _check_redis(self, key: str, tier: Tier) -> Optional[RateLimitResult]:
+        script = await self._redis_script()
+        if script is None:
+            return None
+        try:
+            with tracing.span("redis.rate_limit", kind="client"):
+                allowed, remaining, retry_ms = await script(
+                    keys=[REDIS_KEY_PREFIX + key],
+                    args=[max(1, round(tier.interval * 1000)), round(tier.tolerance * 1000)],
+                )
+        except Exception:
+            self._redis_failed("call")
+            return None
+        return RateLimitResult(bool(int(allowed)), tier.name, int(remaining), int(retry_ms) / 1000.0, "redis")
+
+    def _check_local(self, key: str, tier: Tier) -> RateLimitResult:
+        now = time.monotonic()
+        tat = max(self._local.get(key, now), now)
+        new_tat = tat + tier.interval
+        allow_at = new_tat - tier.tolerance
+        if now < allow_at:
+            return RateLimitResult(False, tier.name, 0, allow_at - now)
+        self._local[key] = new_tat
+        return RateLimitResult(True, tier.name, int((now - allow_at) // tier.interval), 0.0)
+
+    async def check(self, user_id: str, tier: Optional[str] = None) -> RateLimitResult:
+        """Consume one request for `user_id`; the result says whether it may proceed."""
+        limits = self.tier_for(str(user_id), tier)
+        if limits.unlimited:
+            return RateLimitResult(True, limits.name, remaining=-1, backend="none")
+        key = f"{limits.name}:{user_id}"
+        result = await self._check_redis(key, limits) or self._check_local(key, limits)
+        RATE_LIMIT_DECISIONS.inc(tier=limits.name, outcome="allowed" if result.allowed else "limited",
+                                 backend=result.backend)
+        return result
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,322 @@
+"""
+Minimal distributed tracing with W3C trace-context propagation.
+
+Spans are kept in a ContextVar, so they follow asyncio tasks automatically.
+A trace carries a correlation ID that is propagated alongside `traceparent`:
+
+- HTTP: `traceparent` and `X-Correlation-Id` headers (see TracingMiddleware
+  for inbound requests and inject_headers() for outbound calls).
+- JSON-RPC: `params._meta` with `traceparent` and `correlationId`
+  (see span(..., meta=params.get("_meta"))).
+
+Inbound correlation IDs that are not strings of at most 128 characters from
+[A-Za-z0-9._:-] are replaced with a new UUID.
+
+Finished spans are exported in OTLP JSON shape by a background thread to
+either a JSONL file or an OTLP/HTTP collector:
+
+    TRACE_EXPORTER=file  TRACE_FILE=traces.jsonl
+    TRACE_EXPORTER=otlp  OTEL_EXPORTER_OTLP_ENDPOINT=http://otel-collector:4318
+    TRACE_EXPORTER=none  (default; spans are still created so IDs propagate)
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", os.getenv("HOSTNAME", "mcp-backend"))
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")
+
+CORRELATION_HEADER = "X-Correlation-Id"
+TRACEPARENT_HEADER = "traceparent"
+
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+# inbound correlation IDs end up in response and outbound headers and in logs
+_CORRELATION_RE = re.compile(r"^[A-Za-z0-9._:\-]{1,128}$")
+
+
+def valid_correlation_id(value: Any) -> Optional[str]:
+    """`value` if it is a safe correlation ID (bounded, header-safe string), else None."""
+    if isinstance(value, str) and _CORRELATION_RE.match(value):
+        return value
+    return None
+
+
+class SpanContext:
+    """Identifies a (possibly remote) parent span."""
+
+    def __init__(self, trace_id: str, span_id: str, correlation_id: str):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.correlation_id = correlation_id
+
+
+class Span:
+    def __init__(self, name: str, kind: str, parent: Optional[SpanContext],
+                 correlation_id: Optional[str] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.correlation_id = (valid_correlation_id(correlation_id)
+                               or (parent.correlation_id if parent else None) or str(uuid.uuid4()))
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    @property
+    def context(self) -> SpanContext:
+        return SpanContext(self.trace_id, self.span_id, self.correlation_id)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def record_exception(self, exc: BaseException) -> None:
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def to_otlp(self) -> Dict[str, Any]:
+        attributes = dict(self.attributes)
+        attributes["correlation.id"] = self.correlation_id
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KINDS.get(self.kind, 1),
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [_otlp_attribute(k, v) for k, v in attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class _BatchExporter:
+    """Buffers finished spans and exports them from a daemon thread."""
+
+    def __init__(self, export_fn, max_batch: int = 512, interval: float = 2.0):
+        self._export_fn = export_fn
+        self._queue: "queue.Queue[Span]" = queue.Queue(maxsize=10000)
+        self._max_batch = max_batch
+        self._interval = interval
+        self._thread = threading.Thread(target=self._loop, name="trace-exporter", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            logger.debug("Trace export queue full; dropping span %s", span.name)
+
+    def _drain(self, first: Optional[Span] = None) -> List[Span]:
+        batch = [first] if first else []
+        while len(batch) < self._max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                first = self._queue.get(timeout=self._interval)
+            except queue.Empty:
+                continue
+            self._export(self._drain(first))
+
+    def _export(self, batch: List[Span]) -> None:
+        if not batch:
+            return
+        try:
+            self._export_fn(batch)
+        except Exception:
+            logger.exception("Trace export failed (%d spans dropped)", len(batch))
+
+    def flush(self) -> None:
+        self._export(self._drain())
+
+
+def _export_file(batch: List[Span]) -> None:
+    with open(TRACE_FILE, "a", encoding="utf-8") as f:
+        for span in batch:
+            record = span.to_otlp()
+            record["service"] = SERVICE_NAME
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+def _export_otlp(batch: List[Span]) -> None:
+    payload = {
+        "resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "mcp"}, "spans": [s.to_otlp() for s in batch]}],
+        }]
+    }
+    request = urllib.request.Request(
+        f"{OTLP_ENDPOINT.rstrip('/')}/v1/traces",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=5) as res:
+        res.read()
+
+
+_exporter: Optional[_BatchExporter] = None
+if TRACE_EXPORTER == "file":
+    _exporter = _BatchExporter(_export_file)
+elif TRACE_EXPORTER == "otlp":
+    _exporter = _BatchExporter(_export_otlp)
+
+
+def parse_traceparent(value: Optional[str], correlation_id: Optional[str] = None) -> Optional[SpanContext]:
+    if not value or not isinstance(value, str):
+        return None
+    match = _TRACEPARENT_RE.match(value.strip().lower())
+    if not match:
+        return None
+    return SpanContext(match.group(1), match.group(2), valid_correlation_id(correlation_id) or str(uuid.uuid4()))
+
+
+def context_from_headers(headers: Dict[str, str]) -> Tuple[Optional[SpanContext], Optional[str]]:
+    """Return (remote parent, correlation id) from case-insensitive HTTP headers."""
+    lowered = {k.lower(): v for k, v in headers.items()}
+    correlation_id = valid_correlation_id(lowered.get(CORRELATION_HEADER.lower()))
+    return parse_traceparent(lowered.get(TRACEPARENT_HEADER), correlation_id), correlation_id
+
+
+def context_from_meta(meta: Optional[Dict[str, Any]]) -> Tuple[Optional[SpanContext], Optional[str]]:
+    """Return (remote parent, correlation id) from a JSON-RPC `params._meta` dict."""
+    if not isinstance(meta, dict):
+        return None, None
+    correlation_id = valid_correlation_id(meta.get("correlationId"))
+    return parse_traceparent(meta.get(TRACEPARENT_HEADER), correlation_id), correlation_id
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", meta: Optional[Dict[str, Any]] = None,
+         parent: Optional[SpanContext] = None, correlation_id: Optional[str] = None,
+         **attributes) -> Iterator[Span]:
+    """
+    Start a span as a child of `parent`, of the trace in `meta` (JSON-RPC _meta),
+    or of the current span, in that order of preference.
+    """
+    if parent is None and meta is not None:
+        parent, meta_correlation = context_from_meta(meta)
+        correlation_id = correlation_id or meta_correlation
+    if parent is None:
+        current = _current_span.get()
+        parent = current.context if current else None
+
+    s = Span(name, kind, parent, correlation_id, attributes)
+    token = _current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.record_exception(e)
+        raise
+    finally:
+        s.end_ns = time.time_ns()
+        _current_span.reset(token)
+        if _exporter:
+            _exporter.submit(s)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def current_correlation_id() -> Optional[str]:
+    s = _current_span.get()
+    return s.correlation_id if s else None
+
+
+def inject_headers(headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Add traceparent and X-Correlation-Id for the current span to outbound HTTP headers."""
+    headers = dict(headers or {})
+    s = _current_span.get()
+    if s:
+        headers[TRACEPARENT_HEADER] = s.traceparent
+        headers.setdefault(CORRELATION_HEADER, s.correlation_id)
+    return headers
+
+
+def inject_meta(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Add the current trace to JSON-RPC params under `_meta`."""
+    s = _current_span.get()
+    if s:
+        meta = dict(params.get("_meta") or {})
+        meta[TRACEPARENT_HEADER] = s.traceparent
+        meta.setdefault("correlationId", s.correlation_id)
+        params = {**params, "_meta": meta}
+    return params
+
+
+class TracingMiddleware:
+    """
+    Pure ASGI middleware: opens a server span per HTTP request, continuing the
+    caller's trace when `traceparent` is present, and echoes X-Correlation-Id
+    on the response.
+    """
+
+    def __init__(self, app, service_name: Optional[str] = None):
+        self.app = app
+        self.service_name = service_name or SERVICE_NAME
+
+    async def __call__(self, scope, receive, send):
+        if scope.get("type") != "http":
+            return await self.app(scope, receive, send)
+
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        parent, correlation_id = context_from_headers(headers)
+        name = f"{scope.get('method', 'GET')} {scope.get('path', '')}"
+
+        with span(name, kind="server", parent=parent, correlation_id=correlation_id,
+                  **{"service": self.service_name, "http.target": scope.get("path", "")}) as s:
+
+            async def send_with_correlation(message):
+                if message["type"] == "http.response.start":
+                    s.set_attribute("http.status_code", message.get("status", 0))
+                    response_headers = list(message.get("headers", []))
+                    response_headers.append((CORRELATION_HEADER.lower().encode(), s.correlation_id.encode()))
+                    message = {**message, "headers": response_headers}
+                await send(message)
+
+            await self.app(scope, receive, send_with_correlation)
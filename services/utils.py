@@ -2,6 +2,7 @@ import json
 import logging
 from typing import List,Dict
 from models.schemas import ChatMessage
+from services.context_packer import count_tokens
 
 logger=logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -17,17 +18,18 @@ def format_chat_history(history:List[Dict[str,str]])->str:
 
 def truncate_history(history:List[Dict[str,str]],max_tokens:int=2000)->List[Dict[str,str]]:
     """
-    Naively truncates the oldest messages from the history to fit within token limits.
+    Keeps the newest messages from the history that fit within max_tokens (real token counts).
     """
-    truncated=[]
+    kept=[]
     token_count=0
     for message in reversed(history):
-        content_length=len(message['content'].split())
-        if token_count+content_length>max_tokens:
+        message_tokens=count_tokens(message['content'])
+        if token_count+message_tokens>max_tokens:
             break
-        truncated.insert(0,message)
-        token_count+=content_length
-    return truncated
+        kept.append(message)
+        token_count+=message_tokens
+    kept.reverse()
+    return kept
 
 def build_prompt(prompt_template:str,user_query:str,history:str,tool_description:str="")->str:
     """
@@ -0,0 +1,177 @@
+"""
+Entity and pronoun resolution for natural-language SQL requests.
+
+Runs on every OpenAITool call before the LLM is asked for SQL:
+
+1. One scan of the instruction finds the entity it mentions. All patterns are
+   alternatives of a single precompiled regex; the first candidate of each
+   kind is kept and the winner is picked by priority: an explicit field
+   ("email: a@b.com", "vendor_name=Acme") > a number of 3+ digits (user_id)
+   > an email address > a name after "for"/"about" (user_name). Fields and
+   keywords must start a word ("before Alice" no longer names Alice).
+2. A newly mentioned entity is saved as the user's last entity. Otherwise the
+   last entity is loaded. Either way this is one Redis round trip: the state
+   is a single hash per user (ENTITY_REDIS_PREFIX + user_id, fields type and
+   value), expiring after ENTITY_TTL_SECONDS (default 7 days).
+3. Pronouns in the instruction are replaced with the entity's value, and
+   " for <value>" is appended when the value is still not mentioned.
+
+If Redis is unavailable the state is kept in-process (per worker) instead,
+for ENTITY_REDIS_RETRY seconds (default 5) before Redis is tried again.
+"""
+
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from cachetools import TTLCache
+
+from services import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = os.getenv("ENTITY_REDIS_PREFIX", os.getenv("REDIS_KEY_PREFIX", "vartopia:") + "entity:")
+TTL_SECONDS = int(os.getenv("ENTITY_TTL_SECONDS", str(7 * 24 * 3600)))
+LOCAL_MAX_KEYS = int(os.getenv("ENTITY_LOCAL_MAX_KEYS", "100000"))
+REDIS_RETRY = float(os.getenv("ENTITY_REDIS_RETRY", "5"))
+
+IGNORED_NAMES = frozenset({"of"})
+
+# One pass finds every kind of candidate. Alternatives are only tried at word
+# starts and are lookaheads, so a candidate of one kind never hides another
+# kind starting inside it (e.g. the user_id in "bob.123@x.com"). Keywords are
+# factored by prefix and are the only case-insensitive parts: sre tries a flat
+# case-insensitive alternation word by word, which costs about twice as much.
+# Fields: user_id, user_name, email, vendor_id, vendor_name, last_updated.
+_SCANNER = re.compile(
+    r"\b(?:(?=(?P<field>(?i:user_(?:id|name)|email|vendor_(?:id|name)|last_updated))"
+    r"\s*[:=]?\s*(?P<field_value>[\w@.\-: ]+)?)"
+    r"|(?=(?P<number>\d{3,}\b))"
+    r"|(?<![\w.-])(?=(?P<email>[\w\.-]+@[\w\.-]+\.\w+))"
+    r"|(?=(?i:for|about)\s+(?P<name>[A-Za-z][A-Za-z0-9_-]*)))"
+)
+# it, its, them, they, their, he, her, his, she
+_PRONOUNS = re.compile(r"(?i)\b(?:th(?:e(?:m|y|ir))|its?|h(?:er?|is)|she)\b")
+
+ENTITY_RESOLUTIONS = metrics.counter(
+    "mcp_entity_resolutions_total",
+    "Entity resolution outcomes by where the entity came from (field, user_id, email, user_name, memory, none).",
+    ["source"],
+)
+ENTITY_BACKEND_ERRORS = metrics.counter(
+    "mcp_entity_backend_errors_total",
+    "Redis errors that made the entity resolver use its in-process store.",
+)
+
+
+@dataclass
+class Resolution:
+    instruction: str
+    entity: Optional[Dict[str, str]]
+    source: str
+
+
+def _scan(text: str) -> Tuple[str, Optional[Dict[str, str]]]:
+    field = number = email = name = None
+    for match in _SCANNER.finditer(text):
+        kind = match.lastgroup
+        if kind == "field_value":
+            kind = "field"
+        if kind == "field":
+            if field is None:
+                field = match
+                if match.group("field_value"):
+                    break  # nothing outranks the first explicit field
+        elif kind == "number":
+            number = number or match.group("number")
+        elif kind == "email":
+            email = email or match.group("email")
+        elif kind == "name" and name is None:
+            name = match.group("name")
+    if field is not None and field.group("field_value"):
+        return "field", {"type": field.group("field").lower(), "value": field.group("field_value").strip()}
+    if number:
+        return "user_id", {"type": "user_id", "value": number}
+    if email:
+        return "email", {"type": "email", "value": email}
+    if name and name.lower() not in IGNORED_NAMES:
+        return "user_name", {"type": "user_name", "value": name}
+    return "none", None
+
+
+def scan(text: str) -> Optional[Dict[str, str]]:
+    """The entity `text` mentions (type and value), or None."""
+    return _scan(text)[1]
+
+
+def rewrite(instruction: str, entity: Optional[Dict[str, str]]) -> str:
+    """Replace pronouns with the entity's value and make sure the value is mentioned."""
+    value = str(entity.get("value") or "") if entity else ""
+    if not value:
+        return instruction
+    instruction = _PRONOUNS.sub(lambda _: value, instruction)
+    if value.lower() not in instruction.lower():
+        instruction += f" for {value}"
+    return instruction
+
+
+class EntityResolver:
+    """Finds the entity a request refers to and remembers it per user."""
+
+    def __init__(self, ttl: int = TTL_SECONDS):
+        self.ttl = ttl
+        self._local: "TTLCache[str, Dict[str, str]]" = TTLCache(maxsize=LOCAL_MAX_KEYS, ttl=ttl)
+        self._redis_down_until = 0.0
+
+    async def _redis(self):
+        if time.monotonic() < self._redis_down_until:
+            return None
+        from services.feedback_memory import init_redis_pool
+        return await init_redis_pool()
+
+    def _failed(self, what: str) -> None:
+        ENTITY_BACKEND_ERRORS.inc()
+        self._redis_down_until = time.monotonic() + REDIS_RETRY
+        logger.warning("Entity resolver Redis %s failed; using in-process state for %.0fs", what, REDIS_RETRY)
+
+    async def load(self, user_id: str) -> Optional[Dict[str, str]]:
+        try:
+            r = await self._redis()
+            if r is None:
+                return self._local.get(user_id)
+            with tracing.span("redis.entity_load", kind="client"):
+                entity = await r.hgetall(REDIS_KEY_PREFIX + user_id)
+        except Exception:
+            self._failed("read")
+            return self._local.get(user_id)
+        return entity if entity.get("value") else None
+
+    async def save(self, user_id: str, entity: Dict[str, str]) -> None:
+        self._local[user_id] = entity
+        try:
+            r = await self._redis()
+            if r is None:
+                return
+            key = REDIS_KEY_PREFIX + user_id
+            with tracing.span("redis.entity_save", kind="client"):
+                await r.pipeline(transaction=False).hset(key, mapping=entity).expire(key, self.ttl).execute()
+        except Exception:
+            self._failed("write")
+
+    async def resolve(self, user_id: str, instruction: str) -> Resolution:
+        """Rewrite `instruction` against the entity it mentions, or the user's last one."""
+        user_id = str(user_id)
+        source, entity = _scan(instruction)
+        if entity is not None:
+            await self.save(user_id, entity)
+        else:
+            entity = await self.load(user_id)
+            source = "memory" if entity else "none"
+        ENTITY_RESOLUTIONS.inc(source=source)
+        return Resolution(rewrite(instruction, entity), entity, source)
+
+
+entity_resolver = EntityResolver()
@@ -7,12 +7,16 @@ import re
 import json
 import time
 import asyncio
-from openai import AsyncOpenAI, OpenAI
 from memory.mcp_memory import MCPMemoryManager
 from fastapi import FastAPI, Request
 from datetime import date, datetime
 from dotenv import load_dotenv 
 from sql_tool.db_setup import get_table_columns
+from sql_tool.entity_resolver import entity_resolver
+from agent.prompt_template import SQL_SYSTEM_PROMPT, assemble_prompt, entity_context
+from services import deadline, metrics, tracing
+from services.llm_gateway import llm
+from services.rate_limiter import rate_limiter
 
 import logging
 logger = logging.getLogger(__name__)
@@ -45,8 +49,10 @@ class SQLTool(BaseTool):
                 return value.isoformat()
             return value
         
+        conn=None
         try:
             conn=connect_postgres()
+            metrics.DB_CONNECTIONS_IN_USE.inc()
             cur=conn.cursor()
             
             logger.info(f"[SQLTool] Executing query: {query}")
@@ -54,7 +60,8 @@ class SQLTool(BaseTool):
             if query.strip().lower().startswith("insert") and "returning" not in query.lower():
                 query = query.rstrip(";") + " RETURNING user_id;"
                 
-            cur.execute(query)
+            with tracing.span("postgres.execute", kind="client", statement=query.split()[0].lower()):
+                cur.execute(query)
             
             if query.strip().lower().startswith("select"):
                 result=cur.fetchall()
@@ -73,7 +80,7 @@ class SQLTool(BaseTool):
                 response = {"result": unique} if unique else {"info": "No data found."}
                 
                 memory=MCPMemoryManager()
-                memory.add_message(user_id, role="assistant",content=json.dumps(response))
+                memory.add_result(user_id, response)
                 if unique and "user_name" in unique[0]:
                     # memory=MCPMemoryManager()
                     last_entity={"type":"user_name","value":unique[0]["user_name"]}
@@ -115,11 +122,15 @@ class SQLTool(BaseTool):
                 MCPMemoryManager().add_message(user_id,role="assistant",content=json.dumps(response))
 
             cur.close()
-            conn.close()
             return response
         
         except Exception as e:
             return {"error":str(e)}
+        
+        finally:
+            if conn:
+                conn.close()
+                metrics.DB_CONNECTIONS_IN_USE.dec()
 
 #table schema information        
 class TableSchemaTool(BaseTool):
@@ -175,75 +186,19 @@ class OpenAITool(BaseTool):
     async def _run(self, input: Dict[str, Any]) -> Any:
         instruction = input.get("instruction")
         user_id=input.get("user_id","default")
+        # MCPAgent sends its packed prompt; the last user message is the instruction
+        history = list(input.get("messages") or [])
+        if not instruction and history and history[-1].get("role") == "user":
+            instruction = history.pop()["content"]
         
         if not instruction:
             return {"error": "No instruction provided."}
         
-        memory=MCPMemoryManager()
-        # last_message_history = memory.get_history(user_id) or []
-        last_entity_history = memory.get_history(f"{user_id}_last_entity") or []
-        
-        last_entity = None
-        if last_entity_history:
-            try:
-                last_entity = json.loads(last_entity_history[-1]["content"])
-            except Exception:
-                last_entity = {"value": last_entity_history[-1]["content"]}
-        
-        user_match = re.search(
-            r"(user_id|user_name|email|vendor_id|vendor_name|last_updated)\s*[:=]?\s*([\w@.\-: ]+)?",
-            instruction,
-            re.IGNORECASE
-        )
-        if user_match and user_match.group(2):
-            last_entity = {"type": user_match.group(1).lower(), "value": user_match.group(2).strip()}
-            memory.add_message(f"{user_id}_last_entity", role="system", content=json.dumps(last_entity))
-            
-        else:
-            match_id = re.search(r"\b\d{3,}\b", instruction) 
-            if match_id:
-                last_entity = {"type": "user_id", "value": match_id.group()}
-                memory.add_message(
-                    f"{user_id}_last_entity",
-                    role="system",
-                    content=json.dumps(last_entity)
-                )
-
-            elif re.search(r"[\w\.-]+@[\w\.-]+\.\w+", instruction): 
-                email_match = re.search(r"[\w\.-]+@[\w\.-]+\.\w+", instruction)
-                if email_match:
-                    last_entity = {"type": "email", "value": email_match.group()}
-                    memory.add_message(
-                        f"{user_id}_last_entity",
-                        role="system",
-                        content=json.dumps(last_entity)
-                    )
+        with metrics.time_stage("entity_resolution"):
+            resolution = await entity_resolver.resolve(user_id, instruction)
+        instruction, last_entity = resolution.instruction, resolution.entity
 
-            else:
-                match_name = re.search(r"(?:for|about)\s+([A-Za-z][A-Za-z0-9_-]*)", instruction, re.IGNORECASE)
-                if match_name:
-                    entity_value = match_name.group(1)
-                    if entity_value.lower() not in ["of"]:
-                        last_entity = {"type": "user_name", "value": entity_value}
-                        memory.add_message(f"{user_id}_last_entity", role="system", content=json.dumps(last_entity))
-                else:
-                    last_entity_history = memory.get_history(f"{user_id}_last_entity") or []
-                    last_entity=None
-                    if last_entity_history:
-                        try:
-                            last_entity = json.loads(last_entity_history[-1]["content"])
-                        except:
-                            last_entity = None
-            
-        if last_entity and last_entity.get("value"):
-            pronouns = ["it", "its", "them", "they", "he", "she", "his", "her", "their"]
-            pattern = r"\b(" + "|".join(pronouns) + r")\b"
-            instruction = re.sub(pattern, str(last_entity["value"]), instruction, flags=re.IGNORECASE)
-        
-        if last_entity and "value" in last_entity and last_entity["value"]:
-            if last_entity["value"].lower() not in instruction.lower():
-                instruction += f" for {last_entity['value']}"
-                
+        memory=MCPMemoryManager()
         memory.add_message(user_id, role="user", content=instruction)
         
 #         last_user = None
@@ -267,52 +222,18 @@ class OpenAITool(BaseTool):
         logger.info(f"[OpenAITool] Final instruction sent to OpenAI: {instruction}")
         logger.info(f"[OpenAITool] last_user: {last_entity}")
         
-        client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
         try:
-            response = await client.chat.completions.create(
+            response = await llm.chat(
+                "sql_generation",
+                hedge=True,
                 model="gpt-3.5-turbo",
-                messages=[
-                    
-                    {
-                        "role": "system",
-                        "content": (
-                            "You are an expert SQL generator for PostgreSQL.\n"
-                            "Use only this table:\n\n"
-                            "Table: user_vendor_info\n"
-                            "Columns:\n"
-                            "- user_id (int)\n"
-                            "- user_name (text)\n"
-                            "- email (text)\n"
-                            "- vendor_id (text)\n"
-                            "- vendor_name (text)\n"
-                            "- vendor_status (text)\n"
-                            "- last_updated (date)\n\n"
-                            "- Important Rules:\n"
-                            "1. Only use the columns explicity mentioned in the user's request.\n"
-                            "2. If a column value is not provided by the user, set it to NULL (or leave unchanged for UPDATE).\n"
-                            "3. Never invent or predict values such as email, vendor_id or user_id.\n"
-                            "4. For INSERT: only include columns the user actually specified.\n"
-                            "5. For UPDATE: only update columns the user explicity mentioned.\n"
-                            "6. If the user refers to pronouns ('it', 'its', 'them', 'they'), assume they mean the last mentioned user: <last_user if exists>.\n"
-                            "Do not ask for more context. Use last user from memory if needed:"
-                            f"{last_entity if last_entity else 'unknown'}.\n"
-                            "7. Always include a WHERE clause when updating/deleting,"
-                            "using ILIKE for case-insensitive matching.\n"
-                            "8. Always generate syntactically correct PostgreSQL.\n"
-                            "Always use case-insensitive matching for text comparisons using ILIKE.\n"
-                            "Generate valid PostgreSQL queries using this schema only.\n"
-                            "9. You can generate SELECT, INSERT, UPDATE, or DELETE statements as needed.\n"
-                            "Do not ask for more context. Use the last user from memory if needed."
-                            "10. When the user uses pronouns like it, his, her, their, its, resolve them using the most recent result from memory (not just the text of the last query). Always prefer specific attributes like email, user_id, or vendor_id for SQL filtering"
-                        ),
-                    },
-                    {"role": "user", "content": instruction},
-                ],
+                messages=assemble_prompt(SQL_SYSTEM_PROMPT, history, entity_context(last_entity), instruction),
             )
             sql_query = response.choices[0].message.content.strip()
             return {"query": sql_query}
         
+        except deadline.DeadlineExceeded:
+            raise
         except Exception as e:
             return {"error": str(e)}
 
@@ -372,7 +293,7 @@ class MemoryQueryTool(BaseTool):
         if not user_id:
             return {"error":"user_id is required"}
         memory=MCPMemoryManager()
-        history=memory.get_history(user_id)
+        history=memory.get_history(user_id, resolve_results=True)
         return history if history else{"info":"No memory found"}        
     
 #table content summary
@@ -410,22 +331,11 @@ class FallbackTool(BaseTool):
 #rate limiter tool
 class RateLimiterTool(BaseTool):
     name="RateLimiterTool"
-    description="Limits number of queries per user per minute."
-    
-    rate_limit=5
-    store={}
+    description="Limits number of queries per user (per-tier token bucket shared across replicas)."
     
     async def run(self,input:Dict[str,Any])->Any:
-        user_id=input.get("user_id")
-        now=time.time()
-        self.store.setdefault(user_id,[]).append(now)
-        
-        recent=[t for t in self.store[user_id]if now - t<60]
-        self.store[user_id]=recent
-        
-        if len(recent)>self.rate_limit:
-            return {"allowed":False,"error":"Rate limit exceeded"}
-        return {"allowed":True}
+        result=await rate_limiter.check(input.get("user_id","default"))
+        return result.to_dict()
     
 #explain SQL query in natural language
 class ExplainSQLTool(BaseTool):
@@ -436,9 +346,9 @@ class ExplainSQLTool(BaseTool):
         query=input.get("query")
         if not query:
             return {"error":"Query missing"}
-        client=AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         try:
-            response=await client.chat.completions.create(
+            response=await llm.chat(
+                "explain_sql",
                 model="gpt-3.5-turbo",
                 messages=[
                     {"role":"system","content":"Explain what this SQL query does in simple English."},
@@ -471,15 +381,19 @@ class QueryCacheTool(BaseTool):
     async def run(self,input:Dict[str,Any])->Any:
         query=input.get("query")
         if query in self.cache:
+            metrics.record_cache("query_cache", hit=True)
             return {"cached":True, "result":self.cache[query]}
+        metrics.record_cache("query_cache", hit=False)
         return {"cached":False}
  
  
    
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 import uvicorn
 
 app = FastAPI(title="SQL Tool Microservice")
+app.add_middleware(tracing.TracingMiddleware, service_name="sql_tool")
 
 tools = {
     "sql_tool": SQLTool(),
@@ -502,15 +416,20 @@ async def run_tool(tool_name: str, request: Request):
         return {"error": "Tool not found"}
     data = await request.json()
     tool = tools[tool_name]
-    if asyncio.iscoroutinefunction(tool.run):
-        return await tool.run(data)
-    else:
-        return tool.run(data)
+    with metrics.observe_tool(tool.name):
+        if asyncio.iscoroutinefunction(tool.run):
+            return await tool.run(data)
+        else:
+            return tool.run(data)
 
 @app.get("/health")
 def health():
     return {"status": "running"}
 
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render_latest(), media_type=metrics.CONTENT_TYPE_LATEST)
+
 @app.get("/")
 def root():
     return {"message": "Server is up"}
@@ -0,0 +1,12 @@
+import pytest
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    """In-memory Redis (fakeredis, Lua via lupa) installed as the feedback store's client."""
+    fakeredis = pytest.importorskip("fakeredis")
+    from services import feedback_memory
+
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(feedback_memory, "_redis_client", client)
+    return client
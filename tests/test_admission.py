@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+
+from services.admission import AdmissionController, AdmissionRejected
+
+
+async def _hold(controller, user_id, release, started=None):
+    async with controller.admit(user_id):
+        if started is not None:
+            started.set()
+        await release.wait()
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_free_slots_go_to_users_in_fair_order():
+    async def main():
+        controller = AdmissionController(max_concurrent=1, per_user_inflight=1, per_user_queue=8, weights={})
+        order = []
+
+        async def turn(user_id):
+            async with controller.admit(user_id):
+                order.append(user_id)
+                await asyncio.sleep(0)
+
+        release = asyncio.Event()
+        blocker = asyncio.create_task(_hold(controller, "x", release))
+        await _settle()
+        turns = [asyncio.create_task(turn(u)) for u in ("a", "a", "a", "b")]
+        await _settle()
+        assert controller.queued == 4
+        release.set()
+        await asyncio.gather(blocker, *turns)
+        return order, controller
+
+    order, controller = asyncio.run(main())
+    # b queued after all of a's turns but only waits behind one of them
+    assert order == ["a", "b", "a", "a"]
+    assert controller.in_flight == controller.queued == 0 and not controller._users
+
+
+def test_weights_give_proportional_share():
+    async def main():
+        controller = AdmissionController(max_concurrent=1, per_user_inflight=1, weights={"heavy": 2})
+        order = []
+
+        async def turn(user_id):
+            async with controller.admit(user_id):
+                order.append(user_id)
+                await asyncio.sleep(0)
+
+        release = asyncio.Event()
+        blocker = asyncio.create_task(_hold(controller, "x", release))
+        await _settle()
+        turns = [asyncio.create_task(turn(u)) for u in ["heavy"] * 4 + ["light"] * 2]
+        await _settle()
+        release.set()
+        await asyncio.gather(blocker, *turns)
+        return order
+
+    assert asyncio.run(main())[:3].count("heavy") == 2
+
+
+def test_shedding_by_user_queue_global_queue_and_timeout():
+    async def main():
+        controller = AdmissionController(max_concurrent=1, per_user_inflight=1, per_user_queue=1,
+                                         max_queue=2, queue_timeout=0.05)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(_hold(controller, "a", release))
+        await _settle()
+        queued = [asyncio.create_task(_hold(controller, u, release)) for u in ("a", "b")]
+        await _settle()
+
+        with pytest.raises(AdmissionRejected) as user_full:
+            await _hold(controller, "a", release)
+        with pytest.raises(AdmissionRejected) as queue_full:
+            await _hold(controller, "c", release)
+        results = await asyncio.gather(*queued, return_exceptions=True)
+        release.set()
+        await blocker
+        return controller, user_full.value, queue_full.value, results
+
+    controller, user_full, queue_full, results = asyncio.run(main())
+    assert (user_full.status, user_full.reason) == (429, "user_queue_full")
+    assert (queue_full.status, queue_full.reason) == (503, "queue_full")
+    assert [(e.status, e.reason) for e in results] == [(503, "queue_timeout")] * 2
+    assert int(user_full.retry_after_header()) >= 1
+    assert controller.in_flight == controller.queued == 0 and not controller._users
+
+
+def test_past_deadline_is_shed_without_queueing():
+    async def main():
+        controller = AdmissionController(max_concurrent=1)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(_hold(controller, "a", release))
+        await _settle()
+        with pytest.raises(AdmissionRejected) as e:
+            async with controller.admit("b", deadline=0.0):
+                pass
+        release.set()
+        await blocker
+        return e.value
+
+    assert asyncio.run(main()).reason == "deadline"
+
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    async def main():
+        controller = AdmissionController(max_concurrent=1, per_user_inflight=1)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(_hold(controller, "a", release))
+        await _settle()
+        waiter = asyncio.create_task(_hold(controller, "b", release))
+        await _settle()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        release.set()
+        await blocker
+
+        started = asyncio.Event()
+        again = asyncio.create_task(_hold(controller, "b", asyncio.Event(), started))
+        await asyncio.wait_for(started.wait(), 1)
+        again.cancel()
+        await asyncio.gather(again, return_exceptions=True)
+        return controller
+
+    controller = asyncio.run(main())
+    assert controller.in_flight == controller.queued == 0 and not controller._users
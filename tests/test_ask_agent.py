@@ -0,0 +1,25 @@
+import asyncio
+
+import main
+from services import deadline
+from sdk.stdio_transport import DEADLINE_EXCEEDED, SERVER_ERROR
+
+
+def _rpc(monkeypatch, error):
+    async def run_agent(*args, **kwargs):
+        raise error
+
+    monkeypatch.setattr(main, "_run_agent", run_agent)
+    item = {"jsonrpc": "2.0", "id": 3, "params": {"user_id": "u", "messages": []}}
+    return asyncio.run(main._ask_agent_rpc(item, 1.0))
+
+
+def test_deadline_gets_its_own_error_code(monkeypatch):
+    response = _rpc(monkeypatch, deadline.DeadlineExceeded("Deadline exceeded before llm call"))
+    assert response["id"] == 3
+    assert response["error"]["code"] == DEADLINE_EXCEEDED
+    assert response["error"]["message"] == "Deadline exceeded"
+
+
+def test_other_errors_stay_server_errors(monkeypatch):
+    assert _rpc(monkeypatch, RuntimeError("boom"))["error"]["code"] == SERVER_ERROR
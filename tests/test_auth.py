@@ -0,0 +1,86 @@
+import asyncio
+import itertools
+
+import pytest
+from fastapi import HTTPException
+
+from api_client import auth
+
+
+def test_401_logs_in_again_and_retries_once(monkeypatch):
+    counter = itertools.count(1)
+
+    async def login(username, password):
+        return {"Tokens": {"AccessToken": f"token-{next(counter)}"}}
+
+    monkeypatch.setattr(auth.client, "login", login)
+    manager = auth.TokenManager(use_redis=False)
+    seen = []
+
+    async def call(token):
+        seen.append(token)
+        if token == "token-1":
+            raise HTTPException(status_code=401, detail="revoked")
+        return token
+
+    assert asyncio.run(manager.call_with_token("u", "p", call)) == "token-2"
+    assert seen == ["token-1", "token-2"]
+
+
+def test_second_401_is_raised(monkeypatch):
+    async def login(username, password):
+        return {"Tokens": {"AccessToken": "token"}}
+
+    monkeypatch.setattr(auth.client, "login", login)
+    manager = auth.TokenManager(use_redis=False)
+    calls = []
+
+    async def call(token):
+        calls.append(token)
+        raise HTTPException(status_code=401, detail="revoked")
+
+    with pytest.raises(HTTPException):
+        asyncio.run(manager.call_with_token("u", "p", call))
+    assert len(calls) == 2
+
+
+def _shared_manager(r, **kwargs):
+    manager = auth.TokenManager(secret="s3cret", **kwargs)
+
+    async def redis():
+        return r
+
+    manager._redis = redis
+    return manager
+
+
+def test_redis_cache_is_keyed_by_hmac_and_checks_the_password(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    logins = []
+
+    async def login(username, password):
+        logins.append(password)
+        return {"Tokens": {"AccessToken": f"token-{len(logins)}"}}
+
+    monkeypatch.setattr(auth.client, "login", login)
+
+    async def main():
+        r = fakeredis.FakeAsyncRedis(decode_responses=True)
+        first = _shared_manager(r, redis_ttl=60)
+        assert await first.get_token("u", "p") == "token-1"
+        (key,) = await r.keys("*")
+        assert key == auth.TOKEN_REDIS_PREFIX + first._key("u")
+        assert "p" not in (await r.hgetall(key)).values()
+        assert 0 < await r.ttl(key) <= 60
+
+        # another backend reuses the login; a wrong password does not
+        second = _shared_manager(r)
+        assert await second.get_token("u", "p") == "token-1"
+        assert await _shared_manager(r).get_token("u", "wrong") == "token-2"
+        assert logins == ["p", "wrong"]
+
+    asyncio.run(main())
+
+
+def test_redis_cache_needs_a_secret():
+    assert not auth.TokenManager(use_redis=True, secret="").use_redis
@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+from api_client import bulk
+
+
+def _with_token(call):
+    return call("token")
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    calls = []
+
+    async def submit_deal(access_token, user_email, deal_data):
+        calls.append(deal_data)
+        return {"success": True}
+
+    monkeypatch.setattr(bulk.client, "submit_deal", submit_deal)
+    return calls
+
+
+def test_duplicate_unique_ids_still_add_up(submitted):
+    deals = [{"uniqueID": "A"}, {"uniqueID": "A"}, {"uniqueID": "B"}]
+    report = asyncio.run(bulk.bulk_upsert(_with_token, "u@example.com", deals, batch_size=2))
+    assert report["total"] == 3
+    assert report["succeeded"] + report["failed"] == report["total"]
+    assert report["duplicates"] == 1
+    assert set(report["results"]) == {"A", "B"}
+
+
+def test_non_object_line_is_a_400(tmp_path, submitted):
+    path = tmp_path / "deals.jsonl"
+    path.write_text(json.dumps({"uniqueID": "A"}) + "\n[1, 2]\n")
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(bulk.bulk_upsert(_with_token, "u@example.com", bulk.iter_jsonl(str(path)), batch_size=5))
+    assert e.value.status_code == 400 and "Line 2" in e.value.detail
+
+
+def test_input_error_after_submitted_chunks_returns_partial_report(tmp_path, submitted):
+    path = tmp_path / "deals.jsonl"
+    path.write_text("".join(json.dumps({"uniqueID": f"D{i}"}) + "\n" for i in range(4)) + "not json\n")
+    report = asyncio.run(bulk.bulk_upsert(_with_token, "u@example.com", bulk.iter_jsonl(str(path)), batch_size=2))
+    assert report["total"] == 4 and report["succeeded"] == 4
+    assert report["input_error"]["status"] == 400
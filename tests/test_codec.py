@@ -0,0 +1,63 @@
+import json
+import zlib
+from decimal import Decimal
+
+import pytest
+
+from memory import codec
+
+VALUE = {"role": "assistant", "content": "héllo", "rows": [{"id": 1, "amount": 2.5}], "none": None}
+
+
+@pytest.fixture(params=["json", "msgpack"])
+def backend(request, monkeypatch):
+    if request.param == "msgpack":
+        pytest.importorskip("msgpack")
+    name, (tag, dumps, loads) = codec._select(request.param)
+    monkeypatch.setattr(codec, "_TAG", tag)
+    monkeypatch.setattr(codec, "_dumps", dumps)
+    return name
+
+
+def test_round_trip_with_format_tag(backend):
+    data = codec.encode(VALUE)
+    assert data[0] == (codec.TAG_JSON if backend == "json" else codec.TAG_MSGPACK)
+    assert codec.decode(data) == VALUE
+
+
+def test_large_values_are_compressed(backend, monkeypatch):
+    monkeypatch.setattr(codec, "COMPRESS_MIN", 64)
+    value = {"content": "repeat " * 100}
+    data = codec.encode(value)
+    assert data[0] & codec.TAG_ZLIB and len(data) < len(json.dumps(value))
+    assert codec.decode(data) == value
+
+
+def test_incompressible_values_are_stored_plain(monkeypatch):
+    monkeypatch.setattr(codec, "COMPRESS_MIN", 1)
+    assert not codec.encode("x")[0] & codec.TAG_ZLIB
+
+
+def test_values_without_a_native_encoding_fall_back_to_str(backend):
+    assert codec.decode(codec.encode({"amount": Decimal("1.50")})) == {"amount": "1.50"}
+
+
+def test_legacy_untagged_json_still_decodes():
+    legacy = json.dumps(VALUE)
+    assert codec.decode(legacy) == VALUE
+    assert codec.decode(legacy.encode()) == VALUE
+    assert codec.decode(b"\n  " + legacy.encode()) == VALUE
+    assert codec.decode(None) is None
+
+
+def test_each_format_decodes_whatever_is_configured(backend):
+    json_value = bytes((codec.TAG_JSON,)) + json.dumps(VALUE).encode()
+    packed = bytes((codec.TAG_JSON | codec.TAG_ZLIB,)) + zlib.compress(json.dumps(VALUE).encode())
+    assert codec.decode(json_value) == VALUE
+    assert codec.decode(packed) == VALUE
+
+
+def test_corrupt_values_raise_decode_error():
+    for data in (b"", b"\x07abc", bytes((codec.TAG_JSON | codec.TAG_ZLIB,)) + b"not zlib"):
+        with pytest.raises(codec.DecodeError):
+            codec.decode(data)
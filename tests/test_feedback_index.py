@@ -0,0 +1,80 @@
+import asyncio
+
+from services import feedback_index, feedback_memory
+from services.feedback_index import add_document, rebuild, remove_documents, search, tokenize
+
+
+async def _index(r, user_id, documents):
+    pipe = r.pipeline(transaction=False)
+    for message_id, text in documents:
+        add_document(pipe, user_id, message_id, text, ttl=60)
+    await pipe.execute()
+
+
+def test_tokenize_keeps_ids_and_emails_and_drops_stop_words():
+    assert tokenize("Show the deals for VN-4821, please; mail a@b.com.") == ["deals", "vn-4821", "mail", "a@b.com"]
+
+
+def test_search_ranks_by_bm25(redis):
+    async def main():
+        await _index(redis, "u", [
+            ("both", "vendor acme renewal"),
+            ("rare", "acme"),
+            ("common", "vendor vendor"),
+            ("other", "totally unrelated text"),
+        ])
+        return await search(redis, "u", "acme vendor"), await search(redis, "u", "the of")
+
+    hits, stop_words_only = asyncio.run(main())
+    assert [mid for mid, _ in hits][0] == "both"
+    assert {mid for mid, _ in hits} == {"both", "rare", "common"}
+    assert stop_words_only == []
+
+
+def test_remove_and_reindex_keep_stats_consistent(redis):
+    async def main():
+        await _index(redis, "u", [("m1", "acme deal"), ("m2", "globex deal")])
+        await remove_documents(redis, "u", ["m1", "missing"])
+        await feedback_index.reindex_document(redis, "u", "m2", "globex deal\nwrong vendor", ttl=60)
+        stats = await redis.hgetall(feedback_index._key("u", "stats"))
+        return stats, await search(redis, "u", "acme"), await search(redis, "u", "wrong")
+
+    stats, acme, wrong = asyncio.run(main())
+    assert stats == {"docs": "1", "total_len": "4"}
+    assert acme == [] and [mid for mid, _ in wrong] == ["m2"]
+
+
+def test_rebuild_is_aborted_by_a_concurrent_write(redis):
+    async def main():
+        await _index(redis, "u", [("stale", "old text")])
+
+        async def load_clean():
+            return [("m1", "acme deal")]
+
+        async def load_racy():
+            await _index(redis, "u", [("m2", "globex deal")])  # written after the messages were read
+            return [("m1", "acme deal")]
+
+        racy = await rebuild(redis, "u", load_racy, ttl=60)
+        after_race = (await feedback_index.is_built(redis, "u"), await search(redis, "u", "globex"))
+        clean = await rebuild(redis, "u", load_clean, ttl=60)
+        return racy, after_race, clean, await search(redis, "u", "old"), await feedback_index.is_built(redis, "u")
+
+    racy, (built, globex), clean, old, built_after = asyncio.run(main())
+    assert racy is None and not built and [mid for mid, _ in globex] == ["m2"]
+    assert clean == 1 and old == [] and built_after
+
+
+def test_search_feedback_builds_the_index_lazily_and_boosts_feedback(redis):
+    async def main():
+        plain = await feedback_memory.store_message("u", "assistant", "acme vendor report")
+        corrected = await feedback_memory.store_message("u", "assistant", "acme vendor report")
+        await feedback_memory.store_message("u", "user", "acme vendor report")
+        await feedback_memory.add_feedback(corrected, "use the acme vendor id", score=2)
+        await feedback_index.drop(redis, "u")  # as for messages stored before the index existed
+        hits = await feedback_memory.search_feedback("u", "acme vendor")
+        return plain, corrected, hits, await feedback_index.is_built(redis, "u")
+
+    plain, corrected, hits, built = asyncio.run(main())
+    assert built
+    assert [m["message_id"] for m in hits] == [corrected, plain]
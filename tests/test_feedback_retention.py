@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+from services import feedback_index, feedback_memory
+from services.feedback_memory import _message_hash_key, _user_messages_zkey
+from services.feedback_retention import FeedbackRetention, _day, aggregate_key, get_daily_aggregates
+
+DAY = 86400
+
+
+async def _store(user_id, role, content, metadata=None):
+    return await feedback_memory.store_message(user_id, role, content, metadata)
+
+
+def test_old_messages_are_compacted_and_scored_ones_preserved(redis):
+    async def main():
+        plain = await _store("u", "assistant", "acme report", {"type": "sql"})
+        question = await _store("u", "user", "acme?")
+        scored = await _store("u", "assistant", "globex report")
+        await feedback_memory.add_feedback(scored, "wrong vendor", score=1)
+        retention = FeedbackRetention(max_messages=100, compact_after_days=30, max_age_days=90)
+
+        now = time.time() + 40 * DAY
+        counts = await retention.sweep_user(redis, "u", now)
+        left = await redis.zrange(_user_messages_zkey("u"), 0, -1)
+        day = _day(await redis.hget(_message_hash_key(scored), "timestamp"))
+        aggregates = await get_daily_aggregates("u", [day, "1999-01-01"])
+        last_sql = await feedback_memory.get_last_message_id("u", "assistant", "sql")
+        acme = await feedback_index.search(redis, "u", "acme")
+
+        later = await retention.sweep_user(redis, "u", time.time() + 100 * DAY)
+        return (plain, question, scored, counts, left, day, aggregates, last_sql, acme, later,
+                await redis.hgetall(aggregate_key("u", day)), await redis.exists(_user_messages_zkey("u")),
+                await feedback_index.search(redis, "u", "globex"))
+
+    (plain, question, scored, counts, left, day, aggregates, last_sql, acme, later,
+     final_aggregate, zset_left, globex) = asyncio.run(main())
+    assert counts == {"compacted": 2, "expired": 0, "missing": 0, "preserved": 1}
+    assert left == [scored]
+    assert aggregates == {day: {"messages": 2, "role:assistant": 1, "role:user": 1}}
+    assert last_sql is None and acme == []
+
+    # past FEEDBACK_MAX_AGE_DAYS the scored message is aggregated too, and the emptied index dropped
+    assert later == {"compacted": 0, "expired": 1, "missing": 0, "preserved": 0}
+    assert final_aggregate == {"messages": "3", "role:assistant": "2", "role:user": "1", "with_feedback": "1",
+                               "scored": "1", "score_sum": "1", "negative": "1"}
+    assert not zset_left and globex == []
+
+
+def test_overflow_beyond_max_messages_is_compacted_oldest_first(redis):
+    async def main():
+        ids = [await _store("u", "assistant", f"message {i}") for i in range(5)]
+        retention = FeedbackRetention(max_messages=3, compact_after_days=30, batch=1)
+        counts = await retention.sweep_user(redis, "u", time.time())
+        return ids, counts, await redis.zrange(_user_messages_zkey("u"), 0, -1)
+
+    ids, counts, left = asyncio.run(main())
+    assert counts == {"compacted": 2, "expired": 0, "missing": 0, "preserved": 0}
+    assert left == ids[2:]
+
+
+def test_entries_whose_hash_expired_are_pruned(redis):
+    async def main():
+        gone = await _store("u", "assistant", "expired")
+        kept = await _store("u", "assistant", "kept")
+        await feedback_memory.add_feedback(kept, "fine", score=5)
+        await redis.delete(_message_hash_key(gone))
+        counts = await FeedbackRetention().sweep_user(redis, "u", time.time() + 31 * DAY)
+        return kept, counts, await redis.zrange(_user_messages_zkey("u"), 0, -1)
+
+    kept, counts, left = asyncio.run(main())
+    assert counts == {"compacted": 0, "expired": 0, "missing": 1, "preserved": 1}
+    assert left == [kept]
+
+
+def test_sweep_covers_every_user_once_per_lock(redis):
+    async def main():
+        for user_id in ("a", "b"):
+            await _store(user_id, "assistant", "hello")
+        retention = FeedbackRetention(max_messages=0, interval=60)
+        first = await retention.sweep()
+        second = await retention.sweep()  # another replica holds the lock
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first["compacted"] == 2
+    assert second == {}
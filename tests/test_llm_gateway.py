@@ -0,0 +1,182 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import RateLimitError
+
+from services import llm_gateway
+from services.llm_gateway import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, LLMGateway, _Budget, _Lane
+
+
+class FakeCompletions:
+    """Stands in for client.chat.completions; each call awaits the next scripted delay."""
+
+    def __init__(self, delays=(), total_tokens=None):
+        self.delays = list(delays)
+        self.total_tokens = total_tokens
+        self.calls = 0
+        self.cancelled = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        call = self.calls
+        try:
+            await asyncio.sleep(self.delays.pop(0) if self.delays else 0)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        usage = SimpleNamespace(total_tokens=self.total_tokens) if self.total_tokens else None
+        return SimpleNamespace(call=call, usage=usage)
+
+
+def _gateway(completions, concurrency=4, rpm=0, tpm=0):
+    gateway = LLMGateway()
+    gateway._client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    gateway.chat_lane = _Lane("chat", concurrency, rpm, tpm)
+    return gateway
+
+
+def test_budget_waits_for_refill_and_caps_oversize_requests():
+    budget = _Budget(60)  # one unit per second
+    budget.take(60)
+    assert budget.wait_for(2, budget.updated) == pytest.approx(2)
+    assert budget.wait_for(600, budget.updated) == pytest.approx(60)
+    assert _Budget(0).wait_for(10 ** 9, 0) == 0
+
+
+def test_waiters_are_served_by_priority_then_fifo():
+    async def main():
+        lane = _Lane("chat", 1, 0, 0)
+        await lane.acquire(PRIORITY_INTERACTIVE, 1)
+        order = []
+
+        async def wait(name, priority):
+            await lane.acquire(priority, 1)
+            order.append(name)
+            lane.release()
+
+        tasks = [asyncio.create_task(wait(name, p)) for name, p in
+                 [("bg", PRIORITY_BACKGROUND), ("turn1", PRIORITY_INTERACTIVE), ("turn2", PRIORITY_INTERACTIVE)]]
+        await asyncio.sleep(0)
+        lane.release()
+        await asyncio.gather(*tasks)
+        return order, lane.active
+
+    assert asyncio.run(main()) == (["turn1", "turn2", "bg"], 0)
+
+
+def test_cancelled_waiter_does_not_hold_a_slot():
+    async def main():
+        lane = _Lane("chat", 1, 0, 0)
+        await lane.acquire(PRIORITY_INTERACTIVE, 1)
+        waiter = asyncio.create_task(lane.acquire(PRIORITY_INTERACTIVE, 1))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        lane.release()
+        await asyncio.wait_for(lane.acquire(PRIORITY_INTERACTIVE, 1), 1)
+        return lane.active
+
+    assert asyncio.run(main()) == 1
+
+
+def test_usage_corrects_the_token_estimate():
+    async def main():
+        gateway = _gateway(FakeCompletions(total_tokens=500), tpm=60000)
+        await gateway.chat("test", messages=[{"role": "user", "content": "x" * 40}], max_tokens=10)
+        return gateway.chat_lane.tokens
+
+    tokens = asyncio.run(main())
+    assert tokens.capacity - tokens.level == pytest.approx(500, abs=5)
+
+
+def test_provider_429_pauses_the_lane():
+    response = httpx.Response(429, headers={"retry-after": "7"}, request=httpx.Request("POST", "http://llm"))
+
+    class Throttled:
+        async def create(self, **kwargs):
+            raise RateLimitError("slow down", response=response, body=None)
+
+    async def main():
+        gateway = _gateway(Throttled())
+        with pytest.raises(RateLimitError):
+            await gateway.chat("test", messages=[])
+        return gateway.chat_lane
+
+    lane = asyncio.run(main())
+    assert lane.active == 0
+    assert lane.paused_until - llm_gateway.time.monotonic() == pytest.approx(7, abs=1)
+
+
+@pytest.fixture
+def fast_hedges(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(llm_gateway, "HEDGE_DEFAULT_DELAY", 0.02)
+
+
+def test_slow_primary_is_hedged_and_the_loser_cancelled(fast_hedges):
+    async def main():
+        completions = FakeCompletions(delays=[1.0, 0.0])
+        gateway = _gateway(completions)
+        response = await gateway.chat("sql", hedge=True, messages=[])
+        await asyncio.sleep(0)
+        return response, completions, gateway
+
+    response, completions, gateway = asyncio.run(main())
+    assert response.call == 2
+    assert (completions.calls, completions.cancelled) == (2, 1)
+    assert gateway.chat_lane.active == 0
+
+
+def test_fast_primary_is_not_hedged(fast_hedges):
+    completions = FakeCompletions(delays=[0.0])
+    assert asyncio.run(_gateway(completions).chat("sql", hedge=True, messages=[])).call == 1
+    assert completions.calls == 1
+
+
+def test_hedges_are_capped(fast_hedges, monkeypatch):
+    monkeypatch.setattr(llm_gateway, "HEDGE_MAX_RATIO", 0.0)
+
+    async def main():
+        completions = FakeCompletions(delays=[0.2, 0.0, 0.1])
+        gateway = _gateway(completions)
+        first = await gateway.chat("sql", hedge=True, messages=[])
+        second = await gateway.chat("sql", hedge=True, messages=[])
+        return first, second, gateway
+
+    first, second, gateway = asyncio.run(main())
+    # the cap allows one hedge plus HEDGE_MAX_RATIO of eligible calls
+    assert (first.call, second.call) == (2, 3)
+    assert (gateway._hedge_eligible, gateway._hedges_sent) == (2, 1)
+
+
+def test_hedge_delay_waits_for_a_slot(fast_hedges):
+    async def main():
+        gateway = _gateway(FakeCompletions(delays=[0.0]), concurrency=1)
+        await gateway.chat_lane.acquire(PRIORITY_INTERACTIVE, 1)
+        call = asyncio.create_task(gateway.chat("sql", hedge=True, messages=[]))
+        await asyncio.sleep(0.1)  # queued in the gateway for longer than the hedge delay
+        gateway.chat_lane.release()
+        return await call, gateway
+
+    response, gateway = asyncio.run(main())
+    assert response.call == 1
+    assert gateway._hedges_sent == 0
+
+
+def test_deadline_cancels_both_attempts(fast_hedges):
+    from services import deadline
+
+    async def main():
+        completions = FakeCompletions(delays=[1.0, 1.0])
+        gateway = _gateway(completions)
+        with deadline.budget(0.1):
+            with pytest.raises(deadline.DeadlineExceeded):
+                await gateway.chat("sql", hedge=True, messages=[])
+        await asyncio.sleep(0)
+        return completions, gateway
+
+    completions, gateway = asyncio.run(main())
+    assert (completions.calls, completions.cancelled) == (2, 2)
+    assert gateway.chat_lane.active == 0
@@ -0,0 +1,55 @@
+import asyncio
+
+import httpx
+import pytest
+
+from api_client import resilience
+from api_client.resilience import HALF_OPEN, OPEN, CircuitOpenError, breaker_for, send
+
+
+def _open_breaker(endpoint: str):
+    breaker = breaker_for(endpoint)
+    breaker.state, breaker.opened_at = OPEN, 0.0  # reset timeout long elapsed
+    return breaker
+
+
+def test_cancelled_probe_lets_next_call_probe(monkeypatch):
+    monkeypatch.setattr(resilience, "_semaphore", None)
+    breaker = _open_breaker("/cancelled-probe")
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.sleep(3600)
+
+        probe = asyncio.create_task(send("GET", "/cancelled-probe", hang))
+        await started.wait()
+        assert breaker.state == HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            await send("GET", "/cancelled-probe", hang)  # probe still in flight
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        async def ok():
+            return httpx.Response(200)
+
+        return await send("GET", "/cancelled-probe", ok)
+
+    assert asyncio.run(scenario()).status_code == 200
+    assert breaker.state == resilience.CLOSED
+
+
+def test_unexpected_error_in_probe_releases_it(monkeypatch):
+    monkeypatch.setattr(resilience, "_semaphore", None)
+    breaker = _open_breaker("/broken-probe")
+
+    async def boom():
+        raise RuntimeError("bug in the caller")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(send("GET", "/broken-probe", boom))
+    assert breaker.state == HALF_OPEN
+    breaker.before_call()  # a new probe is allowed
@@ -0,0 +1,89 @@
+import asyncio
+
+from sdk import json_codec
+from sdk.stdio_transport import INVALID_REQUEST, PARSE_ERROR, REQUEST_CANCELLED, JSONRPCDispatcher
+
+
+class ListWriter:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(json_codec.loads(line))
+
+    async def flush(self):
+        pass
+
+
+async def _run(lines, handler, max_in_flight=16, between=None):
+    writer = ListWriter()
+    dispatcher = JSONRPCDispatcher(handler, writer, max_in_flight)
+    for line in lines:
+        await dispatcher.dispatch(line)
+        if between is not None:
+            await between()
+    await dispatcher.drain()
+    return writer.lines
+
+
+async def _echo_after(request):
+    await asyncio.sleep(request["params"]["delay"])
+    return request["params"]["delay"]
+
+
+def _request(req_id, delay=0.0, method="work"):
+    message = {"jsonrpc": "2.0", "method": method, "params": {"delay": delay}}
+    if req_id is not None:
+        message["id"] = req_id
+    return json_codec.dumps(message)
+
+
+def test_requests_run_concurrently_and_answer_as_they_finish():
+    lines = asyncio.run(_run([_request(1, 0.05), _request(2, 0.0), _request(None, 0.0)], _echo_after))
+    assert [line["id"] for line in lines] == [2, 1]
+
+
+def test_handlers_are_limited_to_max_in_flight():
+    running = peak = 0
+
+    async def handler(request):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return "ok"
+
+    lines = asyncio.run(_run([_request(i) for i in range(10)], handler, max_in_flight=3))
+    assert len(lines) == 10 and peak == 3
+
+
+def test_malformed_messages_get_errors():
+    lines = asyncio.run(_run([b"{nope", b"42", b"\xef\xbb\xbf" + _request(5), b"   "], _echo_after))
+    assert [(line["id"], line.get("error", {}).get("code")) for line in lines] == [
+        (None, PARSE_ERROR), (None, INVALID_REQUEST), (5, None)]
+
+
+def test_cancel_request_answers_the_cancelled_id():
+    cancel = json_codec.dumps({"jsonrpc": "2.0", "method": "$/cancelRequest", "params": {"id": 1}})
+    mcp_cancel = json_codec.dumps({"jsonrpc": "2.0", "method": "notifications/cancelled",
+                                   "params": {"requestId": 2}})
+
+    async def settle():
+        await asyncio.sleep(0)
+
+    lines = asyncio.run(_run([_request(1, 10), _request(2, 10), cancel, mcp_cancel], _echo_after, between=settle))
+    assert lines == [{"jsonrpc": "2.0", "id": 1, "error": {"code": REQUEST_CANCELLED, "message": "Request cancelled"}}]
+
+
+def test_batch_is_answered_with_one_array():
+    batch = b"[" + b",".join([_request(1, 0.02), _request(None), b"7", _request(2)]) + b"]"
+    (response,) = asyncio.run(_run([batch], _echo_after))
+    assert isinstance(response, list)
+    assert sorted((r["id"] is None, r.get("result", r.get("error", {}).get("code"))) for r in response) == [
+        (False, 0.0), (False, 0.02), (True, INVALID_REQUEST)]
+
+
+def test_empty_and_notification_only_batches():
+    lines = asyncio.run(_run([b"[]", b"[" + _request(None) + b"]"], _echo_after))
+    assert [line["error"]["code"] for line in lines] == [INVALID_REQUEST]
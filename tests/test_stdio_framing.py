@@ -0,0 +1,79 @@
+import asyncio
+
+from sdk import json_codec, stdio_transport
+from sdk.stdio_transport import INVALID_REQUEST, JSONRPCDispatcher, leading_id, read_lines
+
+
+class ListWriter:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(json_codec.loads(line))
+
+    async def flush(self):
+        pass
+
+
+async def _read(data, limit=16, on_oversized=None):
+    reader = asyncio.StreamReader(limit=limit)
+    reader.feed_data(data)
+    reader.feed_eof()
+    return [line async for line in read_lines(reader, on_oversized)]
+
+
+def test_long_lines_are_reassembled_and_last_line_needs_no_newline():
+    long = b'{"id": 1, "method": "' + b"x" * 100 + b'"}'
+    assert asyncio.run(_read(long + b"\n" + b'{"id": 2}')) == [long + b"\n", b'{"id": 2}']
+
+
+def test_oversized_message_is_reported_and_reading_continues(monkeypatch):
+    monkeypatch.setattr(stdio_transport, "MAX_MESSAGE_BYTES", 64)
+    seen = []
+    big = b'{"jsonrpc": "2.0", "id": 7, "params": "' + b"x" * 200 + b'"}\n'
+    lines = asyncio.run(_read(big + b'{"id": 8}\n' + big.rstrip(), on_oversized=lambda h, n: seen.append((h, n))))
+    assert lines == [b'{"id": 8}\n']
+    assert [n for _, n in seen] == [len(big), len(big) - 1]
+    assert leading_id(seen[0][0]) == 7
+
+
+def test_leading_id_only_trusts_an_id_up_front():
+    assert leading_id(b'{"id": "a\\"b", "method": "x", "params": "') == 'a"b'
+    assert leading_id(b'{"jsonrpc":"2.0","id":-3,') == -3
+    assert leading_id(b'{"method": "x", "params": {"id": 5') is None
+    assert leading_id(b'garbage') is None
+
+
+def test_dispatcher_answers_oversized_messages():
+    async def main():
+        writer = ListWriter()
+
+        async def handler(request):
+            return "ok"
+
+        dispatcher = JSONRPCDispatcher(handler, writer)
+        dispatcher.reject_oversized(b'{"id": 4, "params": "', 10 ** 9)
+        dispatcher.reject_oversized(b'{"params": {"id": 4', 10 ** 9)
+        await dispatcher.drain()
+        return writer.lines
+
+    first, second = asyncio.run(main())
+    assert first["id"] == 4 and first["error"]["code"] == INVALID_REQUEST
+    assert first["error"]["message"] == "Message too large"
+    assert second["id"] is None
+
+
+def test_dispatcher_reports_timeouts_apart_from_errors():
+    async def main():
+        writer = ListWriter()
+
+        async def handler(request):
+            raise (TimeoutError if request["method"] == "slow" else RuntimeError)("x")
+
+        dispatcher = JSONRPCDispatcher(handler, writer)
+        await dispatcher.dispatch(b'{"jsonrpc": "2.0", "id": 1, "method": "slow"}')
+        await dispatcher.dispatch(b'{"jsonrpc": "2.0", "id": 2, "method": "bad"}')
+        await dispatcher.drain()
+        return {line["id"]: line["error"]["code"] for line in writer.lines}
+
+    assert asyncio.run(main()) == {1: stdio_transport.DEADLINE_EXCEEDED, 2: stdio_transport.SERVER_ERROR}
@@ -0,0 +1,34 @@
+import asyncio
+
+import httpx
+
+from services import tracing
+
+TRACEPARENT = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+
+def test_non_string_correlation_id_from_meta_is_replaced():
+    with tracing.span("rpc", meta={"traceparent": TRACEPARENT, "correlationId": 123}) as s:
+        assert isinstance(s.correlation_id, str) and s.correlation_id != "123"
+        headers = tracing.inject_headers({})
+    httpx.Request("GET", "http://example.invalid", headers=headers)  # must be header-safe
+
+
+def test_valid_correlation_id_is_kept():
+    with tracing.span("rpc", meta={"correlationId": "req-42:abc"}) as s:
+        assert s.correlation_id == "req-42:abc"
+
+
+def test_middleware_does_not_echo_unsafe_header():
+    sent = []
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"x-correlation-id", b"a b\x7f" + b"x" * 300)]}
+    asyncio.run(tracing.TracingMiddleware(app)(scope, None, send))
+    echoed = dict(sent[0]["headers"])[b"x-correlation-id"].decode()
+    assert tracing.valid_correlation_id(echoed) and echoed != "a b"